@@ -0,0 +1,183 @@
+# Benchmarks for fs.py operations on a scratch image.
+#
+#   python benchmarks/bench.py [--size BYTES] [--descriptors N] [--block-size B] ...
+#   python benchmarks/bench.py --save benchmarks/baseline.json
+#   python benchmarks/bench.py --baseline benchmarks/baseline.json
+#
+# Results are printed as JSON; with --baseline every benchmark slower than
+# the baseline by more than --tolerance is reported and the exit code is 1.
+import argparse, contextlib, gc, json, os, random, sys, tempfile, time
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fs
+
+
+class Suite:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.path = os.path.join(args.dir, 'bench.img')
+        self.os = fs.OS()
+        self.rand = random.Random(args.seed)
+        self.results: dict[str, dict] = dict()
+
+    def measure(self, name: str, ops: int, nbytes: int, func: Callable[[], None]) -> None:
+        # like timeit, keep collector pauses out of the timings
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+        finally:
+            gc.enable()
+        result = {'seconds': seconds, 'ops': ops,
+            'ops_per_sec': ops / seconds if seconds > 0 else 0.0}
+        if nbytes:
+            result['bytes_per_sec'] = nbytes / seconds if seconds > 0 else 0.0
+        self.results[name] = result
+
+    def names(self, count: int) -> list[str]:
+        return [f'f{i}' for i in range(count)]
+
+    def run(self) -> dict[str, dict]:
+        args = self.args
+        with open(self.path, 'wb') as file:
+            file.truncate(args.size)
+        self.measure('mkfs', 1, args.size,
+            lambda: self.os.fs.mkfs(args.descriptors, self.path, block_size=args.block_size))
+        self.os.unmount()
+
+        def mount():
+            for _ in range(args.mounts):
+                self.os.mount(self.path)
+                self.os.unmount()
+        self.measure('mount', args.mounts, 0, mount)
+        self.os.mount(self.path)
+
+        # the root directory and the data file take a descriptor each
+        files = min(args.files, args.descriptors - 2)
+        names = self.names(files)
+        self.measure('create', files, 0, lambda: [self.os.create(n) for n in names])
+        self.measure('unlink', files, 0, lambda: [self.os.unlink(n) for n in names])
+
+        def churn():
+            for i in range(args.churn):
+                self.os.create(names[i % files])
+                self.os.unlink(names[i % files])
+        self.measure('create_unlink_churn', 2 * args.churn, 0, churn)
+
+        fd = self.os.open('data')
+        io_size = args.io_size - args.io_size % args.block_size or args.block_size
+        file_size = args.file_size - args.file_size % io_size
+        chunk = bytes(self.rand.getrandbits(8) for _ in range(io_size))
+        buf = bytearray(io_size)
+        count = file_size // io_size
+
+        def seq_write():
+            self.os.offsets[fd] = 0
+            for _ in range(count):
+                self.os.write_bytes(fd, chunk)
+        self.measure('seq_write', count, file_size, seq_write)
+
+        def seq_read():
+            self.os.offsets[fd] = 0
+            while self.os.read_into(fd, buf) > 0:
+                pass
+        self.measure('seq_read', count, file_size, seq_read)
+
+        offsets = [self.rand.randrange(count) * io_size for _ in range(args.random_ops)]
+
+        def rand_write():
+            for offset in offsets:
+                self.os.offsets[fd] = offset
+                self.os.write_bytes(fd, chunk)
+        self.measure('rand_write', len(offsets), len(offsets) * io_size, rand_write)
+
+        def rand_read():
+            for offset in offsets:
+                self.os.offsets[fd] = offset
+                self.os.read_into(fd, buf)
+        self.measure('rand_read', len(offsets), len(offsets) * io_size, rand_read)
+
+        self.measure('sync', 1, 0, self.os.sync)
+        self.os.close(fd)
+
+        steps = [file_size * (i + 1) // args.truncate_steps for i in range(args.truncate_steps)]
+        self.measure('truncate_shrink', len(steps), 0,
+            lambda: [self.os.truncate('data', size) for size in reversed([0] + steps[:-1])])
+        self.measure('truncate_grow', len(steps), 0,
+            lambda: [self.os.truncate('data', size) for size in steps])
+
+        self.os.unmount()
+        os.remove(self.path)
+        return self.results
+
+
+def params(args) -> dict:
+    return {key: value for key, value in vars(args).items()
+        if key not in ('save', 'baseline', 'tolerance', 'dir')}
+
+def run(args) -> dict:
+    best: dict[str, dict] = dict()
+    for _ in range(args.repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = Suite(args).run()
+            # measure() turns the collector off, so clear the garbage before the next repeat
+            gc.collect()
+        for name, result in results.items():
+            if name not in best or result['seconds'] < best[name]['seconds']:
+                best[name] = result
+    return {'params': params(args), 'results': best}
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = list()
+    if baseline.get('params') != report['params']:
+        print('warning: baseline was taken with different parameters', file=sys.stderr)
+    for name, result in report['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or base['seconds'] <= 0:
+            continue
+        ratio = result['seconds'] / base['seconds']
+        result['baseline_seconds'] = base['seconds']
+        result['ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark fs.py operations')
+    parser.add_argument('--size', type=int, default=1 << 23, help='image size in bytes')
+    parser.add_argument('--descriptors', type=int, default=1024)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--files', type=int, default=1000, help='files for create/unlink')
+    parser.add_argument('--churn', type=int, default=5000, help='create/unlink pairs')
+    parser.add_argument('--file-size', type=int, default=1 << 22, help='bytes for read/write')
+    parser.add_argument('--io-size', type=int, default=1 << 14, help='bytes per read/write call')
+    parser.add_argument('--random-ops', type=int, default=5000)
+    parser.add_argument('--truncate-steps', type=int, default=64)
+    parser.add_argument('--mounts', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5, help='runs, the best one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='directory for the image')
+    parser.add_argument('--save', metavar='FILE', help='store results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+        help='allowed slowdown against the baseline, 0.5 - 50%%')
+    args = parser.parse_args()
+
+    report = run(args)
+    regressions = list()
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        report['regressions'] = regressions
+    print(json.dumps(report, indent=2))
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
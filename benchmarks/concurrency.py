@@ -0,0 +1,96 @@
+# Throughput of fs.AsyncOS under concurrent clients on a scratch image.
+#
+#   python benchmarks/concurrency.py [--clients 1,4,16] [--file-size BYTES] ...
+#
+# Every client works on its own file: 'read' streams it in --io-size chunks,
+# 'mixed' overwrites random chunks and reads others back. Results are
+# printed as JSON, one entry per workload and number of clients.
+import argparse, asyncio, contextlib, functools, json, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fs
+
+
+async def client_read(afs: fs.AsyncOS, path: str, io_size: int) -> int:
+    fd = await afs.open(path)
+    total = 0
+    while True:
+        data = await afs.read(fd, io_size)
+        if not data:
+            break
+        total += len(data)
+    await afs.close(fd)
+    return total
+
+async def client_mixed(afs: fs.AsyncOS, path: str, args, rand: random.Random) -> int:
+    fd = await afs.open(path)
+    chunk = rand.randbytes(args.io_size)
+    count = args.file_size // args.io_size
+    total = 0
+    for _ in range(args.ops):
+        await afs.seek(fd, rand.randrange(count) * args.io_size)
+        if rand.random() < args.write_ratio:
+            total += await afs.write(fd, chunk)
+        else:
+            total += len(await afs.read(fd, args.io_size))
+    await afs.close(fd)
+    return total
+
+async def run(args) -> dict:
+    path = os.path.join(args.dir, 'concurrency.img')
+    with open(path, 'wb') as file:
+        file.truncate(args.size)
+    clients = max(args.clients)
+    results: dict[str, dict] = dict()
+    async with fs.AsyncOS(args.workers) as afs:
+        await afs.run(functools.partial(afs.os.fs.mkfs, block_size=args.block_size), clients + 2, path)
+        await afs.unmount()
+        await afs.mount(path)
+        data = random.Random(args.seed).randbytes(args.file_size)
+        for i in range(clients):
+            fd = await afs.open(f'c{i}')
+            await afs.write(fd, data)
+            await afs.close(fd)
+        await afs.sync()
+        for count in args.clients:
+            for name in ('read', 'mixed'):
+                rands = [random.Random(args.seed + i) for i in range(count)]
+                start = time.perf_counter()
+                if name == 'read':
+                    done = await asyncio.gather(*(client_read(afs, f'c{i}', args.io_size)
+                        for i in range(count)))
+                else:
+                    done = await asyncio.gather(*(client_mixed(afs, f'c{i}', args, rands[i])
+                        for i in range(count)))
+                seconds = time.perf_counter() - start
+                results[f'{name}_{count}'] = {'clients': count, 'seconds': seconds,
+                    'bytes_per_sec': sum(done) / seconds if seconds > 0 else 0.0}
+    os.remove(path)
+    return results
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark fs.AsyncOS with concurrent clients')
+    parser.add_argument('--clients', default='1,2,4,8,16', help='comma separated client counts')
+    parser.add_argument('--workers', type=int, default=fs.ASYNC_WORKERS, help='executor threads')
+    parser.add_argument('--size', type=int, default=1 << 27, help='image size in bytes')
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--file-size', type=int, default=1 << 22, help='bytes per client file')
+    parser.add_argument('--io-size', type=int, default=1 << 16, help='bytes per read/write call')
+    parser.add_argument('--ops', type=int, default=200, help='operations per mixed client')
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='directory for the image')
+    args = parser.parse_args()
+    args.clients = sorted(int(c) for c in args.clients.split(','))
+    args.file_size -= args.file_size % args.io_size
+
+    fs.set_log_level(fs.LOG_FAIL)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run(args))
+    params = {key: value for key, value in vars(args).items() if key != 'dir'}
+    print(json.dumps({'params': params, 'results': results}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,251 @@
-import cmd, sys
-from typing import Optional, TypeVar, Tuple
-from abc import ABC
+import argparse, asyncio, cmd, contextlib, functools, json, signal, socket, socketserver, sys, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, TypeVar, Tuple
+from array import array
 import math
+import mmap
 import os.path
+import struct
+import time
+import zlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 NAME_WIDTH = 16
 NAME_DOT = "."
 NAME_DOT_DOT = ".."
+# where fsck links descriptors no directory names
+LOST_FOUND = "lost+found"
+
+# log levels, messages above LOG_LEVEL are dropped
+LOG_FAIL = 0
+LOG_INFO = 1
+LOG_DEBUG = 2
+LOG_LEVELS = {'fail': LOG_FAIL, 'info': LOG_INFO, 'debug': LOG_DEBUG}
+LOG_LEVEL = LOG_INFO
 
 def log_info(x):
-    print("INFO:", x)
+    if LOG_LEVEL >= LOG_INFO:
+        print("INFO:", x)
+
+# failures logged by each thread, script mode exits non-zero if its commands had any
+FAILURES = threading.local()
 
 def log_fail(x):
-    print("FAIL:", x)
+    FAILURES.count = failures() + 1
+    if LOG_LEVEL >= LOG_FAIL:
+        print("FAIL:", x)
+
+def failures() -> int:
+    return getattr(FAILURES, 'count', 0)
+
+def log_debug(x):
+    if LOG_LEVEL >= LOG_DEBUG:
+        print("DEBUG:", x)
+
+class Histogram:
+    # latencies counted in power-of-two microsecond buckets
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets: list[int] = list()
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+
+    def percentile(self, p: float) -> float:
+        # upper bound of the bucket holding the percentile, in seconds
+        rank = p * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def report(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+            'buckets_us': {1 << b: n for b, n in enumerate(self.buckets) if n}
+        }
+
+    def merge(self, other: "Histogram") -> None:
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        buckets = list(other.buckets)
+        if len(buckets) > len(self.buckets):
+            self.buckets.extend([0] * (len(buckets) - len(self.buckets)))
+        for bucket, n in enumerate(buckets):
+            self.buckets[bucket] += n
+
+class Stats:
+    # counters and latency histograms of one mount session; each thread counts
+    # into a shard of its own, so counting takes no lock, reports merge them
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.local = threading.local()
+        self.shards: dict[threading.Thread, Tuple[dict[str, int], dict[str, Histogram]]] = dict()
+        # shards of finished threads, folded in when new threads start counting
+        self.retired: Tuple[dict[str, int], dict[str, Histogram]] = (dict(), dict())
+        self.lock = threading.Lock()
+
+    def new_shard(self) -> Tuple[dict[str, int], dict[str, Histogram]]:
+        shard = self.local.counters, self.local.latency = dict(), dict()
+        with self.lock:
+            for thread in [thread for thread in self.shards if not thread.is_alive()]:
+                merge_shard(self.retired, self.shards.pop(thread))
+            self.shards[threading.current_thread()] = shard
+        return shard
+
+    def count(self, name: str, n: int = 1) -> None:
+        try:
+            counters = self.local.counters
+        except AttributeError:
+            counters = self.new_shard()[0]
+        counters[name] = counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        try:
+            latency = self.local.latency
+        except AttributeError:
+            latency = self.new_shard()[1]
+        hist = latency.get(name)
+        if hist is None:
+            hist = latency[name] = Histogram()
+        hist.observe(seconds)
+
+    def merged(self) -> Tuple[dict[str, int], dict[str, Histogram]]:
+        total: Tuple[dict[str, int], dict[str, Histogram]] = (dict(), dict())
+        with self.lock:
+            merge_shard(total, self.retired)
+            for shard in list(self.shards.values()):
+                merge_shard(total, shard)
+        return total
+
+    @property
+    def counters(self) -> dict[str, int]:
+        return self.merged()[0]
+
+    def report(self) -> dict:
+        counters, latency = self.merged()
+        return {
+            'seconds': time.monotonic() - self.started,
+            'counters': dict(sorted(counters.items())),
+            'latency': {name: hist.report() for name, hist in sorted(latency.items())}
+        }
+
+def merge_shard(total: Tuple[dict[str, int], dict[str, Histogram]], \
+        shard: Tuple[dict[str, int], dict[str, Histogram]]) -> None:
+    # the owner may still be counting, its dicts are copied before reading
+    for name, n in list(shard[0].items()):
+        total[0][name] = total[0].get(name, 0) + n
+    for name, hist in list(shard[1].items()):
+        if name not in total[1]:
+            total[1][name] = Histogram()
+        total[1][name].merge(hist)
+
+class RWLock:
+    # shared or exclusive holders, a waiting exclusive one blocks new shared ones;
+    # taken with "with lock.shared:" or "with lock.exclusive:"
+    __slots__ = ('mutex', 'cond', 'readers', 'writer', 'waiting', 'sleeping', 'shared', 'exclusive')
+
+    def __init__(self) -> None:
+        self.mutex = threading.Lock()
+        # made by the first holder that has to wait
+        self.cond: Optional[threading.Condition] = None
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+        self.sleeping = 0
+        self.shared = Shared(self)
+        self.exclusive = Exclusive(self)
+
+    def wait(self) -> None:
+        if self.cond is None:
+            self.cond = threading.Condition(self.mutex)
+        self.sleeping += 1
+        self.cond.wait()
+        self.sleeping -= 1
+
+class Shared:
+    # with-statement sides of RWLock, entered on every operation so kept flat
+    __slots__ = ('lock', 'mutex')
+
+    def __init__(self, lock: RWLock) -> None:
+        self.lock = lock
+        self.mutex = lock.mutex
+
+    def __enter__(self) -> None:
+        lock = self.lock
+        with self.mutex:
+            while lock.writer or lock.waiting:
+                lock.wait()
+            lock.readers += 1
+
+    def __exit__(self, *exc) -> None:
+        lock = self.lock
+        with self.mutex:
+            lock.readers -= 1
+            if lock.sleeping:
+                lock.cond.notify_all()
+
+class Exclusive(Shared):
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        lock = self.lock
+        with self.mutex:
+            lock.waiting += 1
+            while lock.writer or lock.readers:
+                lock.wait()
+            lock.waiting -= 1
+            lock.writer = True
+
+    def __exit__(self, *exc) -> None:
+        lock = self.lock
+        with self.mutex:
+            lock.writer = False
+            if lock.sleeping:
+                lock.cond.notify_all()
+
+class InodeLocks:
+    # reader/writer lock per descriptor slot, made on first use and reused
+    def __init__(self) -> None:
+        self.guard = threading.Lock()
+        self.locks: dict[int, RWLock] = dict()
+
+    def make(self, index: int) -> RWLock:
+        with self.guard:
+            return self.locks.setdefault(index, RWLock())
+
+    def shared(self, index: int) -> Shared:
+        lock = self.locks.get(index)
+        return (lock if lock is not None else self.make(index)).shared
+
+    def exclusive(self, index: int) -> Exclusive:
+        lock = self.locks.get(index)
+        return (lock if lock is not None else self.make(index)).exclusive
 
 U = TypeVar('U')
 
@@ -21,50 +254,145 @@ def Optional_unwrap(x: Optional[U]) -> U:
     y: U = x
     return y
 
-# working with blocks
+# working with blocks, the size of new images unless mkfs is given one
 BLOCK_SIZE = 64
+MIN_BLOCK_SIZE = 64
+MAX_BLOCK_SIZE = 1 << 16
+# defaults of the mkfs command line
+MKFS_BLOCK_SIZE = 4096
+MKFS_BYTES_PER_DESC = 1 << 14
+MKFS_MIN_DESCRIPTORS = 16
+
+# descriptors live in FS columns, FileDesc is a view of one slot made on access
+class FileDesc:
+    __slots__ = ('fs', 'index')
+
+    def __init__(self, fs: "FS", index: int) -> None:
+        self.fs = fs
+        self.index = index # slot in descriptors table
+
+    @property
+    def type(self) -> str: # d, r, s or - for a free slot
+        return chr(self.fs.types[self.index])
+
+    @property
+    def nlink(self) -> int:
+        return self.fs.nlinks[self.index]
+
+    @nlink.setter
+    def nlink(self, value: int) -> None:
+        self.fs.nlinks[self.index] = value
+
+    @property
+    def size(self) -> int:
+        return self.fs.sizes[self.index]
+
+    @size.setter
+    def size(self, value: int) -> None:
+        self.fs.sizes[self.index] = value
+
+    @property
+    def nblock(self) -> int:
+        return self.fs.nblocks[self.index]
+
+    @nblock.setter
+    def nblock(self, value: int) -> None:
+        self.fs.nblocks[self.index] = value
+
+    @property
+    def to_delete(self) -> int: # unlinked while open
+        return int(self.index in self.fs.orphans)
+
+    @to_delete.setter
+    def to_delete(self, value: int) -> None:
+        if value:
+            self.fs.orphans.add(self.index)
+        else:
+            self.fs.orphans.discard(self.index)
 
-class Block:
-    def __init__(self) -> None:
-        self.block: bytearray = bytearray(b'\x00')*BLOCK_SIZE
-        self.index = -1
+    @property
+    def opened(self) -> int: # open file handles
+        return self.fs.open_counts.get(self.index, 0)
+
+    @opened.setter
+    def opened(self, value: int) -> None:
+        if value:
+            self.fs.open_counts[self.index] = value
+        else:
+            self.fs.open_counts.pop(self.index, None)
 
-    def write(self, str) -> None:
-        self.block = bytearray(str)
+    @property
+    def data(self) -> array: # data block numbers in file order
+        return self.fs.block_list(self.index)
 
-class FileDesc(ABC):
-    def __init__(self, type) -> None:
-        log_info(f"New FileDesc {self}")
-        self.type = type # d чи r
-        self.nlink = 1 # максимум 16 розрядів
-        self.size = 0 # максимум 16 розрядів
-        self.nblock = 0 # максимум 16 розрядів
-        self.to_delete = 0
+    @property
+    def nodes(self) -> dict[Tuple[int, ...], int]:
+        # indirect blocks of the block map, see block_path for the keys
+        return self.fs.block_nodes(self.index)
 
-    def __del__(self) -> None:
-        log_info(f"Del FileDesc {self}")
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FileDesc) and other.fs is self.fs and other.index == self.index
+
+    def __hash__(self) -> int:
+        return self.index
 
     def __str__(self) -> str:
-        return f"{id(self)} {type(self).__name__}"
+        return f"{self.index} {type(self).__name__}"
 
 class FileReg(FileDesc):
-    def __init__(self) -> None:
-        super().__init__("r")
-        self.data: list[Optional[Block]] = list()
-        self.link: int = None
+    __slots__ = ()
 
 class FileSym(FileDesc):
-    def __init__(self, value: str) -> None:
-        super().__init__("s")
-        self.value: str = value
+    __slots__ = ()
+
+    @property
+    def value(self) -> str:
+        return self.fs.symlinks.get(self.index, "")
 
 class FileDir(FileDesc):
-    def __init__(self, pardesc: FileDesc = None) -> None:
-        super().__init__("d")
-        self.links: dict[str, FileDesc] = dict()
-        self.links[NAME_DOT] = self
-        self.links[NAME_DOT_DOT] = Optional_unwrap(pardesc) \
-            if pardesc != None else self
+    __slots__ = ()
+
+    @property
+    def links(self) -> dict[str, int]: # name -> descriptor slot
+        return self.fs.dir_table(self).links
+
+# directory hash table, loaded from the directory file when it is first changed or listed
+class DirTable:
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.links: dict[str, int] = dict()
+        # name -> slot in the table
+        self.slots: dict[str, int] = dict()
+        # slot states: 0 - empty, 1 - live, 2 - deleted
+        self.states = bytearray(capacity)
+        # live and deleted slots, empty ones end the probing
+        self.used = 0
+
+    def insert(self, name: str, index: int) -> int:
+        slot = zlib.crc32(name.encode()) % self.capacity
+        while self.states[slot] == 1:
+            slot = (slot + 1) % self.capacity
+        if self.states[slot] == 0:
+            self.used += 1
+        self.states[slot] = 1
+        self.links[name] = index
+        self.slots[name] = slot
+        return slot
+
+    def remove(self, name: str) -> int:
+        del self.links[name]
+        slot = self.slots.pop(name)
+        self.states[slot] = 2
+        return slot
+
+    def full(self) -> bool:
+        return self.used + 1 > self.capacity * DIR_MAX_LOAD
+
+DESC_VIEWS = {ord('d'): FileDir, ord('r'): FileReg, ord('s'): FileSym}
+
+def set_log_level(level: int) -> None:
+    global LOG_LEVEL
+    LOG_LEVEL = level
 
 def path_exist(pardir: Optional[FileDir], desc: Optional[FileDesc], \
             path: str) -> bool:
@@ -86,6 +414,12 @@ def path_not_exist(pardir: Optional[FileDir], desc: Optional[FileDesc], \
         return True
     return False
 
+def name_too_long(name: str) -> bool:
+    if len(name.encode()) > MAX_R:
+        log_fail(f"Name '{name}' maximum length is {MAX_R}")
+        return True
+    return False
+
 def desc_is_FileDir(desc: FileDesc, path: str) -> bool:
     if not isinstance(desc, FileDir):
         return False
@@ -99,515 +433,2092 @@ def str_to_binary(c):
     c = str(c)
     return ' '.join(format(ord(i),'b').zfill(8) for i in c)
 
-# format data max length -> 16
+# names and legacy v1 fields max length -> 16
 MAX_R = 16
-def format_data_write_file(n):
-    n = str(n)
-    n_len = len(n)
-    if n_len > MAX_R:
-        n = n[0:MAX_R]
-    elif n_len < MAX_R:
-        n = " " * (MAX_R - n_len) + n
-    return str(n)
-
-BLOCKS_MAP_SIZE = 5
-DESC_SIZE = 1 + MAX_R + MAX_R + MAX_R + BLOCKS_MAP_SIZE*MAX_R
-DESC_NUMBER = 10 # user sets
-SUPERBLOCK_SIZE = 48 
-BLOCKS_NUMBER = 50 # program sets, depending on file size
-HARDLINK_LEN = MAX_R * 2
-HARDLINKS_SIZE = DESC_NUMBER * HARDLINK_LEN #depends on user input of desc number
-
-class FS:
-    def __init__(self) -> None:
-        self.initialized = 0
 
-    def encode_descriptor(self, desc: FileDesc) -> str: 
-        block_map = ""
-        if (desc.type == 'r'):
-            for item in desc.data:
-                block_map += format_data_write_file(item.index)
+# on-disk format: little-endian fixed-width fields, bit-packed bitmap, metadata journal
+FS_MAGIC = b'LZFS'
+FS_VERSION = 5
+NO_BLOCK = 0xFFFFFFFF
+NO_DESC = 0xFFFFFFFF
+# block map: direct pointers, then single, double and triple indirect ones
+DIRECT_BLOCKS = 4
+INDIRECT_LEVELS = 3
+BLOCKS_MAP_SIZE = DIRECT_BLOCKS + INDIRECT_LEVELS
+# magic, version, flags, descriptors number, blocks number, block size, journal size
+SUPERBLOCK_STRUCT = struct.Struct('<4sHHIIII')
+SUPERBLOCK_SIZE = 64
+# v2 block maps had the direct pointers and a single indirect one only
+V2_VERSION = 2
+V2_BLOCKS_MAP_SIZE = DIRECT_BLOCKS + 1
+V2_DESC_STRUCT = struct.Struct(f'<cHQI{V2_BLOCKS_MAP_SIZE}I')
+# v3 superblock had no journal
+V3_VERSION = 3
+V3_SUPERBLOCK_STRUCT = struct.Struct('<4sHHIII')
+# v4 kept the root directory in a hardlinks table before the descriptors
+V4_VERSION = 4
+# directory entry: name, descriptor number
+DIRENT_STRUCT = struct.Struct(f'<{MAX_R}sI')
+DIRENT_LEN = DIRENT_STRUCT.size
+# entry removed from a directory, probing goes on past it
+DELETED_DESC = 0xFFFFFFFE
+EMPTY_DIRENT = DIRENT_STRUCT.pack(b'', NO_DESC)
+# type, nlink, size, nblock, map of block numbers
+DESC_STRUCT = struct.Struct(f'<cHQI{BLOCKS_MAP_SIZE}I')
+DESC_SIZE = DESC_STRUCT.size
+DESC_NLINK_OFFSET = struct.calcsize('<c')
+DESC_SIZE_OFFSET = struct.calcsize('<cH')
+DESC_NBLOCK_OFFSET = struct.calcsize('<cHQ')
+DESC_MAP_OFFSET = struct.calcsize('<cHQI')
+PTR_SIZE = 4
+# descriptors are read from the table in groups of 1 << DESC_GROUP_SHIFT, on first use
+DESC_GROUP_SHIFT = 12
+
+# directories are open addressing hash tables of entries in their data blocks,
+# grown when more than DIR_MAX_LOAD of the slots are live or deleted
+DIR_MIN_ENTRIES = 4
+DIR_MAX_LOAD = 0.75
+
+# metadata journal right after the superblock: header, then transactions
+JOURNAL_MAGIC = b'LZJH'
+TRANSACTION_MAGIC = b'LZJT'
+# magic, sequence number of the first transaction to replay
+JOURNAL_HEADER_STRUCT = struct.Struct('<4sQ')
+JOURNAL_HEADER_SIZE = 64
+# magic, sequence number, payload length, payload crc32
+TRANSACTION_STRUCT = struct.Struct('<4sQII')
+# image offset and length of the data that follows
+RECORD_STRUCT = struct.Struct('<QI')
+JOURNAL_MIN_SIZE = 4096
+JOURNAL_MAX_SIZE = 1 << 22
+# directory and indirect blocks one transaction takes at least
+JOURNAL_MIN_BLOCKS = 8
+
+def journal_size(desc_num: int, blocks_num: int, block_size: int) -> int:
+    # room for two copies of all metadata before a checkpoint is needed,
+    # and for whole metadata blocks however large they are
+    meta = desc_num * (DIRENT_LEN + DESC_SIZE) + bitmap_size(blocks_num)
+    blocks = JOURNAL_HEADER_SIZE + TRANSACTION_STRUCT.size + \
+        JOURNAL_MIN_BLOCKS * (block_size + RECORD_STRUCT.size)
+    return max(min(max(JOURNAL_MIN_SIZE, JOURNAL_HEADER_SIZE + 2*meta), JOURNAL_MAX_SIZE), blocks)
+
+def empty_journal(size: int, seq: int = 0) -> bytes:
+    return JOURNAL_HEADER_STRUCT.pack(JOURNAL_MAGIC, seq).ljust(size, b'\x00')
+
+def replay(image: "Image", offset: int, size: int) -> Tuple[int, int, int]:
+    # writes committed transactions of the journal at offset in place, returns
+    # the next sequence number, journal position after them and their number
+    data = image.read(offset, size)
+    magic, seq = JOURNAL_HEADER_STRUCT.unpack_from(data)
+    if magic != JOURNAL_MAGIC:
+        seq = 0
+    pos = JOURNAL_HEADER_SIZE
+    replayed = 0
+    # committed transactions follow each other with consecutive numbers
+    while pos + TRANSACTION_STRUCT.size <= size:
+        magic, tseq, length, crc = TRANSACTION_STRUCT.unpack_from(data, pos)
+        start = pos + TRANSACTION_STRUCT.size
+        payload = data[start:start + length]
+        if magic != TRANSACTION_MAGIC or tseq != seq or \
+                len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        i = 0
+        while i < length:
+            record, record_size = RECORD_STRUCT.unpack_from(payload, i)
+            i += RECORD_STRUCT.size
+            image.write(record, payload[i:i + record_size])
+            i += record_size
+        pos = start + length
+        seq += 1
+        replayed += 1
+    return seq, pos, replayed
+
+def transactions(records: list[Tuple[int, bytes]], capacity: int) -> list[list[Tuple[int, bytes]]]:
+    # records packed into transaction payloads of at most capacity bytes,
+    # a record too big for one is cut into pieces
+    batches = [list()]
+    free = capacity
+    for offset, data in records:
+        pos = 0
+        while pos < len(data):
+            if free <= RECORD_STRUCT.size:
+                batches.append(list())
+                free = capacity
+            piece = data[pos:pos + free - RECORD_STRUCT.size]
+            batches[-1].append((offset + pos, piece))
+            free -= RECORD_STRUCT.size + len(piece)
+            pos += len(piece)
+    return [batch for batch in batches if batch]
+
+def bitmap_size(blocks_number: int) -> int:
+    return (blocks_number + 7) // 8
+
+def pack_bitmap(bitmap: list[int]) -> bytearray:
+    data = bytearray(bitmap_size(len(bitmap)))
+    for i, bit in enumerate(bitmap):
+        if bit:
+            data[i >> 3] |= 1 << (i & 7)
+    return data
+
+
+def pack_pointers(pointers: list[int], count: int) -> bytes:
+    pointers = list(pointers) + [NO_BLOCK] * (count - len(pointers))
+    return struct.pack(f'<{count}I', *pointers)
+
+def unpack_pointers(data: bytes) -> Tuple[int, ...]:
+    # holes stay in place as NO_BLOCK
+    count = len(data) // PTR_SIZE
+    return struct.unpack(f'<{count}I', data[:count*PTR_SIZE])
+
+def node_pointers(data: bytes) -> array:
+    # block numbers in an indirect block, holes left out
+    pointers = array('I', data[:len(data) // PTR_SIZE * PTR_SIZE])
+    if sys.byteorder == 'big':
+        pointers.byteswap()
+    if NO_BLOCK in pointers:
+        pointers = array('I', (p for p in pointers if p != NO_BLOCK))
+    return pointers
+
+def holes(count: int) -> array:
+    return array('I', [NO_BLOCK]) * count
+
+def mapped_blocks(data: array, chunk: int = 1024) -> list[int]:
+    # block numbers in a block list, runs of holes are skipped a chunk at a time
+    empty = holes(chunk)
+    blocks = list()
+    for i in range(0, len(data), chunk):
+        part = data[i:i + chunk]
+        if part != empty[:len(part)]:
+            blocks.extend(index for index in part if index != NO_BLOCK)
+    return blocks
+
+def column(data: bytes, record: int, offset: int, typecode: str) -> array:
+    # little-endian field at offset of every record, gathered without per-record objects
+    col = array(typecode)
+    width = col.itemsize
+    buf = bytearray(width * (len(data) // record))
+    for k in range(width):
+        buf[k::width] = data[offset + k::record]
+    col.frombytes(buf)
+    if sys.byteorder == 'big':
+        col.byteswap()
+    return col
+
+def scatter(data: bytearray, record: int, offset: int, col: array) -> None:
+    # col as the little-endian field at offset of every record, the inverse of column
+    if sys.byteorder == 'big':
+        col = array(col.typecode, col)
+        col.byteswap()
+    width = col.itemsize
+    buf = col.tobytes()
+    for k in range(width):
+        data[offset + k::record] = buf[k::width]
+
+def coalesce(items: list[int]) -> list[Tuple[int, int]]:
+    # sorted runs of consecutive numbers as (first, count)
+    runs = list()
+    for i in sorted(items):
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
         else:
-            block_map = " " * MAX_R * BLOCKS_MAP_SIZE
-        return desc.type + format_data_write_file(desc.nlink) + format_data_write_file(desc.size) + format_data_write_file(desc.nblock)  + block_map #last field for map of block numbers
+            runs.append((i, 1))
+    return runs
+
+def count_references(refs: array, blocks_number: int) -> Tuple[bytes, list[int]]:
+    # blocks in refs as a packed bitmap, and the ones found more than once
+    if numpy is not None:
+        counts = numpy.bincount(numpy.frombuffer(refs, dtype=numpy.uint32), minlength=blocks_number)
+        used = numpy.packbits(counts > 0, bitorder='little').tobytes()
+        return used, numpy.flatnonzero(counts > 1).tolist()
+    used = bytearray(bitmap_size(blocks_number))
+    duplicates = set()
+    for i in refs:
+        bit = 1 << (i & 7)
+        if used[i >> 3] & bit:
+            duplicates.add(i)
+        used[i >> 3] |= bit
+    return bytes(used), sorted(duplicates)
+
+def set_bits(data: bytes) -> list[int]:
+    # positions of the bits set in a packed bitmap
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8), bitorder='little')
+        return numpy.flatnonzero(bits).tolist()
+    return [(i << 3) + k for i, byte in enumerate(data) if byte for k in range(8) if byte >> k & 1]
+
+def preview(items: list, limit: int = 8) -> str:
+    # count and the first few of a list of problems
+    shown = ", ".join(str(item) for item in items[0:limit])
+    return f"{len(items)} ({shown}{', ...' if len(items) > limit else ''})"
+
+def pointers_per_block(block_size: int) -> int:
+    return block_size // PTR_SIZE
+
+def dirents_per_block(block_size: int) -> int:
+    # entries never cross a block boundary
+    return block_size // DIRENT_LEN
+
+def dir_blocks(entries: int, block_size: int) -> int:
+    # blocks for a table at most half full with entries
+    return max(1, math.ceil(2*entries / dirents_per_block(block_size)))
+
+def dirent_offset(slot: int, block_size: int) -> Tuple[int, int]:
+    # file block and offset in it of a directory slot
+    per_block = dirents_per_block(block_size)
+    return slot // per_block, (slot % per_block) * DIRENT_LEN
+
+def max_file_blocks(block_size: int) -> int:
+    return DIRECT_BLOCKS + sum(pointers_per_block(block_size) ** level
+        for level in range(1, INDIRECT_LEVELS + 1))
+
+def block_path(n: int, block_size: int) -> Tuple[int, list[int]]:
+    # indirection level and pointer offsets on each level for n-th data block
+    if n < DIRECT_BLOCKS:
+        return 0, [n]
+    n -= DIRECT_BLOCKS
+    per_block = pointers_per_block(block_size)
+    for level in range(1, INDIRECT_LEVELS + 1):
+        span = per_block ** level
+        if n < span:
+            offsets = list()
+            for _ in range(level):
+                offsets.append(n % per_block)
+                n //= per_block
+            return level, offsets[::-1]
+        n -= span
+    return -1, []
+
+def node_start(key: Tuple[int, ...], block_size: int) -> int:
+    # first data block under the indirect block at key, the inverse of block_path
+    level = key[0]
+    per_block = pointers_per_block(block_size)
+    n = DIRECT_BLOCKS + sum(per_block ** l for l in range(1, level))
+    for depth, offset in enumerate(key[1:]):
+        n += offset * per_block ** (level - 1 - depth)
+    return n
+
+def mapped_length(data: array, end: int) -> int:
+    # length of data[:end] without the holes at its end, holes are all ones
+    end = min(end, len(data))
+    if end == 0 or data[end - 1] != NO_BLOCK:
+        return end
+    return (len(data[:end].tobytes().rstrip(b'\xff')) + PTR_SIZE - 1) // PTR_SIZE
+
+def decode_data(data: bytes) -> str:
+    return data.strip(b' \x00').decode(errors='replace')
+
+# legacy v1 format: every field is a space-padded ascii decimal of MAX_R chars
+V1_SUPERBLOCK_SIZE = 3 * MAX_R
+V1_HARDLINK_LEN = MAX_R * 2
+V1_BLOCKS_MAP_SIZE = 5
+V1_DESC_SIZE = 1 + MAX_R + MAX_R + MAX_R + V1_BLOCKS_MAP_SIZE*MAX_R
+CONVERT_CHUNK_BLOCKS = 1024
+
+def v4_header(flags: int, desc_num: int, blocks_num: int, block_size: int) -> bytes:
+    size = journal_size(desc_num, blocks_num, block_size)
+    return SUPERBLOCK_STRUCT.pack(FS_MAGIC, V4_VERSION, flags, desc_num, blocks_num,
+        block_size, size).ljust(SUPERBLOCK_SIZE, b'\x00') + empty_journal(size)
+
+def copy_rest(fin, fout, block_size: int) -> None:
+    while True:
+        chunk = fin.read(CONVERT_CHUNK_BLOCKS * block_size)
+        if not chunk:
+            break
+        fout.write(chunk)
+
+def convert_v3(fin, dst: str, flags: int, desc_num: int, blocks_num: int, block_size: int) -> None:
+    # v3 layout is v4 without the journal, the rest is copied as is
+    fin.seek(SUPERBLOCK_SIZE)
+    with open(dst, "wb") as fout:
+        fout.write(v4_header(flags, desc_num, blocks_num, block_size))
+        copy_rest(fin, fout, block_size)
+
+def convert_v2(fin, dst: str, flags: int, desc_num: int, blocks_num: int, block_size: int) -> None:
+    # v2 is v3 with shorter block maps: the direct pointers and the single
+    # indirect one are where v3 has them, nblock counts indirect blocks in both
+    fin.seek(SUPERBLOCK_SIZE)
+    with open(dst, "wb") as fout:
+        fout.write(v4_header(flags, desc_num, blocks_num, block_size))
+        fout.write(fin.read(desc_num * DIRENT_LEN))
+        for fields in V2_DESC_STRUCT.iter_unpack(fin.read(desc_num * V2_DESC_STRUCT.size)):
+            fout.write(DESC_STRUCT.pack(*fields,
+                *[NO_BLOCK] * (BLOCKS_MAP_SIZE - V2_BLOCKS_MAP_SIZE)))
+        copy_rest(fin, fout, block_size)
+
+def convert_v1(fin, dst: str, desc_num: int, blocks_num: int, block_size: int) -> None:
+    with open(dst, "wb") as fout:
+        fout.write(v4_header(0, desc_num, blocks_num, block_size))
+        for _ in range(desc_num):
+            raw = fin.read(V1_HARDLINK_LEN)
+            name = raw[:MAX_R].strip()
+            index = raw[MAX_R:].strip()
+            index = int(index) if index.isdigit() else NO_DESC
+            fout.write(DIRENT_STRUCT.pack(name, index))
+        # indirect blocks hold ascii block numbers and are rewritten below
+        indirect = set()
+        for _ in range(desc_num):
+            raw = fin.read(V1_DESC_SIZE)
+            type = raw[:1].strip() or b'-'
+            fields = [raw[1 + MAX_R*j:1 + MAX_R*(j+1)].strip()
+                for j in range(3 + V1_BLOCKS_MAP_SIZE)]
+            nlink, size, nblock = [int(f or 0) for f in fields[:3]]
+            block_map = [int(f) for f in fields[3:] if f != b'']
+            # v1 map is direct pointers and a single indirect one in the last slot
+            if type == b'r' and len(block_map) == V1_BLOCKS_MAP_SIZE:
+                indirect.add(block_map[-1])
+            fout.write(DESC_STRUCT.pack(type, nlink, size, nblock,
+                *(block_map + [NO_BLOCK] * (BLOCKS_MAP_SIZE - len(block_map)))))
+        done = 0
+        while done < blocks_num:
+            count = min(8 * CONVERT_CHUNK_BLOCKS, blocks_num - done)
+            chunk = fin.read(count)
+            fout.write(pack_bitmap([1 if c == ord('1') else 0 for c in chunk]))
+            done += count
+        for start in range(0, blocks_num, CONVERT_CHUNK_BLOCKS):
+            count = min(CONVERT_CHUNK_BLOCKS, blocks_num - start)
+            chunk = bytearray(fin.read(count * block_size))
+            for i in indirect:
+                if start <= i < start + count:
+                    offset = (i - start) * block_size
+                    raw = chunk[offset:offset + block_size]
+                    pointers = [int(raw[j:j+MAX_R]) for j in
+                        range(0, block_size - MAX_R + 1, MAX_R)
+                        if raw[j:j+MAX_R].strip() != b'']
+                    chunk[offset:offset + block_size] = \
+                        pack_pointers(pointers, block_size // PTR_SIZE)
+            fout.write(chunk)
+
+def convert_v4(src: str, dst: str) -> bool:
+    # the hardlinks table is dropped, its entries go to the root directory file
+    image = Image(src, Stats())
+    _, _, flags, desc_num, blocks_num, block_size, journal = \
+        SUPERBLOCK_STRUCT.unpack(image.read(0, SUPERBLOCK_STRUCT.size))
+    # an image that was not unmounted cleanly gets its journal applied first
+    if replay(image, SUPERBLOCK_SIZE, journal)[2] != 0:
+        image.flush()
+    offset = SUPERBLOCK_SIZE + journal
+    links = [(name.rstrip(b'\x00').decode(), index) for name, index in
+        DIRENT_STRUCT.iter_unpack(image.read(offset, desc_num * DIRENT_LEN))]
+    offset += desc_num * DIRENT_LEN
+    size = journal_size(desc_num, blocks_num, block_size)
+    with open(dst, "wb") as fout:
+        fout.write(SUPERBLOCK_STRUCT.pack(FS_MAGIC, FS_VERSION, flags, desc_num,
+            blocks_num, block_size, size).ljust(SUPERBLOCK_SIZE, b'\x00'))
+        fout.write(empty_journal(size))
+        # root directory starts over without blocks
+        fout.write(DESC_STRUCT.pack(b'd', 2, 0, 0, *[NO_BLOCK] * BLOCKS_MAP_SIZE))
+        offset += DESC_SIZE
+        while True:
+            chunk = image.read(offset, CONVERT_CHUNK_BLOCKS * block_size)
+            if not chunk:
+                break
+            fout.write(chunk)
+            offset += len(chunk)
+    image.close()
+    fs = FS()
+    fs.mount(dst)
+    if not fs.initialized:
+        return False
+    ok = fs.dir_init(fs.rootdir, fs.rootdir) != -1
+    for name, index in links:
+        if not ok:
+            break
+        if index != NO_DESC and name not in (NAME_DOT, NAME_DOT_DOT):
+            ok = fs.add_entry(fs.rootdir, name, index) != -1
+    fs.unmount()
+    if not ok:
+        log_fail("No space left for the root directory")
+    return ok
+
+def convert(src: str, dst: str = None) -> bool:
+    'Upgrade v1, v2, v3 or v4 image src to the current format in dst (src itself if dst is not given)'
+    if not os.path.isfile(src):
+        log_fail(f"Image '{src}' does not exist")
+        return False
+    in_place = dst is None or dst == src
+    out_path = src + ".tmp" if in_place else dst
+    # older formats are brought to v4 first
+    v4_path = src + ".v4"
+    with open(src, "rb") as fin:
+        head = fin.read(V1_SUPERBLOCK_SIZE)
+        if head[:len(FS_MAGIC)] == FS_MAGIC:
+            magic, version, flags, desc_num, blocks_num, block_size = \
+                V3_SUPERBLOCK_STRUCT.unpack(head[:V3_SUPERBLOCK_STRUCT.size])
+            if version == FS_VERSION:
+                log_fail(f"Image '{src}' is already in v{FS_VERSION} format")
+                return False
+            if version == V4_VERSION:
+                v4_path = src
+            elif version == V3_VERSION:
+                convert_v3(fin, v4_path, flags, desc_num, blocks_num, block_size)
+            elif version == V2_VERSION:
+                convert_v2(fin, v4_path, flags, desc_num, blocks_num, block_size)
+            else:
+                log_fail(f"Unsupported image version {version}")
+                return False
+        else:
+            try:
+                desc_num, blocks_num, block_size = \
+                    [int(head[MAX_R*i:MAX_R*(i+1)]) for i in range(3)]
+            except ValueError:
+                log_fail(f"Image '{src}' is not a v1 filesystem")
+                return False
+            convert_v1(fin, v4_path, desc_num, blocks_num, block_size)
+    ok = convert_v4(v4_path, out_path)
+    if v4_path != src:
+        os.remove(v4_path)
+    if not ok:
+        os.remove(out_path)
+        return False
+    if in_place:
+        os.replace(out_path, src)
+    log_info(f"Image '{src}' converted to v{FS_VERSION}")
+    return True
 
-    def encode_hardlink(self, link) -> str:
-        name = link[0]
-        index = link[1]
-        return format_data_write_file(name) + format_data_write_file(index)
+# blocks per free-count group of the allocator
+BITMAP_GROUP_BLOCKS = 4096
+BITMAP_GROUP_BYTES = BITMAP_GROUP_BLOCKS // 8
+
+class Bitmap:
+    def __init__(self, data: bytes, blocks_number: int, stats: Stats) -> None:
+        self.data = bytearray(data[0:bitmap_size(blocks_number)])
+        self.blocks_number = blocks_number
+        self.stats = stats
+        # next-fit cursor - block to start the next search from
+        self.cursor = 0
+        self.groups_number = (blocks_number + BITMAP_GROUP_BLOCKS - 1) // BITMAP_GROUP_BLOCKS
+        self.group_free: list[int] = list()
+        for g in range(self.groups_number):
+            start = g * BITMAP_GROUP_BLOCKS
+            count = min(BITMAP_GROUP_BLOCKS, blocks_number - start)
+            used = int.from_bytes(self.data[start >> 3:(start + count + 7) >> 3],
+                'little').bit_count()
+            self.group_free.append(count - used)
+        self.free = sum(self.group_free)
+        # bytes changed since last persist
+        self.dirty: set[int] = set()
+        # allocator lock, writers of different files share the bitmap
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self.blocks_number
+
+    def __getitem__(self, index: int) -> int:
+        return (self.data[index >> 3] >> (index & 7)) & 1
+
+    def __setitem__(self, index: int, value: int) -> None:
+        with self.lock:
+            if self[index] == value:
+                return
+            self.data[index >> 3] ^= 1 << (index & 7)
+            self.dirty.add(index >> 3)
+            group = index // BITMAP_GROUP_BLOCKS
+            if value:
+                self.group_free[group] -= 1
+                self.free -= 1
+            else:
+                self.group_free[group] += 1
+                self.free += 1
+
+    def find_free_in_bytes(self, start: int, end: int) -> int:
+        for i in range(start, end):
+            byte = self.data[i]
+            if byte == 0xFF:
+                continue
+            index = (i << 3) + ((~byte & (byte + 1)).bit_length() - 1)
+            if index < self.blocks_number:
+                self.stats.count('bitmap_bytes_scanned', i - start + 1)
+                return index
+        self.stats.count('bitmap_bytes_scanned', end - start)
+        return -1
 
-    def mkfs(self, n = 10) -> None: 
+    def find_free(self) -> int:
+        if self.free == 0:
+            return -1
+        self.stats.count('bitmap_sweeps')
+        group = self.cursor // BITMAP_GROUP_BLOCKS
+        # first pass starts at the cursor, last one wraps to the start of its group
+        for k in range(self.groups_number + 1):
+            g = (group + k) % self.groups_number
+            if self.group_free[g] == 0:
+                continue
+            start = g * BITMAP_GROUP_BYTES
+            if k == 0:
+                start = self.cursor >> 3
+            end = min((g + 1) * BITMAP_GROUP_BYTES, len(self.data))
+            index = self.find_free_in_bytes(start, end)
+            if index != -1:
+                return index
+        return -1
+
+    def allocate(self) -> int:
+        index, _ = self.allocate_run(1)
+        return index
+
+    def allocate_run(self, count: int, goal: int = -1) -> Tuple[int, int]:
+        # up to count free blocks in a row, starting at goal when it is free
+        with self.lock:
+            if 0 <= goal < self.blocks_number and not self[goal]:
+                start = goal
+            else:
+                start = self.find_free()
+                if start == -1:
+                    return -1, 0
+            length = 1
+            while length < count and start + length < self.blocks_number and \
+                    not self[start + length]:
+                length += 1
+            for i in range(start, start + length):
+                self[i] = 1
+            self.cursor = start + length if start + length < self.blocks_number else 0
+        self.stats.count('blocks_allocated', length)
+        return start, length
+
+    def allocate_extent(self, count: int, goal: int = -1) -> Tuple[int, int]:
+        # up to count free blocks in a row, at goal when it is free or else
+        # anywhere in the image: the run is searched as whole free bytes and
+        # the request is halved until one is found
+        with self.lock:
+            if 0 <= goal < self.blocks_number and not self[goal]:
+                return self.allocate_run(count, goal)
+            size = (count + 7) >> 3
+            pos = -1
+            while size > 0:
+                pos = self.data.find(bytes(size))
+                if pos != -1:
+                    break
+                size >>= 1
+            start = pos << 3
+            if pos == -1 or start >= self.blocks_number:
+                return self.allocate_run(count)
+            end = pos + size
+            while (end - pos) << 3 < count and end < len(self.data) and self.data[end] == 0:
+                end += 1
+            length = min(count, (end - pos) << 3, self.blocks_number - start)
+            # whole bytes are known to be free, the rest goes bit by bit
+            full = length >> 3
+            self.data[pos:pos + full] = b'\xff' * full
+            self.dirty.update(range(pos, pos + full))
+            first, last = start, start + (full << 3)
+            while first < last:
+                group = first // BITMAP_GROUP_BLOCKS
+                n = min(last, (group + 1) * BITMAP_GROUP_BLOCKS) - first
+                self.group_free[group] -= n
+                self.free -= n
+                first += n
+            for i in range(last, start + length):
+                self[i] = 1
+        self.stats.count('blocks_allocated', length)
+        self.stats.count('extents_allocated')
+        return start, length
+
+    def take_dirty(self) -> list[Tuple[int, bytes]]:
+        with self.lock:
+            runs = [(start, bytes(self.data[start:start + count]))
+                for start, count in coalesce(self.dirty)]
+            self.dirty = set()
+        return runs
+
+# default memory budget of the block cache in bytes
+BLOCK_CACHE_SIZE = 1 << 20
+
+class BlockCache:
+    def __init__(self, image: "Image", data_offset: int, block_size: int, \
+            size: int = BLOCK_CACHE_SIZE) -> None:
+        self.image = image
+        self.data_offset = data_offset
+        self.block_size = block_size
+        self.entries: OrderedDict[int, bytes] = OrderedDict()
+        # blocks changed in memory but not yet written to the image
+        self.dirty: set[int] = set()
+        # metadata blocks, kept in memory until the journal takes them
+        self.pinned: set[int] = set()
+        # readers share the cache from worker threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # blocks of multi-block runs transferred around the cache
+        self.bypassed = 0
+        self.resize(size)
+
+    def resize(self, size: int) -> None:
+        with self.lock:
+            self.size = size
+            self.capacity = max(1, size // self.block_size)
+            self.evict()
+
+    def evict(self, keep: int = -1) -> None:
+        # pinned blocks and keep, the block being added, stay even over capacity
+        while len(self.entries) > self.capacity:
+            index = next((i for i in self.entries if i not in self.pinned and i != keep), None)
+            if index is None:
+                return
+            data = self.entries.pop(index)
+            if index in self.dirty:
+                self.dirty.discard(index)
+                self.image.write(self.data_offset + self.block_size*index, data)
+            self.evictions += 1
+
+    def read(self, index: int) -> bytes:
+        with self.lock:
+            data = self.entries.get(index)
+            if data is not None:
+                self.hits += 1
+                self.entries.move_to_end(index)
+                return data
+            self.misses += 1
+        # the image is read without the lock, so misses of other readers overlap
+        data = self.image.read(self.data_offset + self.block_size*index, self.block_size)
+        with self.lock:
+            cached = self.entries.get(index)
+            if cached is not None:
+                return cached
+            self.entries[index] = data
+            self.evict(index)
+        return data
+
+    def write(self, index: int, offset: int, data: bytes, pin: bool = False) -> None:
+        data = data[0:self.block_size - offset]
+        partial = len(data) != self.block_size
+        # a partial write is merged into the block, a missing one is read first
+        # without the lock and other blocks may push it out again by the merge
+        base = self.read(index) if partial and index not in self.entries else None
+        with self.lock:
+            if not partial:
+                block = bytes(data)
+            else:
+                cached = self.entries.get(index)
+                if cached is not None:
+                    if base is None:
+                        self.hits += 1
+                    base = cached
+                elif base is None:
+                    # pushed out between the check and the lock
+                    base = self.image.read(self.data_offset + self.block_size*index, self.block_size)
+                block = base[0:offset] + data + base[offset + len(data):]
+            self.entries[index] = block
+            self.entries.move_to_end(index)
+            self.dirty.add(index)
+            if pin:
+                self.pinned.add(index)
+            self.evict(index)
+
+    def read_run(self, index: int, count: int, buf: memoryview) -> None:
+        # count blocks starting at index, read from the image with one call
+        if count == 1:
+            buf[0:self.block_size] = self.read(index)
+            return
+        self.image.readinto(self.data_offset + self.block_size*index, buf)
+        with self.lock:
+            for i in range(count):
+                cached = self.entries.get(index + i)
+                if cached is not None:
+                    buf[self.block_size*i:self.block_size*(i + 1)] = cached
+            self.bypassed += count
+
+    def write_run(self, index: int, count: int, data: bytes) -> None:
+        # count whole blocks starting at index, written to the image with one call
+        if count == 1:
+            self.write(index, 0, data)
+            return
+        self.image.write(self.data_offset + self.block_size*index, data)
+        with self.lock:
+            for i in range(count):
+                if index + i in self.entries:
+                    self.entries[index + i] = bytes(data[self.block_size*i:self.block_size*(i + 1)])
+                    self.dirty.discard(index + i)
+            self.bypassed += count
+
+    def flush(self) -> None:
+        with self.lock:
+            for start, count in coalesce(self.dirty):
+                data = b"".join(self.entries[i] for i in range(start, start + count))
+                self.image.write(self.data_offset + self.block_size*start, data)
+            self.dirty = set()
+
+    def take_pinned(self) -> list[Tuple[int, bytes]]:
+        # dirty pinned blocks as (first block, data) runs, unpinned and clean afterwards
+        with self.lock:
+            blocks = [i for i in self.pinned if i in self.dirty]
+            self.dirty.difference_update(blocks)
+            self.pinned = set()
+            return [(start, b"".join(self.entries[i] for i in range(start, start + count)))
+                for start, count in coalesce(blocks)]
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'blocks': len(self.entries),
+            'capacity': self.capacity,
+            'dirty': len(self.dirty),
+            'pinned': len(self.pinned),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bypassed': self.bypassed
+        }
+
+class Image:
+    def __init__(self, path: str, stats: Stats, use_mmap: bool = False) -> None:
+        self.path = path
+        self.stats = stats
+        self.fd = os.open(path, os.O_RDWR)
+        if fcntl is not None:
+            # one process at a time, others go through its server
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self.fd)
+                raise
+        stats.count('image_opens')
+        self.map: Optional[mmap.mmap] = None
+        if use_mmap and os.path.getsize(path) > 0:
+            self.map = mmap.mmap(self.fd, 0)
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.stats.count('image_reads')
+        self.stats.count('image_read_bytes', size)
+        if self.map is not None:
+            return self.map[offset:offset + size]
+        return os.pread(self.fd, size, offset)
+
+    def readinto(self, offset: int, buf) -> int:
+        self.stats.count('image_reads')
+        self.stats.count('image_read_bytes', len(buf))
+        if self.map is not None:
+            data = self.map[offset:offset + len(buf)]
+            buf[0:len(data)] = data
+            return len(data)
+        return os.preadv(self.fd, [buf], offset)
+
+    def write(self, offset: int, data: bytes) -> None:
+        self.stats.count('image_writes')
+        self.stats.count('image_write_bytes', len(data))
+        if self.map is not None:
+            self.map[offset:offset + len(data)] = data
+            return
+        os.pwrite(self.fd, data, offset)
+
+    def clear(self, size: int, use_mmap: bool = False) -> None:
+        # size bytes of zeros, holes in the host file where its filesystem has them
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, size)
+        if use_mmap and size > 0:
+            self.map = mmap.mmap(self.fd, 0)
+
+    def flush(self) -> None:
+        self.stats.count('image_fsyncs')
+        if self.map is not None:
+            self.map.flush()
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        if self.fd is None:
+            return
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+        self.fd = None
+
+# write-back limits: flush when this many bytes are dirty or this many seconds passed
+DIRTY_LIMIT = 1 << 18
+FLUSH_INTERVAL = 5.0
+
+class FS:
+    def __init__(self) -> None:
+        self.initialized = 0
+        self.image: Optional[Image] = None
+        self.stats = Stats()
+        self.dirty_limit = DIRTY_LIMIT
+        self.flush_interval = FLUSH_INTERVAL
+        self.dirty_descriptors: set[int] = set()
+        self.last_flush = time.monotonic()
+        # sequence number and journal offset of the next transaction
+        self.journal_seq = 0
+        self.journal_pos = JOURNAL_HEADER_SIZE
+        # operations share the filesystem, flush and (un)mount take it whole
+        self.lock = RWLock()
+        self.inodes = InodeLocks()
+        # descriptor slots
+        self.alloc_lock = threading.Lock()
+        # loading of descriptor groups
+        self.desc_lock = threading.Lock()
+        # geometry of the mounted image, block_size also that of new images
+        self.desc_number = 0
+        self.blocks_number = 0
+        self.block_size = BLOCK_SIZE
+        self.journal_size = JOURNAL_MIN_SIZE
+
+    def encode_descriptors(self, start: int, count: int) -> bytes:
+        # table bytes of a run of slots, written field by field from the columns
+        end = start + count
+        for index in range(start, end):
+            if index in self.file_blocks:
+                self.store_block_map(index)
+        data = bytearray(DESC_SIZE * count)
+        nlinks = self.nlinks[start:end]
+        data[0::DESC_SIZE] = bytes(type if nlink != 0 else ord('-')
+            for type, nlink in zip(self.types[start:end], nlinks))
+        scatter(data, DESC_SIZE, DESC_NLINK_OFFSET, nlinks)
+        scatter(data, DESC_SIZE, DESC_SIZE_OFFSET, self.sizes[start:end])
+        scatter(data, DESC_SIZE, DESC_NBLOCK_OFFSET, self.nblocks[start:end])
+        for k, m in enumerate(self.maps):
+            scatter(data, DESC_SIZE, DESC_MAP_OFFSET + PTR_SIZE*k, m[start:end])
+        return bytes(data)
+
+    def empty_descriptors(self, count: int) -> None:
+        # descriptor table as columns, one array per field, all slots free
+        self.types = bytearray(b'-') * count
+        self.nlinks = array('H', [0]) * count
+        self.sizes = array('Q', [0]) * count
+        self.nblocks = array('I', [0]) * count
+        self.maps = [holes(count) for _ in range(BLOCKS_MAP_SIZE)]
+        groups = (count + (1 << DESC_GROUP_SHIFT) - 1) >> DESC_GROUP_SHIFT
+        self.desc_groups = bytearray(b'\x01') * groups
+        # block lists of files and directories, loaded on first access
+        self.file_blocks: dict[int, array] = dict()
+        self.file_nodes: dict[int, dict[Tuple[int, ...], int]] = dict()
+        self.dirs: dict[int, DirTable] = dict()
+        self.symlinks: dict[int, str] = dict()
+        self.open_counts: dict[int, int] = dict()
+        self.orphans: set[int] = set()
+
+    def load_descriptors(self) -> None:
+        # columns of the image table, each group is read in on first use
+        self.empty_descriptors(self.desc_number)
+        self.desc_groups = bytearray(len(self.desc_groups))
+
+    def load_group(self, group: int) -> None:
+        with self.desc_lock:
+            if self.desc_groups[group]:
+                return
+            start = group << DESC_GROUP_SHIFT
+            end = min(start + (1 << DESC_GROUP_SHIFT), self.desc_number)
+            size = DESC_SIZE * (end - start)
+            data = self.image.read(self.get_descriptor_offset(start), size).ljust(size, b'\x00')
+            self.types[start:end] = data[0::DESC_SIZE]
+            self.nlinks[start:end] = column(data, DESC_SIZE, DESC_NLINK_OFFSET, 'H')
+            self.sizes[start:end] = column(data, DESC_SIZE, DESC_SIZE_OFFSET, 'Q')
+            self.nblocks[start:end] = column(data, DESC_SIZE, DESC_NBLOCK_OFFSET, 'I')
+            for k, m in enumerate(self.maps):
+                m[start:end] = column(data, DESC_SIZE, DESC_MAP_OFFSET + PTR_SIZE*k, 'I')
+            # set last, readers that find it set need no lock
+            self.desc_groups[group] = 1
+            self.stats.count('descriptor_groups_loaded')
+
+    def load_all_descriptors(self) -> None:
+        for group, loaded in enumerate(self.desc_groups):
+            if not loaded:
+                self.load_group(group)
+
+    def descriptor(self, index: int) -> FileDesc:
+        if not self.desc_groups[index >> DESC_GROUP_SHIFT]:
+            self.load_group(index >> DESC_GROUP_SHIFT)
+        return DESC_VIEWS.get(self.types[index], FileDesc)(self, index)
+
+    def new_descriptor(self, index: int, type: str) -> FileDesc:
+        self.types[index] = ord(type)
+        self.nlinks[index] = 1
+        self.sizes[index] = 0
+        self.nblocks[index] = 0
+        for m in self.maps:
+            m[index] = NO_BLOCK
+        if type == 'd':
+            self.nlinks[index] = 2
+        if type in ('r', 'd'):
+            self.file_blocks[index] = array('I')
+            self.file_nodes[index] = dict()
+        log_debug(f"New descriptor {index} type={type}")
+        return self.descriptor(index)
+
+    def clear_descriptor(self, index: int) -> None:
+        self.types[index] = ord('-')
+        self.nlinks[index] = 0
+        self.sizes[index] = 0
+        self.nblocks[index] = 0
+        for m in self.maps:
+            m[index] = NO_BLOCK
+        self.file_blocks.pop(index, None)
+        self.file_nodes.pop(index, None)
+        self.symlinks.pop(index, None)
+        self.dirs.pop(index, None)
+        self.orphans.discard(index)
+        log_debug(f"Del descriptor {index}")
+
+    def mkfs(self, n = 10, path = "fs", use_mmap = False, \
+            cache_size = BLOCK_CACHE_SIZE, size = None, block_size = None) -> None: 
+        # size defaults to the size of an existing image, block_size to the current one
+        self.unmount()
+        if size is None:
+            if not os.path.isfile(path):
+                log_fail(f"Image '{path}' does not exist, its size is needed")
+                return
+            size = os.path.getsize(path)
+        file_size = int(size)
+        block_size = self.block_size if block_size is None else int(block_size)
+        if block_size & (block_size - 1) or not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+            log_fail(f"Block size must be a power of two from {MIN_BLOCK_SIZE} to {MAX_BLOCK_SIZE}")
+            return
+        if not 0 < int(n) < DELETED_DESC:
+            log_fail("Wrong number of descriptors")
+            return
+        journal = journal_size(int(n), file_size // block_size, block_size)
+        # every block takes block_size bytes of data and one bit of bitmap
+        blocks = (file_size - SUPERBLOCK_SIZE - journal - DESC_SIZE*int(n))*8 // (block_size*8 + 1)
+        if blocks < dir_blocks(DIR_MIN_ENTRIES, block_size) or blocks > NO_BLOCK - 1:
+            log_fail(f"Image size {file_size} does not fit {n} descriptors and blocks of {block_size} bytes")
+            return
+        self.stats = Stats()
+        try:
+            if not os.path.exists(path):
+                with open(path, "wb"):
+                    pass
+            image = Image(path, self.stats)
+        except BlockingIOError:
+            log_fail(f"'{path}' is mounted by another process")
+            return
+        except OSError as error:
+            log_fail(f"Could not open '{path}': {error.strerror}")
+            return
+        self.desc_number = int(n)
+        self.blocks_number = blocks
+        self.block_size = block_size
+        self.journal_size = journal
         self.initialized = 1
-        file_size = int(os.path.getsize('fs'))
-        global DESC_NUMBER
-        DESC_NUMBER = int(n)
-        global HARDLINKS_SIZE
-        HARDLINKS_SIZE = DESC_NUMBER * HARDLINK_LEN
-        global BLOCKS_NUMBER
-        BLOCKS_NUMBER = math.floor((file_size - SUPERBLOCK_SIZE - HARDLINKS_SIZE - (DESC_SIZE*DESC_NUMBER))/(BLOCK_SIZE + 1))
         self.superblock = {
-            'desc_num': DESC_NUMBER,
-            'blocks_num': BLOCKS_NUMBER,
-            'blocks_size': BLOCK_SIZE
+            'desc_num': self.desc_number,
+            'blocks_num': self.blocks_number,
+            'blocks_size': self.block_size
         }
-        self.rootdir: FileDir = FileDir()
-        self.blocks: list[Optional[Block]] = [None] * BLOCKS_NUMBER
-        self.bitmap: list[int] = [0]*BLOCKS_NUMBER
-
-        # ім'я файлу - 16, номер дескриптора - 16
-        self.hardlinks: list[list[str]] = list()
-        for i in range(DESC_NUMBER):
-            a = list()
-            a.append(" ")
-            a.append("-")
-            self.hardlinks.append(a)
-        self.hardlinks[0] = ['.', '0']
-        self.hardlinks[1] = ['..', '0']
-
-        # keep track of descriptors and theirs ids
-        self.descriptors: list[Optional[FileDesc]] = [FileDesc('-')] * DESC_NUMBER
-        self.descriptors[0] = self.rootdir
-
-        # superblock meta takes MAX_R*number_of_fields_in_superblock of space
-        superblock_data = ""
-        for item in self.superblock.values():
-            superblock_data += format_data_write_file(item)
-
-        # hardlinks take descriptors_number*(16+16) of space
-        hardlinks_data = ""
-        for item in self.hardlinks:
-            hardlinks_data += self.encode_hardlink(item)
-
-        descriptors_data = ""
-        for desc in self.descriptors:
-            descriptors_data += self.encode_descriptor(desc)
-
-        bitmap = "0"*BLOCKS_NUMBER
-
-        blocks_data = ""
-        for key in range(len(self.blocks)):
-            block = Block()
-            self.blocks[key] = block
-            block.index = key
-            blocks_data += " "*BLOCK_SIZE
-        with open("fs", "w+") as file:
-            file.write(superblock_data + hardlinks_data + descriptors_data + bitmap + blocks_data)
+        # zeros everywhere, on disk only where the host filesystem has no holes:
+        # the journal past its header, the bitmap and data blocks need no writes
+        image.clear(file_size, use_mmap)
+        self.image = image
+        self.image.write(0, SUPERBLOCK_STRUCT.pack(FS_MAGIC, FS_VERSION, 0,
+            self.desc_number, self.blocks_number, self.block_size, self.journal_size))
+        self.image.write(self.get_journal_offset(), empty_journal(JOURNAL_HEADER_SIZE))
+        self.journal_seq = 0
+        self.journal_pos = JOURNAL_HEADER_SIZE
+        # all slots free, the root directory gets the first one at the end
+        empty = DESC_STRUCT.pack(b'-', 0, 0, 0, *[NO_BLOCK] * BLOCKS_MAP_SIZE)
+        chunk = max(1, IO_CHUNK_SIZE // DESC_SIZE)
+        for first in range(0, self.desc_number, chunk):
+            self.image.write(self.get_descriptor_offset(first), empty * min(chunk, self.desc_number - first))
+
+        self.bitmap: Bitmap = Bitmap(bytes(bitmap_size(self.blocks_number)), self.blocks_number, self.stats)
+        self.empty_descriptors(self.desc_number)
+        self.rootdir: FileDir = self.new_descriptor(0, 'd')
+        self.write_descriptor(self.rootdir)
+        self.build_free_descriptors()
+        self.cache = BlockCache(self.image, self.get_block_offset(0), self.block_size, cache_size)
+        # root directory is its own parent
+        if self.dir_init(self.rootdir, self.rootdir) == -1:
+            log_fail("No space left for the root directory")
+        self.sync()
         self.fs_data()
 
-    def set_hardlinks(self) -> None:
-        self.hardlinks: list[list[str]] = list()
-        with open('fs', "r") as file:
-            for i in range(DESC_NUMBER):
-                file.seek(MAX_R * 3 + HARDLINK_LEN*i)
-                a = list()
-                name = file.read(MAX_R).strip()
-                if len(name) == 0:
-                    name = " "
-                a.append(name)
-                file.seek(MAX_R * 3 + HARDLINK_LEN*i + MAX_R)
-                index = file.read(MAX_R).strip()
-                a.append(index)
-                self.hardlinks.append(a)
-
-    def mount(self, fs) -> None:
+    def mount(self, fs, use_mmap = False, cache_size = BLOCK_CACHE_SIZE, \
+            dirty_limit = DIRTY_LIMIT, flush_interval = FLUSH_INTERVAL) -> None:
+        self.unmount()
+        self.dirty_limit = dirty_limit
+        self.flush_interval = flush_interval
+        self.stats = Stats()
+        try:
+            self.image = Image(fs, self.stats, use_mmap)
+        except BlockingIOError:
+            log_fail(f"'{fs}' is mounted by another process, connect to its server instead")
+            return
+        except OSError as error:
+            log_fail(f"Could not open '{fs}': {error.strerror}")
+            return
+        magic, version, _, desc_num, blocks_num, block_size, journal = \
+            SUPERBLOCK_STRUCT.unpack(self.image.read(0, SUPERBLOCK_STRUCT.size))
+        if magic != FS_MAGIC or version in (V2_VERSION, V3_VERSION, V4_VERSION):
+            log_fail(f"'{fs}' is not a v{FS_VERSION} image, run 'convert {fs}' first")
+            self.unmount()
+            return
+        if version != FS_VERSION:
+            log_fail(f"Unsupported image version {version}")
+            self.unmount()
+            return
         self.initialized = 1
+        self.desc_number = desc_num
+        self.blocks_number = blocks_num
+        self.block_size = block_size
+        self.journal_size = journal
+        self.replay_journal()
 
-        with open(fs, "r") as file:
-            n = int(file.read(MAX_R).strip())
-            global DESC_NUMBER
-            DESC_NUMBER = n
-            file.seek(MAX_R)
-            global BLOCKS_NUMBER
-            BLOCKS_NUMBER = int(file.read(MAX_R).strip())
-            blocks_num = BLOCKS_NUMBER
-            file.seek(MAX_R * 2)
-            global BLOCK_SIZE 
-            BLOCK_SIZE = int(file.read(MAX_R).strip())
-            global HARDLINKS_SIZE
-            HARDLINKS_SIZE = DESC_NUMBER * HARDLINK_LEN
-
-            self.superblock = {
-                'desc_num': DESC_NUMBER,
-                'blocks_num': blocks_num,
-                'blocks_size': BLOCK_SIZE
-            }
-            self.descriptors: list[Optional[FileDesc]] = [None] * DESC_NUMBER
-            self.blocks: list[Optional[Block]] = [None] * blocks_num
-            self.bitmap: list[int] = [0]*BLOCKS_NUMBER
-            self.set_hardlinks()
-
-            for i in range(blocks_num):
-                file.seek(self.get_block_offset(i))
-                self.blocks[i] = Block()
-                self.blocks[i].write(file.read(BLOCK_SIZE).encode())
-                self.blocks[i].index = i
-
-            for i in range(DESC_NUMBER):
-                file.seek(self.get_descriptor_offset(i))
-                type = file.read(1).strip()
-                # directory - only one and the first descriptor
-                if type == 'd':
-                    self.descriptors[i] = FileDir()
-                elif type == 'r':
-                    self.descriptors[i] = FileReg()
-                elif type == 's':
-                    self.descriptors[i] = FileSym()
-                else:
-                    self.descriptors[i] = FileDesc('-')
-                self.descriptors[i].type = type
-                file.seek(self.get_descriptor_offset(i) + 1)
-                self.descriptors[i].nlink = int(file.read(MAX_R).strip())
-                file.seek(self.get_descriptor_offset(i) + 1 + MAX_R)
-                self.descriptors[i].size = int(file.read(MAX_R).strip())
-                file.seek(self.get_descriptor_offset(i) + 1+2*MAX_R)
-                self.descriptors[i].nblock = int(file.read(MAX_R).strip())
-                if type == 'r':
-                    for j in range(BLOCKS_MAP_SIZE):
-                        file.seek(self.get_descriptor_offset(i) + 1+3*MAX_R + (MAX_R)*j)
-                        block_num = file.read(MAX_R).strip()
-                        if block_num == "":
-                            break
-                        if j == (BLOCKS_MAP_SIZE - 1):
-                            self.descriptors[i].link = 1
-                        block_num = int(block_num)
-                        block = self.blocks[block_num]
-                        self.descriptors[i].data.append(block)
-                    if self.descriptors[i].link == 1:
-                        block_offset = self.get_block_offset(self.descriptors[i].data[-1].index)
-                        file.seek(block_offset)
-                        for j in range(int(BLOCK_SIZE/MAX_R)):
-                            block_num = file.read(MAX_R).strip()
-                            if block_num == "":
-                                break
-                            block_num = int(block_num)
-                            block = self.blocks[block_num]
-                            self.descriptors[i].data.append(block)
-
-            for key, value in self.hardlinks:
-                if value == '' or value == '-':
-                    continue
-                value = int(value)
-                self.descriptors[0].links[key] = self.descriptors[value]
-            self.rootdir: FileDir = self.descriptors[0]
-
-            for i in range(BLOCKS_NUMBER):
-                file.seek(self.get_bitmap_offset(i))
-                self.bitmap[i] = int(file.read(1))
+        self.superblock = {
+            'desc_num': self.desc_number,
+            'blocks_num': blocks_num,
+            'blocks_size': self.block_size
+        }
+        self.cache = BlockCache(self.image, self.get_block_offset(0), self.block_size, cache_size)
+
+        self.load_descriptors()
+        # root directory is the first descriptor, the rest are found through it
+        self.rootdir: FileDir = self.descriptor(0)
+        self.build_free_descriptors()
+
+        bitmap_data = self.image.read(self.get_bitmap_offset(0), bitmap_size(self.blocks_number))
+        self.bitmap: Bitmap = Bitmap(bitmap_data, self.blocks_number, self.stats)
+
+    def unmount(self) -> None:
+        if self.initialized:
+            self.sync()
+        if self.image is not None:
+            self.image.close()
+            self.image = None
+        self.initialized = 0
 
     def lookup(self, d: FileDir, name: str) -> Tuple[Optional[FileDesc], int]:
-        if name in d.links:
-            return d.links[name], self.descriptors.index(d.links[name])
+        table = self.dirs.get(d.index)
+        if table is not None:
+            index = table.links.get(name)
+        else:
+            index = self.probe(d, name)
+        if index is not None:
+            return self.descriptor(index), index
+        return None, None
+
+    def lookup_loaded(self, d: FileDir, name: str) -> Optional[Tuple[Optional[FileDesc], int]]:
+        # needs no inode lock, a loaded table changes by single dict operations;
+        # None when only the on-disk table has the entries and lookup must be locked
+        table = self.dirs.get(d.index)
+        if table is None:
+            return None
+        index = table.links.get(name)
+        if index is not None:
+            return self.descriptor(index), index
         return None, None
 
     def fs_data(self):
-        with open("fs", "r") as file:
-            print("Descriptors number: ", file.read(MAX_R).strip())
-            file.seek(MAX_R)
-            print("Blocks number: ", file.read(MAX_R).strip())
-            file.seek(MAX_R*2)
-            print("Blocks size: ", file.read(MAX_R).strip())
+        _, _, _, desc_num, blocks_num, block_size, _ = \
+            SUPERBLOCK_STRUCT.unpack(self.image.read(0, SUPERBLOCK_STRUCT.size))
+        print("Descriptors number: ", desc_num)
+        print("Blocks number: ", blocks_num)
+        print("Blocks size: ", block_size)
 
     def reverse_lookup(self, d: FileDir, desc: FileDesc) -> Optional[str]:
-        for name, dest in d.links.items():
-            if dest == desc:
+        for name, index in d.links.items():
+            if index == desc.index:
                 return name
         return None
 
+    def build_free_descriptors(self) -> None:
+        # released slots are used as a stack, then the table is searched on
+        # from free_cursor, so the lowest free slot is handed out first
+        self.free_descriptors: list[int] = list()
+        self.free_cursor = 0
+
     def find_free_descriptor(self) -> int:
-        descriptors_taken = list()
-        for key in range(int(HARDLINKS_SIZE/HARDLINK_LEN)):
-            link = self.hardlinks[key]
-            if link[1] not in descriptors_taken:
-                descriptors_taken.append(link[1].strip())
-        for i in range(DESC_NUMBER):
-            i = str(i)
-            if i not in descriptors_taken:
-                return int(i)
-        return -1
+        with self.alloc_lock:
+            if len(self.free_descriptors) != 0:
+                return self.free_descriptors.pop()
+            while self.free_cursor < self.desc_number:
+                group = self.free_cursor >> DESC_GROUP_SHIFT
+                if not self.desc_groups[group]:
+                    self.load_group(group)
+                end = min((group + 1) << DESC_GROUP_SHIFT, self.desc_number)
+                index = self.types.find(b'-', self.free_cursor, end)
+                if index != -1:
+                    self.free_cursor = index + 1
+                    return index
+                self.free_cursor = end
+            return -1
 
-    def get_hardlink_offset(self, index: int) -> int:
-        return SUPERBLOCK_SIZE + HARDLINK_LEN*index
+    def put_free_descriptor(self, index: int) -> None:
+        with self.alloc_lock:
+            self.free_descriptors.append(index)
+
+    def get_journal_offset(self) -> int:
+        return SUPERBLOCK_SIZE
 
     def get_descriptor_offset(self, index: int) -> int:
-        return SUPERBLOCK_SIZE + HARDLINKS_SIZE + DESC_SIZE*index
+        return SUPERBLOCK_SIZE + self.journal_size + DESC_SIZE*index
 
     def get_bitmap_offset(self, index: int) -> int:
-        return SUPERBLOCK_SIZE + HARDLINKS_SIZE + DESC_SIZE*DESC_NUMBER + index
+        return SUPERBLOCK_SIZE + self.journal_size + DESC_SIZE*self.desc_number + (index >> 3)
 
     def get_block_offset(self, index: int) -> int:
-        return SUPERBLOCK_SIZE + HARDLINKS_SIZE + DESC_SIZE*DESC_NUMBER + BLOCKS_NUMBER + BLOCK_SIZE*index
+        return SUPERBLOCK_SIZE + self.journal_size + DESC_SIZE*self.desc_number + bitmap_size(self.blocks_number) + self.block_size*index
+
+    def write_descriptor(self, desc: FileDesc) -> None:
+        self.dirty_descriptors.add(desc.index)
+
+    def write_meta(self, index: int, offset: int, data: bytes) -> None:
+        # directory and indirect blocks are committed through the journal
+        self.cache.write(index, offset, data, pin=True)
+
+    def dirty_bytes(self) -> int:
+        return len(self.cache.dirty)*self.block_size + len(self.dirty_descriptors)*DESC_SIZE + \
+            len(self.bitmap.dirty)
+
+    def journal_bytes(self) -> int:
+        # payload of the next flush at worst, every item a record of its own
+        return len(self.cache.pinned)*(self.block_size + RECORD_STRUCT.size) + \
+            len(self.dirty_descriptors)*(DESC_SIZE + RECORD_STRUCT.size) + \
+            len(self.bitmap.dirty)*(1 + RECORD_STRUCT.size)
+
+    def maybe_flush(self) -> None:
+        # called with no locks held, flush needs the filesystem to itself
+        if not self.initialized:
+            return
+        # the journal limit holds even when write-back is deferred
+        if self.dirty_bytes() >= self.dirty_limit or \
+                self.journal_bytes() >= self.journal_capacity() // 2 or \
+                time.monotonic() - self.last_flush >= self.flush_interval:
+            with self.lock.exclusive:
+                self.flush()
+
+    def flush(self) -> None:
+        meta = self.cache.take_pinned()
+        # data goes first, so committed metadata never points to unwritten blocks
+        self.cache.flush()
+        # all dirty metadata in image offset order becomes one transaction
+        records = list()
+        for start, count in coalesce(self.dirty_descriptors):
+            data = self.encode_descriptors(start, count)
+            records.append((self.get_descriptor_offset(start), data))
+        self.stats.count('descriptors_written', len(self.dirty_descriptors))
+        self.dirty_descriptors = set()
+        offset = self.get_bitmap_offset(0)
+        for start, data in self.bitmap.take_dirty():
+            records.append((offset + start, data))
+            self.stats.count('bitmap_bytes_written', len(data))
+        for start, data in meta:
+            records.append((self.get_block_offset(start), data))
+            self.stats.count('meta_blocks_written', len(data) // self.block_size)
+        self.stats.count('flushes')
+        if len(records) != 0:
+            self.commit(records)
+        self.last_flush = time.monotonic()
+
+    def journal_capacity(self) -> int:
+        # payload bytes of the largest transaction an empty journal takes
+        return self.journal_size - JOURNAL_HEADER_SIZE - TRANSACTION_STRUCT.size
+
+    def commit(self, records: list[Tuple[int, bytes]]) -> None:
+        # maybe_flush keeps a flush within one transaction, more metadata than
+        # the journal holds is committed in several, each ahead of its in-place writes
+        batches = transactions(records, self.journal_capacity())
+        if len(batches) > 1:
+            self.stats.count('journal_split_flushes')
+        for batch in batches:
+            payload = b"".join(RECORD_STRUCT.pack(offset, len(data)) + data
+                for offset, data in batch)
+            transaction = TRANSACTION_STRUCT.pack(TRANSACTION_MAGIC, self.journal_seq,
+                len(payload), zlib.crc32(payload)) + payload
+            if self.journal_pos + len(transaction) > self.journal_size:
+                self.checkpoint()
+            self.stats.count('journal_transactions')
+            self.stats.count('journal_bytes', len(transaction))
+            self.image.write(self.get_journal_offset() + self.journal_pos, transaction)
+            # the only fsync of the transaction, committing every operation in it
+            self.image.flush()
+            for offset, data in batch:
+                self.image.write(offset, data)
+            self.journal_pos += len(transaction)
+            self.journal_seq += 1
+
+    def checkpoint(self) -> None:
+        # make in-place metadata durable, then drop the journalled transactions
+        self.image.flush()
+        if self.journal_pos == JOURNAL_HEADER_SIZE:
+            return
+        self.stats.count('journal_checkpoints')
+        self.image.write(self.get_journal_offset(),
+            JOURNAL_HEADER_STRUCT.pack(JOURNAL_MAGIC, self.journal_seq))
+        self.image.flush()
+        self.journal_pos = JOURNAL_HEADER_SIZE
+
+    def replay_journal(self) -> None:
+        seq, pos, replayed = replay(self.image, self.get_journal_offset(), self.journal_size)
+        self.journal_seq = seq
+        self.journal_pos = pos
+        if replayed != 0:
+            log_info(f"Replayed {replayed} journal transactions")
+            self.checkpoint()
+        else:
+            self.journal_pos = JOURNAL_HEADER_SIZE
+
+    def sync(self) -> None:
+        self.flush()
+        self.checkpoint()
+
+    def reset_stats(self) -> None:
+        self.stats = Stats()
+        if self.initialized:
+            self.image.stats = self.stats
+            self.bitmap.stats = self.stats
 
     def create(self, d: FileDir, name: str) -> int:
         index = self.find_free_descriptor()
         if index == -1:
             return -1
-        desc: FileDir = FileReg()
-        d.links[name] = desc
-        ind = self.get_free_hardlink()
-        if ind == -1:
+        if self.add_entry(d, name, index) == -1:
+            self.put_free_descriptor(index)
             return -1
-        self.hardlinks[ind][0] = format_data_write_file(name)
-        self.hardlinks[ind][1] = format_data_write_file(index)
-        h_offset = self.get_hardlink_offset(ind)
-        hl_encoded = self.encode_hardlink(self.hardlinks[ind])
-        self.descriptors[index] = desc
-        desc_encoded = self.encode_descriptor(desc)
-        offset = self.get_descriptor_offset(index)
-        with open("fs", "r+") as file:
-            file.seek(h_offset)
-            file.write(hl_encoded)
-        with open("fs", "r+") as file:
-            file.seek(offset, 0)
-            file.write(desc_encoded)
+        desc: FileReg = self.new_descriptor(index, 'r')
+        self.write_descriptor(desc)
         return 1
 
-    def update_links(self, d: FileDir):
-        prev_links_names = list()
-        prev_links_desc_nums = list()
-        with open("fs", "r+") as file:
-            for i in range(DESC_NUMBER):
-                links_offset = self.get_hardlink_offset(i)
-                file.seek(links_offset)
-                file.write(format_data_write_file(" "))
-                file.write(format_data_write_file("-"))
-                if i < len(d.links):
-                    file.seek(links_offset)
-                    name = format_data_write_file(list(d.links.keys())[i])
-                    desc_num = self.descriptors.index(list(d.links.values())[i])
-                    file.write(name)
-                    file.write(format_data_write_file(desc_num))
-            self.set_hardlinks()         
-
-    def link(self, d: FileDir, name: str, dest: FileDesc) -> None:
-        d.links[name] = dest
+    def mkdir(self, d: FileDir, name: str) -> int:
+        index = self.find_free_descriptor()
+        if index == -1:
+            return -1
+        desc: FileDir = self.new_descriptor(index, 'd')
+        if self.dir_init(desc, d) == -1 or self.add_entry(d, name, index) == -1:
+            self.release(desc)
+            return -1
+        # '..' of the new directory
+        d.nlink += 1
+        self.write_descriptor(d)
+        self.write_descriptor(desc)
+        return 1
+
+    def link(self, d: FileDir, name: str, dest: FileDesc) -> int:
+        if self.add_entry(d, name, dest.index) == -1:
+            return -1
         dest.nlink += 1
-        self.update_links(d)
-        self.update_file_data(dest)
+        self.write_descriptor(dest)
+        return 1
 
     def unlink(self, d: FileDir, name: str, opened: bool) -> None:
-        dest = d.links[name]
-        if opened == 0:
-            dest.nlink -= 1
-            del d.links[name]
-            hardlink = list([str(name), str(self.descriptors.index(dest))])
-            if hardlink in self.hardlinks: 
-                self.hardlinks[self.hardlinks.index(hardlink)] = [' ', '-']
-            self.update_links(d)
-            if dest.nlink == 0:
-                self.free_blocks(dest, 0)
-        else:
+        dest = self.descriptor(d.links[name])
+        dest.nlink -= 1
+        self.remove_entry(d, name)
+        if dest.nlink == 0 and not opened:
+            self.release(dest)
+            return
+        # an open file keeps its descriptor and blocks until the last close
+        if dest.nlink == 0:
             dest.to_delete = 1
+        self.write_descriptor(dest)
+
+    def rmdir(self, d: FileDir, name: str) -> None:
+        desc = self.descriptor(d.links[name])
+        self.remove_entry(d, name)
+        d.nlink -= 1
+        self.write_descriptor(d)
+        self.release(desc)
+
+    def release(self, desc: FileDesc) -> None:
+        if isinstance(desc, (FileReg, FileDir)):
+            self.free_blocks(desc, 0)
+        self.clear_descriptor(desc.index)
+        self.write_descriptor(desc)
+        self.put_free_descriptor(desc.index)
+
+    def dir_init(self, d: FileDir, parent: FileDir) -> int:
+        # empty table with '.' and '..' in the blocks of a new directory
+        count = dir_blocks(DIR_MIN_ENTRIES, self.block_size)
+        if self.extend_file(d, count) != count:
+            return -1
+        table = DirTable(count * dirents_per_block(self.block_size))
+        table.insert(NAME_DOT, d.index)
+        table.insert(NAME_DOT_DOT, parent.index)
+        self.dirs[d.index] = table
+        self.write_table(d, table)
+        return 1
 
-    def get_free_hardlink(self) -> int:
-        for i in range(len(self.hardlinks)):
-            if self.hardlinks[i][1] == "-":
-                return i
-        return -1
+    def dir_table(self, d: FileDir) -> DirTable:
+        table = self.dirs.get(d.index)
+        if table is not None:
+            return table
+        per_block = dirents_per_block(self.block_size)
+        data = bytearray(d.size)
+        self.read_into(d, 0, data)
+        table = DirTable(d.size // self.block_size * per_block)
+        for slot in range(table.capacity):
+            block, offset = dirent_offset(slot, self.block_size)
+            name, index = DIRENT_STRUCT.unpack_from(data, block*self.block_size + offset)
+            if index == NO_DESC:
+                continue
+            table.used += 1
+            if index == DELETED_DESC:
+                table.states[slot] = 2
+                continue
+            name = name.rstrip(b'\x00').decode()
+            table.states[slot] = 1
+            table.links[name] = index
+            table.slots[name] = slot
+        self.dirs[d.index] = table
+        self.stats.count('dir_tables_loaded')
+        return table
+
+    def probe(self, d: FileDir, name: str) -> Optional[int]:
+        # lookup in the on-disk table of a directory that is not loaded
+        capacity = d.size // self.block_size * dirents_per_block(self.block_size)
+        if capacity == 0:
+            return None
+        key = name.encode()
+        slot = zlib.crc32(key) % capacity
+        blocks = d.data
+        for _ in range(capacity):
+            block, offset = dirent_offset(slot, self.block_size)
+            entry, index = DIRENT_STRUCT.unpack_from(self.cache.read(blocks[block]), offset)
+            if index == NO_DESC:
+                break
+            if index != DELETED_DESC and entry.rstrip(b'\x00') == key:
+                return index
+            slot = (slot + 1) % capacity
+        return None
+
+    def write_dirent(self, d: FileDir, slot: int, name: bytes, index: int) -> None:
+        block, offset = dirent_offset(slot, self.block_size)
+        self.write_meta(d.data[block], offset, DIRENT_STRUCT.pack(name, index))
+
+    def write_table(self, d: FileDir, table: DirTable) -> None:
+        per_block = dirents_per_block(self.block_size)
+        empty = EMPTY_DIRENT * per_block + bytes(self.block_size - per_block*DIRENT_LEN)
+        data = bytearray(empty * (table.capacity // per_block))
+        for name, slot in table.slots.items():
+            block, offset = dirent_offset(slot, self.block_size)
+            DIRENT_STRUCT.pack_into(data, block*self.block_size + offset, name.encode(), table.links[name])
+        for i, block in enumerate(d.data):
+            self.write_meta(block, 0, data[i*self.block_size:(i + 1)*self.block_size])
+        d.size = table.capacity // per_block * self.block_size
+        self.write_descriptor(d)
+
+    def rehash(self, d: FileDir, table: DirTable) -> int:
+        # rebuild without deleted entries, growing when live ones need it
+        count = max(len(d.data), dir_blocks(len(table.links) + 1, self.block_size))
+        need = count - len(d.data)
+        if need > 0 and self.extend_file(d, need) != need:
+            self.free_blocks(d, d.size)
+            return -1
+        new = DirTable(count * dirents_per_block(self.block_size))
+        for name, index in table.links.items():
+            new.insert(name, index)
+        self.dirs[d.index] = new
+        self.write_table(d, new)
+        self.stats.count('dir_rehashes')
+        return 1
+
+    def add_entry(self, d: FileDir, name: str, index: int) -> int:
+        table = self.dir_table(d)
+        if table.full():
+            if self.rehash(d, table) == -1 and len(table.links) == table.capacity:
+                return -1
+            table = self.dirs[d.index]
+        slot = table.insert(name, index)
+        self.write_dirent(d, slot, name.encode(), index)
+        return 1
+
+    def remove_entry(self, d: FileDir, name: str) -> None:
+        slot = self.dir_table(d).remove(name)
+        self.write_dirent(d, slot, b'', DELETED_DESC)
 
     def ls(self, d: FileDir, cwd: FileDir) -> None:
-        for name, dest in d.links.items():
-            print(f"\t{name: <{NAME_WIDTH}} => type={dest.type} desc={self.descriptors.index(dest)}", end = '')
+        for name, index in sorted(d.links.items()):
+            print(f"\t{name: <{NAME_WIDTH}} => type={self.descriptor(index).type} desc={index}", end = '')
             print()
     
+    def runs(self, d: FileReg, first: int, last: int) -> list[Tuple[int, int, int]]:
+        # physically contiguous pieces of blocks first..last-1 as
+        # (first file block, first image block, count), holes as NO_BLOCK pieces
+        runs = list()
+        data = d.data
+        mapped = len(data)
+        for i in range(first, last):
+            index = data[i] if i < mapped else NO_BLOCK
+            if runs and (runs[-1][1] + runs[-1][2] == index or runs[-1][1] == index == NO_BLOCK):
+                runs[-1] = (runs[-1][0], runs[-1][1], runs[-1][2] + 1)
+            else:
+                runs.append((i, index, 1))
+        return runs
+
+    def is_hole(self, d: FileReg, i: int) -> bool:
+        return i >= len(d.data) or d.data[i] == NO_BLOCK
+
+    def read_into(self, d: FileReg, offset: int, buf) -> int:
+        # raw file bytes from offset into buf, returns number of bytes read
+        size = min(len(buf), d.size - offset)
+        if size <= 0:
+            return 0
+        block_index_start = offset // self.block_size
+        block_index_end = math.ceil((offset + size)/self.block_size)
+        start = offset % self.block_size
+        view = memoryview(buf)
+        # read straight into buf when it is block aligned
+        target = view[0:size]
+        if start != 0 or size != self.block_size*(block_index_end - block_index_start):
+            target = memoryview(bytearray(self.block_size*(block_index_end - block_index_start)))
+        for i, index, count in self.runs(d, block_index_start, block_index_end):
+            pos = self.block_size*(i - block_index_start)
+            if index == NO_BLOCK:
+                # holes read as zeros without touching the image
+                target[pos:pos + self.block_size*count] = bytes(self.block_size*count)
+                self.stats.count('hole_blocks_read', count)
+                continue
+            self.cache.read_run(index, count, target[pos:pos + self.block_size*count])
+        if target.obj is not buf:
+            view[0:size] = target[start:start + size]
+        return size
+
     def read(self, size: int, d: FileReg, offset: int) -> str:
-        data_len = d.nblock
         size = int(size)
-        if data_len == 0:
+        if d.size == 0:
             return "File empty"    
 
-        block_index_start = int(abs(offset/BLOCK_SIZE))
-        if block_index_start == BLOCKS_MAP_SIZE - 1:
-                block_index_start += 1
-        if data_len <= block_index_start or offset >= d.size:
+        if offset >= d.size:
             return "Error: Wrong offset!"
-        if d.size < size:
-            size = d.size
-        block_start_offset = offset%BLOCK_SIZE
-        block_start = d.data[block_index_start]
-        reads = list()
-        first_read = self.get_block_characters(d, offset)
-        if size < first_read:
-            first_read = size
-        reads.append(first_read)
-        if size > first_read:
-            other_reads_num = math.ceil((size - first_read)/BLOCK_SIZE)
-            last_read = (size - first_read)%BLOCK_SIZE
-            for i in range(other_reads_num):
-                reads.append(BLOCK_SIZE)
-            if last_read == 0:
-                last_read = BLOCK_SIZE
-            reads[len(reads) - 1] = last_read
+        buf = bytearray(min(size, d.size - offset))
+        size = self.read_into(d, offset, buf)
+        # padding is stripped block by block
         result = ""
-        for read in reads:
-            seek_num = self.get_block_offset(d.data[block_index_start].index) + block_start_offset
-            with open('fs', "r") as file:
-                file.seek(seek_num)
-                result += file.read(read).strip()
-            block_index_start = block_index_start + 1
-            if block_index_start == BLOCKS_MAP_SIZE - 1:
-                block_index_start += 1
-            if block_index_start >= d.nblock:
-                break 
-            block_start_offset = 0  
+        pos = 0
+        while pos < size:
+            end = pos + self.block_size - (offset + pos) % self.block_size
+            result += decode_data(buf[pos:end])
+            pos = end
         return result 
 
     def get_free_block(self) -> int:
-        for key in range(len(self.bitmap)):
-            if self.bitmap[key] == 0:
-                return key
-        return -1
-
-    def get_block_characters(self, d: FileReg, offset: int) -> int:
-        block_start_offset = offset%BLOCK_SIZE
-        return BLOCK_SIZE - block_start_offset
-
-    def update_file_data(self, d: FileReg) -> None: #update file info on block's data change
-        #get descriptor index
-        index = self.descriptors.index(d)
-        desc_offset = self.get_descriptor_offset(index)
-        #get curr block number map
-        curr_block_number_map = list()
-        for block in d.data:
-            curr_block_number_map.append(block.index)
-        prev_block_map = list()
-        if d.link is not None:
-            # get block for other block numbers to write into
-            index = None
-            index_list = curr_block_number_map
-            if len(curr_block_number_map) < BLOCKS_MAP_SIZE:
-                index = d.temp_last_bl_link[BLOCKS_MAP_SIZE - 1]
-                prev_block_map = list() + d.temp_last_bl_link
+        return self.bitmap.allocate()
+
+    def block_list(self, index: int) -> array:
+        data = self.file_blocks.get(index)
+        if data is None:
+            data = self.load_block_map(index)
+        return data
+
+    def block_nodes(self, index: int) -> dict[Tuple[int, ...], int]:
+        self.block_list(index)
+        return self.file_nodes[index]
+
+    def load_block_map(self, index: int) -> array:
+        count = math.ceil(self.sizes[index] / self.block_size)
+        data = array('I')
+        nodes = dict()
+        # holes after the last mapped block are left out of the list
+        pending = 0
+        for m in self.maps[0:DIRECT_BLOCKS]:
+            if len(data) + pending == count:
+                break
+            pending = self.load_pointer(data, pending, m[index])
+        for level in range(1, INDIRECT_LEVELS + 1):
+            if len(data) + pending == count:
+                break
+            top = self.maps[DIRECT_BLOCKS + level - 1][index]
+            if top == NO_BLOCK:
+                pending += min(pointers_per_block(self.block_size) ** level, count - len(data) - pending)
+                continue
+            pending = self.load_node(data, nodes, pending, (level,), top, level, count)
+        self.file_blocks[index] = data
+        self.file_nodes[index] = nodes
+        self.stats.count('block_maps_loaded')
+        return data
+
+    def load_pointer(self, data: array, pending: int, pointer: int) -> int:
+        # adds a data block pointer, returns the holes not yet added
+        if pointer == NO_BLOCK:
+            return pending + 1
+        if pending:
+            data.extend(holes(pending))
+        data.append(pointer)
+        return 0
+
+    def load_node(self, data: array, nodes: dict[Tuple[int, ...], int], pending: int, \
+            key: Tuple[int, ...], index: int, depth: int, count: int) -> int:
+        nodes[key] = index
+        span = pointers_per_block(self.block_size) ** (depth - 1)
+        for i, pointer in enumerate(unpack_pointers(self.cache.read(index))):
+            left = count - len(data) - pending
+            if left == 0:
+                break
+            if depth == 1:
+                pending = self.load_pointer(data, pending, pointer)
+            elif pointer == NO_BLOCK:
+                pending += min(span, left)
             else:
-                index = index_list[BLOCKS_MAP_SIZE - 1]
-            seek_num = self.get_block_offset(index)
-            with open('fs', "r+") as file:
-                entries_fit = math.floor(BLOCK_SIZE/MAX_R)
-                file.seek(seek_num)
-                #rewrite all entries
-                for index in range(entries_fit):
-                    i = BLOCKS_MAP_SIZE + index
-                    offset =  seek_num + MAX_R*(index)
-                    file.seek(offset)
-                    file.write(format_data_write_file(" "))
-                    if len(index_list) - 1 < i:
-                        if index == 0:
-                            d.link = None
-                            if len(index_list) == BLOCKS_MAP_SIZE:
-                                index_list.pop()
-                                d.data.pop()
-                            d.nblock -= 1
-                        continue
-                    num = index_list[i]
-                    file.seek(offset)
-                    file.write(format_data_write_file(num))
-        block_number_map = curr_block_number_map[0:BLOCKS_MAP_SIZE]        
-        # update nlink
-        nlink_offset = desc_offset + 1
-        nlink_data = format_data_write_file(d.nlink)
-        #update size
-        size_offset = nlink_offset + MAX_R
-        d_size = len(curr_block_number_map)
-        if d.link is not None:
-            d_size -= 1
-        d.size = d_size * BLOCK_SIZE
-        size_data = format_data_write_file(d.size)
-        # update nblock
-        nblock_offset = size_offset + MAX_R
-        d.nblock = len(curr_block_number_map)
-        nblock_data = format_data_write_file(d.nblock)
-        #write curr block number map and get prev block number map
-        with open('fs', "r+") as file:
-            if d.nlink == 0:
-                file.seek(desc_offset)
-                file.write('-')
-            file.seek(nlink_offset)
-            file.write(nlink_data)
-            file.seek(size_offset)
-            file.write(size_data)
-            file.seek(nblock_offset)
-            file.write(nblock_data)
-            for i in range(BLOCKS_MAP_SIZE):
-                file.seek(nblock_offset + MAX_R*i + MAX_R)
-                curr_block_index = file.read(MAX_R).strip()
-                file.seek(nblock_offset + MAX_R*i + MAX_R)
-                if curr_block_index != "":
-                    prev_block_map.append(int(curr_block_index))
-                if i <= len(block_number_map) - 1:
-                    file.write(format_data_write_file(block_number_map[i]))
-                else:
-                    file.write(format_data_write_file(" "))
-        # update bitmap
-            for i in range(BLOCKS_NUMBER):
-                bitmap_offset = self.get_bitmap_offset(i)
-                file.seek(bitmap_offset)
-                if i in curr_block_number_map:
-                    file.write("1")
-                    self.bitmap[i] = 1
-                file.seek(bitmap_offset)
-                if i in prev_block_map and i not in curr_block_number_map:
-                    file.write("0")
+                pending = self.load_node(data, nodes, pending, key + (i,), pointer, depth - 1, count)
+        return pending
+
+    def store_block_map(self, index: int) -> None:
+        # direct pointers and indirect roots of a loaded block list back to the columns
+        data = self.file_blocks[index]
+        nodes = self.file_nodes[index]
+        for k in range(DIRECT_BLOCKS):
+            self.maps[k][index] = data[k] if k < len(data) else NO_BLOCK
+        for level in range(1, INDIRECT_LEVELS + 1):
+            self.maps[DIRECT_BLOCKS + level - 1][index] = nodes.get((level,), NO_BLOCK)
+
+    def set_pointer(self, node: int, offset: int, value: int) -> None:
+        self.write_meta(node, offset*PTR_SIZE, struct.pack('<I', value))
+
+    def map_block(self, d: FileReg, pos: int, index: int) -> bool:
+        # attach block index as data block pos of the file, pos is a hole
+        level, offsets = block_path(pos, self.block_size)
+        if level == -1:
+            log_info('Maximum file size reached!')
+            return False
+        # indirect blocks missing on the path, allocated top-down
+        missing = [(level,) + tuple(offsets[0:i]) for i in range(level)]
+        missing = [key for key in missing if key not in d.nodes]
+        # other files allocate at the same time, the blocks are taken before any is linked
+        nodes = list()
+        for key in missing:
+            node = self.get_free_block()
+            if node == -1:
+                for i in nodes:
                     self.bitmap[i] = 0
+                log_info("No space left!")
+                return False
+            nodes.append(node)
+        for key, node in zip(missing, nodes):
+            self.write_meta(node, 0, b'\xff' * self.block_size)
+            d.nodes[key] = node
+            if len(key) > 1:
+                self.set_pointer(d.nodes[key[:-1]], key[-1], node)
+        if level > 0:
+            self.set_pointer(d.nodes[(level,) + tuple(offsets[:-1])], offsets[-1], index)
+        d.nblock += 1 + len(missing)
+        data = d.data
+        if pos < len(data):
+            data[pos] = index
+            return True
+        if pos > len(data):
+            data.extend(holes(pos - len(data)))
+        data.append(index)
+        return True
+
+    def cut_blocks(self, d: FileReg, count: int) -> list[int]:
+        # detach data blocks from count on and the indirect blocks with nothing
+        # left under them, returns blocks to free
+        data = d.data
+        if count >= len(data):
+            return []
+        freed = mapped_blocks(data[count:])
+        del data[count:]
+        for key in [key for key in d.nodes if node_start(key, self.block_size) >= count]:
+            freed.append(d.nodes.pop(key))
+        # pointers past the cut in the indirect blocks that stay
+        level, offsets = block_path(count, self.block_size)
+        per_block = pointers_per_block(self.block_size)
+        for depth in range(1, level + 1):
+            node = d.nodes.get((level,) + tuple(offsets[0:depth - 1]))
+            if node is None:
+                break
+            first = offsets[depth - 1] + (1 if any(offsets[depth:]) else 0)
+            if first < per_block:
+                self.write_meta(node, first*PTR_SIZE, b'\xff' * ((per_block - first)*PTR_SIZE))
+        return freed
+
+    def update_file_data(self, d: FileReg, freed: list[int] = ()) -> None: #update file info on block's data change
+        d.nblock -= len(freed)
+        self.write_descriptor(d)
+        self.release_blocks(freed)
+
+    def release_blocks(self, blocks: list[int]) -> None:
+        # blocks are marked in bitmap on allocation, release the freed ones
+        for i in blocks:
+            self.bitmap[i] = 0
+        self.stats.count('blocks_freed', len(blocks))
 
     def free_blocks(self, desc: FileReg, size: int) -> None:
-        blocks_num = size/BLOCK_SIZE
-        block_num_curr = desc.nblock
-        to_free_blocks_num = block_num_curr - blocks_num
-        temp_last_bl_link = list(map(lambda x: x.index, desc.data.copy()))
-        for i in reversed(range(block_num_curr)):
-            if to_free_blocks_num != 0:
-                if i == BLOCKS_MAP_SIZE - 1:
-                    desc.temp_last_bl_link = temp_last_bl_link
-                del desc.data[i]
-                to_free_blocks_num -= 1
-        self.update_file_data(desc)
-
-    def write_to_new_block(self, d: FileReg) -> bool:
-        index = self.get_free_block()
-        if index == -1:
-            log_info("No space left!")
-            return False
-        data_len = len(d.data)
-        if data_len == BLOCKS_MAP_SIZE + (BLOCK_SIZE/MAX_R):
+        # a hole at the end needs no entry
+        blocks_num = mapped_length(desc.data, math.ceil(size/self.block_size))
+        freed = self.cut_blocks(desc, blocks_num)
+        # bytes past the end read as zeros once the file grows again
+        tail = size % self.block_size
+        if tail and size < desc.size and not self.is_hole(desc, size // self.block_size):
+            self.cache.write(desc.data[size // self.block_size], tail, bytes(self.block_size - tail))
+        desc.size = min(desc.size, size)
+        self.update_file_data(desc, freed)
+
+    def resize(self, d: FileReg, size: int) -> int:
+        # growing only moves the end, the new range is a hole
+        if size <= d.size:
+            self.free_blocks(d, size)
+            return 1
+        if size > max_file_blocks(self.block_size) * self.block_size:
             log_info('Maximum file size reached!')
-            return
-        if data_len + 1 == BLOCKS_MAP_SIZE:
-            d.link = index
-            self.bitmap[index] = 1
-            d.data.append(self.blocks[index])
-            index = self.get_free_block()
-            if index == -1:
+            return -1
+        d.size = size
+        self.write_descriptor(d)
+        return 1
+
+    def allocate_range(self, d: FileReg, first: int, last: int, contiguous: bool = False) -> int:
+        # fill holes among blocks first..last-1 in runs placed right after the
+        # block before them if possible, contiguous looks for the longest free
+        # runs otherwise, returns the first block left a hole
+        data = d.data
+        if last <= len(data) and NO_BLOCK not in data[first:last]:
+            return last
+        pos = first
+        while pos < last:
+            if not self.is_hole(d, pos):
+                pos += 1
+                continue
+            end = pos + 1
+            while end < last and self.is_hole(d, end):
+                if end >= len(data):
+                    end = last
+                    break
+                end += 1
+            goal = data[pos - 1] + 1 if 0 < pos <= len(data) and data[pos - 1] != NO_BLOCK else -1
+            if contiguous:
+                start, length = self.bitmap.allocate_extent(end - pos, goal)
+            else:
+                start, length = self.bitmap.allocate_run(end - pos, goal)
+            if length == 0:
                 log_info("No space left!")
-                return False
-        d.data.append(self.blocks[index])
-        self.update_file_data(d)
-        return True
-        
-    def write(self, text: str, d: FileReg, offset: int) -> bool:
-        text_len = len(text)
-        data_len = d.nblock
-        block_index_start = int(abs(offset/BLOCK_SIZE))
-        block_start_offset = offset%BLOCK_SIZE
-        if block_index_start >= BLOCKS_MAP_SIZE - 1:
-            block_index_start += 1
-        if data_len <= block_index_start:
-            res = self.write_to_new_block(d)
-            if not res:
-                return False
-        block_start = d.data[block_index_start]
-        seek_num = self.get_block_offset(block_start.index) + block_start_offset
-        with open('fs', "r+") as file:
-            file.seek(seek_num, 0)
-            file.write(text)
-        return True
-                    
+                break
+            mapped = 0
+            while mapped < length and self.map_block(d, pos + mapped, start + mapped):
+                mapped += 1
+            for i in range(start + mapped, start + length):
+                self.bitmap[i] = 0
+            pos += mapped
+            if mapped < length:
+                break
+        if pos > first:
+            self.update_file_data(d)
+        return pos
+
+    def preallocate(self, d: FileReg, size: int) -> int:
+        # like fallocate, back the holes below size with zeroed blocks taken
+        # in as few runs as free space allows, the file grows to size
+        last = math.ceil(size/self.block_size)
+        if last > max_file_blocks(self.block_size):
+            log_info('Maximum file size reached!')
+            return -1
+        gaps = [(i, count) for i, index, count in self.runs(d, 0, last) if index == NO_BLOCK]
+        mapped = self.allocate_range(d, 0, last, contiguous=True)
+        chunk = max(1, IO_CHUNK_SIZE // self.block_size)
+        zeros = bytes(chunk*self.block_size)
+        for first, length in gaps:
+            for i, index, count in self.runs(d, first, min(first + length, mapped)):
+                for k in range(0, count, chunk):
+                    n = min(chunk, count - k)
+                    self.cache.write_run(index + k, n, zeros[0:n*self.block_size])
+        end = min(size, mapped*self.block_size)
+        if end > d.size:
+            d.size = end
+            self.write_descriptor(d)
+        return 1 if mapped == last else -1
+
+    def fragments(self, d: FileReg) -> int:
+        # physically contiguous pieces of the file, holes do not count
+        count = 0
+        prev = NO_BLOCK
+        for index in d.data:
+            if index != NO_BLOCK and (prev == NO_BLOCK or index != prev + 1):
+                count += 1
+            prev = index if index != NO_BLOCK else prev
+        return count
+
+    def defrag(self, d: FileReg, progress: Callable[[int, int], None] = None) -> Optional[list[int]]:
+        # copy data blocks of the file into as few runs as possible and point the
+        # block map at the copies, returns the old blocks or None when no better
+        # layout was found; the caller frees them once the new map is committed
+        data = d.data
+        positions = [i for i, index in enumerate(data) if index != NO_BLOCK]
+        before = self.fragments(d)
+        if before <= 1:
+            return None
+        extents = list()
+        total = 0
+        goal = -1
+        while total < len(positions) and len(extents) < before:
+            start, length = self.bitmap.allocate_extent(len(positions) - total, goal)
+            if length == 0:
+                break
+            extents.append((start, length))
+            total += length
+            goal = start + length
+        if total < len(positions) or len(extents) >= before:
+            for start, length in extents:
+                for i in range(start, start + length):
+                    self.bitmap[i] = 0
+            return None
+        old = [data[i] for i in positions]
+        chunk = max(1, IO_CHUNK_SIZE // self.block_size)
+        view = memoryview(bytearray(chunk*self.block_size))
+        done = 0
+        for start, length in extents:
+            for k in range(0, length, chunk):
+                count = min(chunk, length - k)
+                sources = old[done:done + count]
+                i = 0
+                while i < count:
+                    n = 1
+                    while i + n < count and sources[i + n] == sources[i] + n:
+                        n += 1
+                    self.cache.read_run(sources[i], n, view[self.block_size*i:self.block_size*(i + n)])
+                    i += n
+                self.cache.write_run(start + k, count, view[0:self.block_size*count])
+                for j in range(count):
+                    self.remap_block(d, positions[done + j], start + k + j)
+                done += count
+                if progress is not None:
+                    progress(done, len(positions))
+        self.write_descriptor(d)
+        self.stats.count('blocks_moved', len(old))
+        return old
+
+    def remap_block(self, d: FileReg, pos: int, index: int) -> None:
+        # point data block pos of the file, which is not a hole, at block index
+        level, offsets = block_path(pos, self.block_size)
+        if level > 0:
+            self.set_pointer(d.nodes[(level,) + tuple(offsets[:-1])], offsets[-1], index)
+        d.data[pos] = index
+
+    def extend_file(self, d: FileReg, count: int) -> int:
+        # append count blocks, returns how many were added
+        first = len(d.data)
+        return self.allocate_range(d, first, first + count) - first
+
+    def write(self, data: bytes, d: FileReg, offset: int) -> int:
+        # returns number of bytes written
+        size = len(data)
+        if size == 0:
+            return 0
+        first = offset // self.block_size
+        last = math.ceil((offset + size)/self.block_size)
+        # new blocks may hold stale data, zero what the write leaves of them
+        head = offset % self.block_size if self.is_hole(d, first) else 0
+        tail = -(offset + size) % self.block_size if self.is_hole(d, last - 1) else 0
+        mapped = self.allocate_range(d, first, last)
+        if head or tail:
+            data = bytes(head) + bytes(data) + bytes(tail)
+        blocks = d.data
+        base = offset - head
+        end = min(offset + size + tail, mapped*self.block_size)
+        pos = base
+        while pos < end:
+            i = pos // self.block_size
+            block_offset = pos % self.block_size
+            if block_offset != 0 or end - pos < self.block_size:
+                n = min(self.block_size - block_offset, end - pos)
+                self.cache.write(blocks[i], block_offset, data[pos - base:pos - base + n])
+                pos += n
+                continue
+            index = blocks[i]
+            count = 1
+            while (i + count + 1)*self.block_size <= end and blocks[i + count] == index + count:
+                count += 1
+            self.cache.write_run(index, count, data[pos - base:pos - base + self.block_size*count])
+            pos += self.block_size*count
+        written = max(min(end, offset + size) - offset, 0)
+        if written > 0 and offset + written > d.size:
+            d.size = offset + written
+            self.write_descriptor(d)
+        return written
+
+    def walk_tree(self, parents: dict[int, int]) -> Tuple[list[int], list[Tuple[int, str, int]]]:
+        # entries naming every descriptor below the directories in parents,
+        # which maps directories to their parents and gets the reached ones;
+        # bad entries come as (directory, name, descriptor it should name)
+        links = [0] * self.desc_number
+        bad = list()
+        queue = list(parents.items())
+        while queue:
+            index, parent = queue.pop()
+            entries = self.descriptor(index).links
+            for name, expected in ((NAME_DOT, index), (NAME_DOT_DOT, parent)):
+                if entries.get(name) != expected:
+                    bad.append((index, name, expected))
+            for name, child in entries.items():
+                if name == NAME_DOT or name == NAME_DOT_DOT:
+                    continue
+                if child >= self.desc_number or self.types[child] == ord('-') or self.nlinks[child] == 0:
+                    bad.append((index, name, NO_DESC))
+                    continue
+                if self.types[child] == ord('d'):
+                    # a directory has one parent, other entries are dropped
+                    if child in parents:
+                        bad.append((index, name, NO_DESC))
+                        continue
+                    parents[child] = index
+                    queue.append((child, index))
+                links[child] += 1
+        return links, bad
+
+    def block_references(self, files: list[int]) -> Tuple[array, dict[int, int], list[Tuple[int, int, int]]]:
+        # data and indirect blocks of the files, the number of them per file and
+        # pointers past the end of the image as (file, indirect block or NO_BLOCK
+        # for the descriptor, offset)
+        refs = array('I')
+        counts = dict()
+        bad = list()
+        for index in files:
+            start = len(refs)
+            for k in range(BLOCKS_MAP_SIZE):
+                pointer = self.maps[k][index]
+                if pointer == NO_BLOCK:
+                    continue
+                if pointer >= self.blocks_number:
+                    bad.append((index, NO_BLOCK, k))
+                    continue
+                if k < DIRECT_BLOCKS:
+                    refs.append(pointer)
+                    continue
+                # indirect blocks level by level, data blocks below the last one
+                nodes = array('I', [pointer])
+                for depth in range(k - DIRECT_BLOCKS + 1, 0, -1):
+                    refs.extend(nodes)
+                    children = array('I')
+                    for node in nodes:
+                        data = self.cache.read(node)
+                        pointers = node_pointers(data)
+                        if len(pointers) and max(pointers) >= self.blocks_number:
+                            bad += [(index, node, offset) for offset, p in enumerate(unpack_pointers(data))
+                                if p != NO_BLOCK and p >= self.blocks_number]
+                            pointers = array('I', (p for p in pointers if p < self.blocks_number))
+                        children.extend(pointers)
+                    nodes = children
+                refs.extend(nodes)
+            counts[index] = len(refs) - start
+        return refs, counts, bad
+
+    def fsck(self, repair: bool = False) -> int:
+        # cross-checks the flushed metadata, returns the number of problems found
+        start = time.monotonic()
+        self.load_all_descriptors()
+        free = ord('-')
+        # unlinked files still open hold their blocks
+        files = [i for i in range(self.desc_number) if self.types[i] != free and
+            (self.nlinks[i] != 0 or i in self.open_counts)]
+        parents = {self.rootdir.index: self.rootdir.index}
+        links, bad_entries = self.walk_tree(parents)
+        orphans = [i for i in files if self.nlinks[i] != 0 and i not in parents and links[i] == 0]
+        refs, counts, bad_pointers = self.block_references(files)
+        used, duplicates = count_references(refs, self.blocks_number)
+        self.stats.count('fsck_blocks_checked', len(refs))
+        current = bytes(self.bitmap.data)
+        marked = int.from_bytes(current, 'little')
+        referenced = int.from_bytes(used, 'little')
+        leaked = [i for i in set_bits((marked & ~referenced).to_bytes(len(current), 'little'))
+            if i < self.blocks_number]
+        missing = set_bits((referenced & ~marked).to_bytes(len(current), 'little'))
+        nblocks = [i for i in files if self.nblocks[i] != counts[i]]
+        expected = self.link_counts(parents, links)
+        nlinks = [i for i in files if expected[i] != 0 and self.nlinks[i] != expected[i]]
+
+        problems = 0
+        for name, items in (('Bad directory entries', [f"{d}:{name}" for d, name, _ in bad_entries]),
+                ('Pointers past the end of the image', [f"{i}:{node}:{k}" if node != NO_BLOCK else f"{i}:{k}"
+                    for i, node, k in bad_pointers]),
+                ('Blocks used but marked free', missing),
+                ('Blocks marked used but not referenced', leaked),
+                ('Blocks referenced more than once', duplicates),
+                ('Orphaned descriptors', orphans),
+                ('Wrong block counts', nblocks),
+                ('Wrong link counts', nlinks)):
+            if items:
+                log_fail(f"{name}: {preview(items)}")
+                problems += len(items)
+        log_info(f"Checked {len(files)} descriptors and {len(refs)} blocks "
+            f"in {time.monotonic() - start:.3f}s, {problems} problems")
+        if repair and problems:
+            self.repair(bad_pointers, used, missing + leaked, duplicates, counts, orphans, bad_entries)
+        return problems
+
+    def link_counts(self, parents: dict[int, int], links: list[int]) -> list[int]:
+        # a directory is named by its parent and its own '.', and by '..' of
+        # every subdirectory; the root names itself instead of a parent
+        counts = list(links)
+        for index in parents:
+            counts[index] = 2
+        for child, parent in parents.items():
+            if child != parent:
+                counts[parent] += 1
+        return counts
+
+    def repair(self, bad_pointers: list[Tuple[int, int, int]], used: bytes, wrong: list[int], \
+            duplicates: list[int], counts: dict[int, int], orphans: list[int], \
+            bad_entries: list[Tuple[int, str, int]]) -> None:
+        # block map and bitmap first, so directory fixes allocate only free blocks
+        for index, node, k in bad_pointers:
+            if node == NO_BLOCK:
+                self.maps[k][index] = NO_BLOCK
+            else:
+                self.set_pointer(node, k, NO_BLOCK)
+            self.file_blocks.pop(index, None)
+            self.file_nodes.pop(index, None)
+            self.write_descriptor(self.descriptor(index))
+        self.bitmap = Bitmap(used, self.blocks_number, self.stats)
+        self.bitmap.dirty = {i >> 3 for i in wrong}
+        for index, count in counts.items():
+            if self.nblocks[index] != count:
+                self.nblocks[index] = count
+                self.write_descriptor(self.descriptor(index))
+        # later owners of a shared data block get a copy of it
+        shared = set(duplicates)
+        seen = set()
+        for index in counts:
+            if not shared or self.types[index] not in (ord('r'), ord('d')):
+                continue
+            d = self.descriptor(index)
+            for pos, block in enumerate(d.data):
+                if block not in shared:
+                    continue
+                if block not in seen:
+                    seen.add(block)
+                    continue
+                copy = self.get_free_block()
+                if copy == -1:
+                    log_fail("No space left to copy shared blocks")
+                    break
+                self.cache.write(copy, 0, self.cache.read(block))
+                self.remap_block(d, pos, copy)
+            self.write_descriptor(d)
+        for index, name, expected in bad_entries:
+            d = self.descriptor(index)
+            if name in d.links:
+                self.remove_entry(d, name)
+            if expected != NO_DESC:
+                self.add_entry(d, name, expected)
+        if orphans:
+            self.reattach(orphans)
+        # links are counted again over the repaired tree
+        parents = {self.rootdir.index: self.rootdir.index}
+        links, _ = self.walk_tree(parents)
+        expected = self.link_counts(parents, links)
+        for index in range(self.desc_number):
+            if self.types[index] != ord('-') and self.nlinks[index] != 0 and \
+                    expected[index] != 0 and self.nlinks[index] != expected[index]:
+                self.nlinks[index] = expected[index]
+                self.write_descriptor(self.descriptor(index))
+        log_info("Repaired")
+
+    def reattach(self, orphans: list[int]) -> None:
+        # orphans not found in other orphaned directories go to /lost+found
+        found = set()
+        for index in orphans:
+            if self.types[index] == ord('d'):
+                found.update(i for name, i in self.descriptor(index).links.items()
+                    if name != NAME_DOT and name != NAME_DOT_DOT)
+        lost, _ = self.lookup(self.rootdir, LOST_FOUND)
+        if lost is None and self.mkdir(self.rootdir, LOST_FOUND) == 1:
+            lost, _ = self.lookup(self.rootdir, LOST_FOUND)
+        if not isinstance(lost, FileDir):
+            log_fail(f"Could not make /{LOST_FOUND} for orphaned descriptors")
+            return
+        for index in orphans:
+            if index in found:
+                continue
+            if self.add_entry(lost, f"#{index}", index) == -1:
+                log_fail(f"No space left in /{LOST_FOUND}")
+                return
+            d = self.descriptor(index)
+            if isinstance(d, FileDir):
+                self.remove_entry(d, NAME_DOT_DOT)
+                self.add_entry(d, NAME_DOT_DOT, lost.index)
+            log_info(f"Descriptor {index} moved to /{LOST_FOUND}/#{index}")
+
+# chunk size of bulk transfers between host files and the image
+IO_CHUNK_SIZE = 1 << 20
+
+def host_chunks(file, chunk_size: int) -> Iterator[bytes]:
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def timed(func):
+    # records latency of an OS operation in the session stats
+    name = func.__name__
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.fs.stats.observe(name, time.perf_counter() - start)
+    return wrapper
+
+def writeback(func):
+    # timed, then flush when write-back limits are hit, once the operation
+    # let its locks go; one wrapper as it runs on every change
+    name = func.__name__
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.fs.maybe_flush()
+            self.fs.stats.observe(name, time.perf_counter() - start)
+    return wrapper
+
+# resolved paths kept by OS.lookup
+DENTRY_CACHE_SIZE = 4096
+# seconds between progress lines of a defrag
+DEFRAG_PROGRESS_INTERVAL = 1.0
+
 class OS:
+    # safe to share between threads: operations hold fs.lock shared (flush,
+    # mount and unmount hold it exclusive), then lock directories before the
+    # files in them through fs.inodes; blocks and descriptor slots have
+    # allocator locks of their own
     def __init__(self) -> None:
         self.fs: FS = FS()
-        self.fd: list[FileReg] = list()
+        # open files table and dentry cache locks
+        self.fd_lock = threading.Lock()
+        self.dentry_lock = threading.Lock()
+        self.dentry_gen = 0
+        self.clear_handles()
+        # source of data for write, replaced in script mode
+        self.input = input
+
+    def clear_handles(self) -> None:
+        # open files pin their descriptors, paths are kept for messages only
+        self.fd: list[Optional[FileDesc]] = list()
+        self.paths: list[Optional[str]] = list()
         self.offsets: list[int] = list()
+        # keep calls on one handle and its offset in order
+        self.fd_locks: list[threading.Lock] = list()
+        self.free_fds: list[int] = list()
+        # (path, follow) -> lookup result, dropped on any namespace change
+        self.dentries: dict[Tuple[str, bool], tuple] = dict()
+
+    def close_all(self) -> None:
+        # files unlinked while open are released with their last handle
+        for desc in self.fd:
+            if desc is not None:
+                desc.opened -= 1
+                if desc.opened == 0 and desc.to_delete == 1:
+                    self.fs.release(desc)
+        self.clear_handles()
+
+    def invalidate(self) -> None:
+        with self.dentry_lock:
+            self.dentry_gen += 1
+            self.dentries.clear()
 
     def lookup(self, path: str, follow: bool = True) \
                 -> Tuple[Optional[FileDir], Optional[FileDesc], str, int]:
+        key = (path, follow)
+        found = self.dentries.get(key)
+        if found is not None:
+            self.fs.stats.count('dentry_hits')
+            return found
+        self.fs.stats.count('dentry_misses')
+        gen = self.dentry_gen
+        found = self.resolve(path, follow)
+        # only existing files are cached, misses are followed by create anyway,
+        # so adding a name never makes an entry stale, removing one does
+        if found[1] is not None:
+            with self.dentry_lock:
+                # a namespace change since the resolve started may make it stale
+                if gen == self.dentry_gen:
+                    if len(self.dentries) >= DENTRY_CACHE_SIZE:
+                        del self.dentries[next(iter(self.dentries))]
+                    self.dentries[key] = found
+        return found
+
+    def resolve(self, path: str, follow: bool = True) \
+                -> Tuple[Optional[FileDir], Optional[FileDesc], str, int]:
         curdir: FileDir = self.fs.rootdir if path[0] == '/' else self.cwd
         pardir: Optional[FileDir] = curdir
         if path == "/":
@@ -618,7 +2529,11 @@ class OS:
         for i, name in enumerate(comp):
             if name == "":
                 continue
-            desc, index = self.fs.lookup(curdir, name)
+            found = self.fs.lookup_loaded(curdir, name)
+            if found is None:
+                with self.fs.inodes.shared(curdir.index):
+                    found = self.fs.lookup(curdir, name)
+            desc, index = found
             if desc is None:
                 if i < len(comp) - 1:
                     pardir = None
@@ -641,139 +2556,336 @@ class OS:
                 pardir = curdir
         return pardir, desc, name, index
 
+    def entry(self, d: FileDir, name: str) -> Tuple[Optional[FileDir], Optional[FileDesc]]:
+        # lookup again with d locked, it may have changed or gone since the path was resolved
+        if d.type != 'd':
+            return None, None
+        return d, self.fs.lookup(d, name)[0]
+
+    @writeback
     def create(self, path: str) -> None:
         log_info(f"Create regular file '{path}'")
-        pardir, desc, name, _ = self.lookup(path)
-        if path_exist(pardir, desc, path):
-            return
-        if len(path) > MAX_R:
-            log_fail(f"Name '{path}' maximum length is {MAX_R}")
-            return
-
-        if len(list(pardir.links.keys())) > DESC_NUMBER:
-            log_fail(f"Maximum file quantity reached!")
-            return
-        self.fs.create(Optional_unwrap(pardir), name)
+        with self.fs.lock.shared:
+            pardir, desc, name, _ = self.lookup(path)
+            if path_exist(pardir, desc, path) or name_too_long(name):
+                return
+            with self.fs.inodes.exclusive(pardir.index):
+                if path_exist(*self.entry(pardir, name), path):
+                    return
+                if self.fs.create(Optional_unwrap(pardir), name) == -1:
+                    log_fail(f"Maximum file quantity reached!")
+
+    @writeback
+    def mkdir(self, path: str) -> None:
+        log_info(f"Create directory '{path}'")
+        with self.fs.lock.shared:
+            pardir, desc, name, _ = self.lookup(path)
+            if path_exist(pardir, desc, path) or name_too_long(name):
+                return
+            with self.fs.inodes.exclusive(pardir.index):
+                if path_exist(*self.entry(pardir, name), path):
+                    return
+                if self.fs.mkdir(Optional_unwrap(pardir), name) == -1:
+                    log_fail(f"Could not create directory '{path}'")
+
+    @writeback
+    def rmdir(self, path: str) -> None:
+        log_info(f"Remove directory '{path}'")
+        with self.fs.lock.shared:
+            pardir, desc, name, _ = self.lookup(path, False)
+            if path_not_exist(pardir, desc, path):
+                return
+            with self.fs.inodes.exclusive(pardir.index):
+                pardir, desc = self.entry(pardir, name)
+                if path_not_exist(pardir, desc, path):
+                    return
+                if not desc_is_FileDir(desc, path):
+                    log_fail(f"'{path}' is not a directory")
+                    return
+                if name in (NAME_DOT, NAME_DOT_DOT) or desc == self.fs.rootdir:
+                    log_fail(f"Cannot remove '{path}'")
+                    return
+                with self.fs.inodes.exclusive(desc.index):
+                    if len(desc.links) > 2:
+                        log_fail(f"Directory '{path}' is not empty")
+                        return
+                    if desc == self.cwd:
+                        log_fail(f"Directory '{path}' is the working directory")
+                        return
+                    self.fs.rmdir(Optional_unwrap(pardir), name)
+                    # lookups do not wait for the change, they may have cached the entry during it
+                    self.invalidate()
+
+    def cd(self, path: str) -> None:
+        log_info(f"Change working directory to '{path}'")
+        with self.fs.lock.shared:
+            pardir, desc, _, _ = self.lookup(path)
+            if path_not_exist(pardir, desc, path):
+                return
+            if not desc_is_FileDir(desc, path):
+                log_fail(f"'{path}' is not a directory")
+                return
+            self.cwd = desc
+            # relative paths resolve differently now
+            self.invalidate()
 
+    @writeback
     def link(self, path1: str, path2: str) -> None:
         log_info(f"Create link '{path2}' to '{path1}'")
-        pardir, dest, name, _ = self.lookup(path1, False)
-        if path_not_exist(pardir, dest, path1):
-            return
-        pardir, desc, name, _ = self.lookup(path2)
-        if path_exist(pardir, desc, path2):
-            return
-        if len(list(pardir.links.keys())) > DESC_NUMBER:
-            log_fail(f"Maximum file quantity reached!")
-            return
-        self.fs.link(Optional_unwrap(pardir), name, Optional_unwrap(dest))
-
+        with self.fs.lock.shared:
+            pardir, dest, name, _ = self.lookup(path1, False)
+            if path_not_exist(pardir, dest, path1):
+                return
+            if desc_is_FileDir(dest, path1):
+                log_fail(f"'{path1}' is a directory")
+                return
+            pardir, desc, name, _ = self.lookup(path2)
+            if path_exist(pardir, desc, path2) or name_too_long(name):
+                return
+            with self.fs.inodes.exclusive(pardir.index), self.fs.inodes.exclusive(dest.index):
+                if path_exist(*self.entry(pardir, name), path2):
+                    return
+                if dest.nlink == 0:
+                    log_fail(f"Link '{path1}' does not exist")
+                    return
+                if self.fs.link(Optional_unwrap(pardir), name, Optional_unwrap(dest)) == -1:
+                    log_fail(f"Maximum file quantity reached!")
+
+    @writeback
     def unlink(self, path: str) -> None:
         log_info(f"Unlink link '{path}'")
-        pardir, desc, name, _ = self.lookup(path, False)
-        if path_not_exist(pardir, desc, path):
-            return
-        opened = 0
-        if path in self.fd:
-            opened = 1
-        self.fs.unlink(Optional_unwrap(pardir), name, opened)
-
-    def ls(self, path: str = "") -> None:
-        log_info(f"List for '{path}'")
-        desc: Optional[FileDesc]
-        if path == "":
-            desc = self.cwd
-        else:
-            pardir, desc, _, index = self.lookup(path)
+        with self.fs.lock.shared:
+            pardir, desc, name, _ = self.lookup(path, False)
             if path_not_exist(pardir, desc, path):
                 return
-            desc = Optional_unwrap(desc)
-            pardir = None
-        if desc_is_FileDir(desc, path):
-            self.fs.ls(desc, self.cwd)
-
+            with self.fs.inodes.exclusive(pardir.index):
+                pardir, desc = self.entry(pardir, name)
+                if path_not_exist(pardir, desc, path):
+                    return
+                if desc_is_FileDir(desc, path):
+                    log_fail(f"'{path}' is a directory, use rmdir")
+                    return
+                with self.fs.inodes.exclusive(desc.index):
+                    self.fs.unlink(Optional_unwrap(pardir), name, desc.opened > 0)
+                    # lookups do not wait for the change, they may have cached the entry during it
+                    self.invalidate()
+
+    @timed
+    def ls(self, path: str = "") -> None:
+        log_info(f"List for '{path}'")
+        with self.fs.lock.shared:
+            desc: Optional[FileDesc]
+            if path == "":
+                desc = self.cwd
+            else:
+                pardir, desc, _, index = self.lookup(path)
+                if path_not_exist(pardir, desc, path):
+                    return
+                desc = Optional_unwrap(desc)
+                pardir = None
+            if desc_is_FileDir(desc, path):
+                with self.fs.inodes.shared(desc.index):
+                    self.fs.ls(desc, self.cwd)
+
+    @timed
     def fstat(self, path: str) -> None:
         log_info(f"File stat for '{path}'")
-        pardir, desc, _, index = self.lookup(path, False)
-        if path_not_exist(pardir, desc, path):
-            return
-        print(f"id={index}", f"type={desc.type}", f"nlink={desc.nlink}", f"size={desc.size}", f"nblock={desc.nblock}")
+        stat = self.stat(path)
+        if stat is not None:
+            print(*(f"{key}={value}" for key, value in stat.items()))
+
+    def stat(self, path: str) -> Optional[dict]:
+        with self.fs.lock.shared:
+            pardir, desc, _, index = self.lookup(path, False)
+            if path_not_exist(pardir, desc, path):
+                return None
+            with self.fs.inodes.shared(desc.index):
+                return {'id': index, 'type': desc.type, 'nlink': desc.nlink,
+                    'size': desc.size, 'nblock': desc.nblock}
+
+    def listdir(self, path: str = "") -> Optional[list[str]]:
+        with self.fs.lock.shared:
+            desc = self.cwd
+            if path != "":
+                pardir, desc, _, _ = self.lookup(path)
+                if path_not_exist(pardir, desc, path):
+                    return None
+            if not desc_is_FileDir(desc, path):
+                log_fail(f"'{path}' is not a directory")
+                return None
+            with self.fs.inodes.shared(desc.index):
+                return sorted(desc.links)
 
     def pwd(self) -> None:
         log_info("Get CWD canonical absolute path")
         cwd_path = ""
         path = ""
-        while True:
-            _, desc1, _, _ = os.lookup(path + NAME_DOT)
-            path = NAME_DOT_DOT + "/" + path
-            _, desc2, _, _ = os.lookup(path)
-            if desc1 == None or desc2 == None:
-                log_fail("CWD was removed");
-                return
-            assert isinstance(desc1, FileDir)
-            assert isinstance(desc2, FileDir)
-            name = os.fs.reverse_lookup(Optional_unwrap(desc2),
-                Optional_unwrap(desc1))
-            if name == None:
-                log_fail("CWD was removed")
-                return
-            if desc1 == desc2:
-                if cwd_path == "":
-                    cwd_path = "/"
-                break
-            cwd_path = "/" + Optional_unwrap(name) + cwd_path
+        with self.fs.lock.shared:
+            while True:
+                _, desc1, _, _ = self.lookup(path + NAME_DOT)
+                path = NAME_DOT_DOT + "/" + path
+                _, desc2, _, _ = self.lookup(path)
+                if desc1 == None or desc2 == None:
+                    log_fail("CWD was removed");
+                    return
+                assert isinstance(desc1, FileDir)
+                assert isinstance(desc2, FileDir)
+                with self.fs.inodes.shared(desc2.index):
+                    name = self.fs.reverse_lookup(Optional_unwrap(desc2),
+                        Optional_unwrap(desc1))
+                if name == None:
+                    log_fail("CWD was removed")
+                    return
+                if desc1 == desc2:
+                    if cwd_path == "":
+                        cwd_path = "/"
+                    break
+                cwd_path = "/" + Optional_unwrap(name) + cwd_path
         log_info(f"CWD canonical absolute path '{cwd_path}'")
 
+    @writeback
     def truncate(self, path: str, size: int) -> None:
         log_info(f"Truncate file {path} size to {size}")
-        pardir, desc, _, _ = self.lookup(path, False)
-        if path_not_exist(pardir, desc, path):
-            return
-        size = math.ceil(int(size)/BLOCK_SIZE)*BLOCK_SIZE
-        if size > desc.size:
-            offset = desc.size
-            text = "0"*(size - desc.size)
-            text_arr, _ = self.split_text_to_write(desc, offset, text)
-            for i in range(len(text_arr)):
-                text_chunk = text_arr[i]
-                success = self.fs.write(text_chunk, desc, offset)
-                if success:
-                    offset += len(text_chunk)
-        elif size < desc.size:
-            self.fs.free_blocks(desc, size)
-
+        with self.fs.lock.shared:
+            pardir, desc, _, _ = self.lookup(path, False)
+            if path_not_exist(pardir, desc, path):
+                return
+            if desc_is_FileDir(desc, path):
+                log_fail(f"File '{path}' is a directory")
+                return
+            with self.fs.inodes.exclusive(desc.index):
+                if desc.nlink == 0 and desc.opened == 0:
+                    log_fail(f"Link '{path}' does not exist")
+                    return
+                size = math.ceil(int(size)/self.fs.block_size)*self.fs.block_size
+                if size != desc.size:
+                    self.fs.resize(desc, size)
+
+    @writeback
+    def preallocate(self, path: str, size: int) -> None:
+        log_info(f"Preallocate {size} bytes for file {path}")
+        with self.fs.lock.shared:
+            pardir, desc, _, _ = self.lookup(path, False)
+            if path_not_exist(pardir, desc, path):
+                return
+            if not isinstance(desc, FileReg):
+                log_fail(f"'{path}' is not a regular file")
+                return
+            with self.fs.inodes.exclusive(desc.index):
+                if desc.nlink == 0 and desc.opened == 0:
+                    log_fail(f"Link '{path}' does not exist")
+                    return
+                self.fs.preallocate(desc, int(size))
+                extents = self.fs.fragments(desc)
+        log_info(f"File {path} is {desc.size} bytes in {extents} extents")
+
+    @timed
+    def defrag(self, path: str = "") -> None:
+        # files are locked one at a time, the rest of the filesystem stays in use
+        log_info(f"Defragment {path or 'all files'}")
+        with self.fs.lock.shared:
+            if path:
+                pardir, desc, _, _ = self.lookup(path, False)
+                if path_not_exist(pardir, desc, path):
+                    return
+                if not isinstance(desc, FileReg):
+                    log_fail(f"'{path}' is not a regular file")
+                    return
+                files = [desc.index]
+            else:
+                self.fs.load_all_descriptors()
+                files = [i for i, type in enumerate(self.fs.types)
+                    if type == ord('r') and self.fs.nlinks[i] != 0]
+        moved = 0
+        start = time.monotonic()
+        reported = start
+
+        def progress(done: int, total: int) -> None:
+            nonlocal reported
+            now = time.monotonic()
+            if now - reported >= DEFRAG_PROGRESS_INTERVAL:
+                reported = now
+                log_info(f"  {done}/{total} blocks ({100*done//total}%), "
+                    f"{(moved + done)*self.fs.block_size/(now - start)/(1 << 20):.1f} MiB/s")
+
+        for k, index in enumerate(files):
+            name = path or f"#{index}"
+            with self.fs.lock.shared:
+                if not self.fs.initialized:
+                    return
+                desc = self.fs.descriptor(index)
+                if not isinstance(desc, FileReg):
+                    continue
+                with self.fs.inodes.exclusive(index):
+                    if desc.nlink == 0 and desc.opened == 0:
+                        continue
+                    before = self.fs.fragments(desc)
+                    old = self.fs.defrag(desc, progress)
+                    after = self.fs.fragments(desc)
+            if old is None:
+                # either contiguous already or free space is too fragmented
+                message = f"[{k + 1}/{len(files)}] {name}: {before} extents, left as is"
+                if path:
+                    log_info(message)
+                else:
+                    log_debug(message)
+                continue
+            # old blocks may be reused only once the new block map is committed
+            with self.fs.lock.exclusive:
+                if self.fs.initialized:
+                    self.fs.flush()
+                    self.fs.release_blocks(old)
+            moved += len(old)
+            log_info(f"[{k + 1}/{len(files)}] {name}: {before} -> {after} extents, "
+                f"{len(old)} blocks moved")
+        elapsed = time.monotonic() - start
+        log_info(f"Moved {moved*self.fs.block_size} bytes in {elapsed:.3f}s "
+            f"({moved*self.fs.block_size/max(elapsed, 1e-9)/(1 << 20):.1f} MiB/s)")
+
+    @timed
+    def fsck(self, repair: bool = False) -> int:
+        # the check reads metadata as it is on disk, so it runs on a flushed
+        # filesystem with every other operation waiting
+        log_info("Check filesystem" + (" and repair it" if repair else ""))
+        with self.fs.lock.exclusive:
+            self.fs.flush()
+            problems = self.fs.fsck(repair)
+            if repair and problems:
+                self.fs.sync()
+                self.invalidate()
+        return problems
+
+    @timed
     def open(self, path: str) -> int:
         log_info(f"Open file {path}")
+        # a missing file is created, create reports a wrong path itself
         pardir, desc, _, _ = self.lookup(path, False)
-        if path_not_exist(pardir, desc, path):
+        if desc is None:
             self.create(path)
+        with self.fs.lock.shared:
             pardir, desc, _, _ = self.lookup(path, False)
-        if desc_is_FileDir(desc, path):
-            log_fail(f"File '{path}' is a directory")
-            return -1
-
-        if len(path) > MAX_R:
-            log_fail(f"Name '{path}' maximum length is {MAX_R}")
-            return -1
-
-        if len(list(pardir.links.keys())) > DESC_NUMBER:
-            log_fail(f"Maximum file quantity reached!")
-            return
-
-        index = -1
-        if None in self.fd:
-            index = self.fd.index(None)
-        else: 
-            index = len(self.fd)
-            self.fd.append(None)
-            self.offsets.append(None)
-        self.fd[index] = path
-        self.offsets[index] = 0
-
-        if index == -1:
-            log_fail(f"Could not open file '{path}'")
-        else:
-            print(f"fd={index}")
+            if desc is None:
+                return -1
+            if desc_is_FileDir(desc, path):
+                log_fail(f"File '{path}' is a directory")
+                return -1
+            with self.fs.inodes.exclusive(desc.index):
+                if desc.nlink == 0:
+                    log_fail(f"Could not open file '{path}'")
+                    return -1
+                desc.opened += 1
+            with self.fd_lock:
+                if len(self.free_fds) > 0:
+                    index = self.free_fds.pop()
+                else:
+                    index = len(self.fd)
+                    self.fd.append(None)
+                    self.paths.append(None)
+                    self.offsets.append(None)
+                    self.fd_locks.append(threading.Lock())
+                self.fd[index] = desc
+                self.paths[index] = path
+                self.offsets[index] = 0
         return index
 
     def fd_is_busy(self, fd: int) -> bool:
@@ -782,101 +2894,679 @@ class OS:
             return False
         return True
 
-    def mkfs(self, n: int) -> None:
-        self.fs.mkfs(n)
-        self.cwd: FileDir = self.fs.rootdir
+    @timed
+    def mkfs(self, n: int, path: str = "fs", size: Optional[int] = None, \
+            block_size: Optional[int] = None) -> None:
+        with self.fs.lock.exclusive:
+            self.close_all()
+            self.invalidate()
+            self.fs.mkfs(n, path, size=size, block_size=block_size)
+        if self.fs.initialized:
+            self.cwd: FileDir = self.fs.rootdir
     
     def fs_initialized(self) -> bool:
         return self.fs.initialized
 
-    def mount(self, fs: str) -> None:
-        self.fs.mount(fs)
-        self.cwd: FileDir = self.fs.rootdir
-
-    def close(self, fd: int) -> None:
-        fd = int(fd)
-        if not self.fd_is_busy(fd):
-            log_fail(f"Could not find opened fd='{fd}'")
-            return
-        path = self.fd[fd]
-        pardir, desc, _, _ = self.lookup(path, False)
-        if path_not_exist(pardir, desc, path):
-            log_fail('Error! Path does not exist')
+    @timed
+    def mount(self, fs: str, use_mmap: bool = False, cache_size: int = BLOCK_CACHE_SIZE, \
+            dirty_limit: int = DIRTY_LIMIT, flush_interval: float = FLUSH_INTERVAL) -> None:
+        with self.fs.lock.exclusive:
+            self.close_all()
+            self.invalidate()
+            self.fs.mount(fs, use_mmap, cache_size, dirty_limit, flush_interval)
+        if self.fs.initialized:
+            self.cwd: FileDir = self.fs.rootdir
+
+    @timed
+    def unmount(self) -> None:
+        with self.fs.lock.exclusive:
+            self.close_all()
+            self.fs.unmount()
+
+    @timed
+    def flush(self) -> None:
+        log_info("Flush dirty blocks and metadata")
+        with self.fs.lock.exclusive:
+            self.fs.flush()
+
+    @timed
+    def sync(self) -> None:
+        log_info("Sync filesystem to disk")
+        with self.fs.lock.exclusive:
+            self.fs.sync()
+
+    def cache(self, size: Optional[int] = None) -> None:
+        if size is not None:
+            self.fs.cache.resize(int(size))
+        log_info(f"Block cache {self.fs.cache.stats()}")
+
+    def stats(self) -> dict:
+        report = self.fs.stats.report()
+        if self.fs.initialized:
+            report['cache'] = self.fs.cache.stats()
+        return report
+
+    def print_stats(self) -> None:
+        report = self.stats()
+        print(f"Session {report['seconds']:.3f}s")
+        for name, value in report['counters'].items():
+            print(f"\t{name:<24} {value}")
+        for name, hist in report['latency'].items():
+            print(f"\t{name:<16} n={hist['count']} mean={hist['mean']*1e6:.1f}us "
+                f"p50<={hist['p50']*1e6:.0f}us p99<={hist['p99']*1e6:.0f}us max={hist['max']*1e6:.1f}us")
+        if 'cache' in report:
+            print(f"\tcache {report['cache']}")
+
+    def reset_stats(self) -> None:
+        self.fs.reset_stats()
+
+    def dump_stats(self, path: Optional[str] = None) -> None:
+        data = json.dumps(self.stats(), indent=2)
+        if path is None:
+            print(data)
             return
-        if desc.to_delete == 1:
-            self.fs.unlink(Optional_unwrap(self.cwd), path, 0)
-        self.fd[fd] = None
-        self.offsets[fd] = None
-        print("Closed!")
-        return
-
+        with open(path, "w") as file:
+            file.write(data + "\n")
+        log_info(f"Stats written to '{path}'")
+
+    def handle(self, fd: int):
+        # lock of an open file handle, calls on a closed fd fail once they get it
+        if 0 <= fd < len(self.fd_locks):
+            return self.fd_locks[fd]
+        return contextlib.nullcontext()
+
+    @writeback
+    def close(self, fd: int) -> int:
+        fd = int(fd)
+        with self.handle(fd), self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return -1
+            desc = self.fd[fd]
+            with self.fs.inodes.exclusive(desc.index):
+                desc.opened -= 1
+                if desc.opened == 0 and desc.to_delete == 1:
+                    self.fs.release(desc)
+            with self.fd_lock:
+                self.fd[fd] = None
+                self.paths[fd] = None
+                self.offsets[fd] = None
+                self.free_fds.append(fd)
+        return 0
+
+    @timed
     def read(self, fd: int, size: int) -> None:
         fd = int(fd)
         size = int(size)
-        if not self.fd_is_busy(fd):
-            log_fail(f"Could not find opened fd='{fd}'")
-            return
-        path = self.fd[fd]
-        offset = self.offsets[fd]
-        _, desc, _, _ = self.lookup(path, False)
-        text = self.fs.read(size, desc, offset)
-        self.offsets[fd] += size
+        with self.handle(fd), self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return
+            desc = self.fd[fd]
+            offset = self.offsets[fd]
+            with self.fs.inodes.shared(desc.index):
+                text = self.fs.read(size, desc, offset)
+            self.offsets[fd] += size
         print(text)
 
+    @timed
     def seek(self, fd: int, offset: int) -> None:
         fd = int(fd)
         offset = int(offset)
-        if not self.fd_is_busy(fd):
-            log_fail(f"Could not find opened fd='{fd}'")
-            return
-        path = self.fd[fd]
-        _, desc, _, _ = self.lookup(path, False)
-        if int(desc.size) < offset:
-            log_fail(f"Cannot seek to not existing position, file size='{desc.size}'")
-            return
-        self.offsets[fd] = offset
+        with self.handle(fd):
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return
+            # past the end is fine, a write there leaves a hole
+            if offset < 0:
+                log_fail(f"Cannot seek to negative position '{offset}'")
+                return
+            self.offsets[fd] = offset
         log_info(f"Seek value set {offset}")
     
-    def split_text_to_write(self, desc: FileReg, offset: int, text: str):
-        first_chunk_size = self.fs.get_block_characters(desc, offset)
-        text_arr = list()
-        text_arr.append(text[0:first_chunk_size])
-        text = text[first_chunk_size:]
-        arr = [text[i:i+BLOCK_SIZE] for i in range(0, len(text), BLOCK_SIZE)]
-        text_arr = text_arr + arr
-        last_element_len = len(text_arr[-1])
-        if last_element_len != BLOCK_SIZE:
-            text_arr[-1] = text_arr[-1] + " " * (BLOCK_SIZE - last_element_len)
-        return text_arr, last_element_len
-
+    @writeback
     def write(self, fd: int, size: int) -> None:
         fd = int(fd)
         size = int(size)
+        # the data is taken even if the write fails, scripts keep it on the next line
+        text = self.input("Insert data: ")
         if not self.fd_is_busy(fd):
             log_fail(f"Could not find opened fd='{fd}'")
             return
-        path = self.fd[fd]
-        offset = self.offsets[fd]
-        _, desc, _, _ = self.lookup(path, False)
-        if desc_is_FileDir(desc, path):
+        if desc_is_FileDir(self.fd[fd], self.paths[fd]):
             log_fail(f"Cannot write to directory")
             return 
-        text = input("Insert data: ")
         if len(text) > size:
             text = text[0:size]
-        text_arr, last_element_len = self.split_text_to_write(desc, offset, text)
-        for i in range(len(text_arr)):
-            text_chunk = text_arr[i]
-            success = self.fs.write(text_chunk, desc, offset)
-            if success:
-                if i == len(text_arr) - 1:
-                    self.offsets[fd] += last_element_len
-                    offset += last_element_len  
-                else: 
-                    self.offsets[fd] += len(text_chunk)
-                    offset += len(text_chunk)
+        data = text.encode()
+        with self.handle(fd), self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return
+            desc = self.fd[fd]
+            offset = self.offsets[fd]
+            # pad the last block with spaces
+            padding = -(offset + len(data)) % self.fs.block_size
+            with self.fs.inodes.exclusive(desc.index):
+                written = self.fs.write(data + b" "*padding, desc, offset)
+            self.offsets[fd] += min(written, len(data))
         return
 
+    @writeback
+    def write_bytes(self, fd: int, buf) -> int:
+        with self.handle(fd), self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return -1
+            desc = self.fd[fd]
+            with self.fs.inodes.exclusive(desc.index):
+                written = self.fs.write(buf, desc, self.offsets[fd])
+            self.offsets[fd] += written
+        return written
+
+    @timed
+    def read_into(self, fd: int, buf) -> int:
+        with self.handle(fd), self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return -1
+            desc = self.fd[fd]
+            with self.fs.inodes.shared(desc.index):
+                size = self.fs.read_into(desc, self.offsets[fd], buf)
+            self.offsets[fd] += size
+        return size
+
+    @writeback
+    def write_at(self, fd: int, buf, offset: int) -> int:
+        # like pwrite, the handle offset is neither used nor moved
+        with self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return -1
+            desc = self.fd[fd]
+            with self.fs.inodes.exclusive(desc.index):
+                return self.fs.write(buf, desc, offset)
+
+    @timed
+    def read_at(self, fd: int, buf, offset: int) -> int:
+        # like pread, the handle offset is neither used nor moved
+        with self.fs.lock.shared:
+            if not self.fd_is_busy(fd):
+                log_fail(f"Could not find opened fd='{fd}'")
+                return -1
+            desc = self.fd[fd]
+            with self.fs.inodes.shared(desc.index):
+                return self.fs.read_into(desc, offset, buf)
+
+    def image_chunks(self, fd: int, chunk_size: int) -> Iterator[memoryview]:
+        # chunks share one buffer, each is valid until the next one is taken
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            size = self.read_into(fd, buf)
+            if size <= 0:
+                return
+            yield view[0:size]
+
+    def io_chunk_size(self) -> int:
+        return max(1, IO_CHUNK_SIZE // self.fs.block_size) * self.fs.block_size
+
+    @timed
+    def import_file(self, host_path: str, path: str) -> None:
+        log_info(f"Import host file '{host_path}' to '{path}'")
+        if not os.path.isfile(host_path):
+            log_fail(f"Host file '{host_path}' does not exist")
+            return
+        with self.fs.lock.shared:
+            pardir, desc, _, _ = self.lookup(path, False)
+            if pardir is not None and isinstance(desc, FileReg):
+                with self.fs.inodes.exclusive(desc.index):
+                    self.fs.free_blocks(desc, 0)
+        fd = self.open(path)
+        if fd is None or fd == -1:
+            return
+        total = 0
+        start = time.monotonic()
+        with open(host_path, "rb") as file:
+            for chunk in host_chunks(file, self.io_chunk_size()):
+                written = self.write_bytes(fd, chunk)
+                total += written
+                if written < len(chunk):
+                    log_fail(f"Only {total} bytes imported")
+                    break
+        self.close(fd)
+        log_info(f"Imported {total} bytes in {time.monotonic() - start:.3f}s")
+
+    @timed
+    def export_file(self, path: str, host_path: str) -> None:
+        log_info(f"Export '{path}' to host file '{host_path}'")
+        with self.fs.lock.shared:
+            pardir, desc, _, _ = self.lookup(path, False)
+        if path_not_exist(pardir, desc, path):
+            return
+        if not isinstance(desc, FileReg):
+            log_fail(f"'{path}' is not a regular file")
+            return
+        fd = self.open(path)
+        total = 0
+        start = time.monotonic()
+        with open(host_path, "wb") as file:
+            for chunk in self.image_chunks(fd, self.io_chunk_size()):
+                file.write(chunk)
+                total += len(chunk)
+        self.close(fd)
+        log_info(f"Exported {total} bytes in {time.monotonic() - start:.3f}s")
+
+
+# worker threads of AsyncOS
+ASYNC_WORKERS = 4
+
+class AsyncOS:
+    # asyncio front end of OS: calls run on a bounded thread pool and OS
+    # locking lets operations on different files go side by side
+    def __init__(self, workers: int = ASYNC_WORKERS) -> None:
+        self.os = OS()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fs")
+
+    async def __aenter__(self) -> "AsyncOS":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close_all()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def mount(self, image: str, use_mmap: bool = False) -> bool:
+        await self.run(self.os.mount, image, use_mmap)
+        return bool(self.os.fs_initialized())
+
+    async def unmount(self) -> None:
+        await self.run(self.os.unmount)
+
+    async def close_all(self) -> None:
+        if self.os.fs_initialized():
+            await self.unmount()
+        self.executor.shutdown()
+
+    async def flush(self) -> None:
+        await self.run(self.os.flush)
+
+    async def sync(self) -> None:
+        await self.run(self.os.sync)
+
+    async def create(self, path: str) -> None:
+        await self.run(self.os.create, path)
+
+    async def mkdir(self, path: str) -> None:
+        await self.run(self.os.mkdir, path)
+
+    async def rmdir(self, path: str) -> None:
+        await self.run(self.os.rmdir, path)
+
+    async def link(self, path1: str, path2: str) -> None:
+        await self.run(self.os.link, path1, path2)
+
+    async def unlink(self, path: str) -> None:
+        await self.run(self.os.unlink, path)
+
+    async def truncate(self, path: str, size: int) -> None:
+        await self.run(self.os.truncate, path, size)
+
+    async def stat(self, path: str) -> Optional[dict]:
+        return await self.run(self.os.stat, path)
+
+    async def listdir(self, path: str = "") -> Optional[list[str]]:
+        return await self.run(self.os.listdir, path)
+
+    async def open(self, path: str) -> int:
+        return await self.run(self.os.open, path)
+
+    async def close(self, fd: int) -> None:
+        await self.run(self.os.close, fd)
+
+    async def seek(self, fd: int, offset: int) -> None:
+        await self.run(self.os.seek, fd, offset)
+
+    async def read(self, fd: int, size: int) -> bytes:
+        buf = bytearray(size)
+        count = await self.run(self.os.read_into, fd, buf)
+        return bytes(buf[0:max(count, 0)])
+
+    async def write(self, fd: int, data: bytes) -> int:
+        return await self.run(self.os.write_bytes, fd, data)
+
+    async def read_at(self, fd: int, size: int, offset: int) -> bytes:
+        buf = bytearray(size)
+        count = await self.run(self.os.read_at, fd, buf, offset)
+        return bytes(buf[0:max(count, 0)])
+
+    async def write_at(self, fd: int, data: bytes, offset: int) -> int:
+        return await self.run(self.os.write_at, fd, data, offset)
+
+
+# socket of the fs server and size of its reads
+SERVER_SOCKET = "fs.sock"
+SERVER_RECV_SIZE = 1 << 16
+# request: payload length, opcode; reply: payload length, status
+REQUEST_STRUCT = struct.Struct('<IB')
+REPLY_STRUCT = struct.Struct('<IB')
+REPLY_OK = 0
+REPLY_ERROR = 1
+# served OS operations, the opcode of each is its position
+SERVER_OPS = ('create', 'mkdir', 'rmdir', 'link', 'unlink', 'truncate', 'stat', 'listdir',
+    'open', 'close', 'seek', 'read', 'write', 'read_at', 'write_at', 'flush', 'sync', 'stats',
+    'preallocate')
+SERVER_OPCODES = {name: opcode for opcode, name in enumerate(SERVER_OPS)}
+# arguments and results are tagged values
+VALUE_INT = struct.Struct('<q')
+VALUE_FLOAT = struct.Struct('<d')
+VALUE_LEN = struct.Struct('<I')
+
+def encode_value(value, out: bytearray) -> None:
+    if value is None:
+        out += b'n'
+    elif isinstance(value, int):
+        out += b'i'
+        out += VALUE_INT.pack(value)
+    elif isinstance(value, float):
+        out += b'f'
+        out += VALUE_FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b's'
+        out += VALUE_LEN.pack(len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += b'b'
+        out += VALUE_LEN.pack(len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b'l'
+        out += VALUE_LEN.pack(len(value))
+        for item in value:
+            encode_value(item, out)
+    elif isinstance(value, dict):
+        out += b'd'
+        out += VALUE_LEN.pack(len(value))
+        for key, item in value.items():
+            encode_value(key, out)
+            encode_value(item, out)
+    else:
+        raise TypeError(f"Cannot send {type(value).__name__}")
+
+def decode_value(data, pos: int = 0):
+    # value at pos and the position after it
+    tag = data[pos]
+    pos += 1
+    if tag == ord('n'):
+        return None, pos
+    if tag == ord('i'):
+        return VALUE_INT.unpack_from(data, pos)[0], pos + VALUE_INT.size
+    if tag == ord('f'):
+        return VALUE_FLOAT.unpack_from(data, pos)[0], pos + VALUE_FLOAT.size
+    count, = VALUE_LEN.unpack_from(data, pos)
+    pos += VALUE_LEN.size
+    if tag == ord('s'):
+        return bytes(data[pos:pos + count]).decode(), pos + count
+    if tag == ord('b'):
+        return bytes(data[pos:pos + count]), pos + count
+    if tag == ord('l'):
+        items = list()
+        for _ in range(count):
+            item, pos = decode_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == ord('d'):
+        items = dict()
+        for _ in range(count):
+            key, pos = decode_value(data, pos)
+            items[key], pos = decode_value(data, pos)
+        return items, pos
+    raise ValueError(f"Unknown value tag {tag}")
+
+class ServerHandler(socketserver.BaseRequestHandler):
+    # one client connection: requests run in the order they came, replies to
+    # all requests found in one read go back in one write
+    def setup(self) -> None:
+        self.os: OS = self.server.os
+        # descriptors opened by this client, closed when it goes away
+        self.fds: set[int] = set()
+
+    def handle(self) -> None:
+        buf = bytearray()
+        while True:
+            data = self.request.recv(SERVER_RECV_SIZE)
+            if not data:
+                return
+            buf += data
+            replies = bytearray()
+            pos = 0
+            while len(buf) - pos >= REQUEST_STRUCT.size:
+                size, opcode = REQUEST_STRUCT.unpack_from(buf, pos)
+                start = pos + REQUEST_STRUCT.size
+                if len(buf) < start + size:
+                    break
+                self.dispatch(opcode, buf[start:start + size], replies)
+                pos = start + size
+            del buf[0:pos]
+            if replies:
+                self.request.sendall(replies)
+
+    def finish(self) -> None:
+        for fd in self.fds:
+            self.os.close(fd)
+
+    def dispatch(self, opcode: int, payload: bytes, replies: bytearray) -> None:
+        body = bytearray()
+        name = SERVER_OPS[opcode] if opcode < len(SERVER_OPS) else str(opcode)
+        try:
+            if opcode >= len(SERVER_OPS):
+                raise ValueError(f"Unknown opcode {opcode}")
+            args, _ = decode_value(payload)
+            # calls on descriptors are checked here, the rest go straight to OS
+            func = getattr(self, "op_" + name, None) or getattr(self.os, name)
+            encode_value(func(*args), body)
+            status = REPLY_OK
+        except Exception as error:
+            log_fail(f"Request '{name}' failed: {error}")
+            body = bytearray(str(error).encode())
+            status = REPLY_ERROR
+        replies += REPLY_STRUCT.pack(len(body), status)
+        replies += body
+
+    def owned(self, fd: int) -> int:
+        if fd not in self.fds:
+            raise ValueError(f"fd={fd} is not open on this connection")
+        return fd
+
+    def op_open(self, path: str) -> int:
+        fd = self.os.open(path)
+        if fd >= 0:
+            self.fds.add(fd)
+        return fd
+
+    def op_close(self, fd: int) -> None:
+        self.os.close(self.owned(fd))
+        self.fds.discard(fd)
+
+    def op_seek(self, fd: int, offset: int) -> None:
+        self.os.seek(self.owned(fd), offset)
+
+    def op_read(self, fd: int, size: int) -> Optional[bytes]:
+        buf = bytearray(size)
+        count = self.os.read_into(self.owned(fd), buf)
+        return bytes(buf[0:count]) if count >= 0 else None
+
+    def op_write(self, fd: int, data: bytes) -> int:
+        return self.os.write_bytes(self.owned(fd), data)
+
+    def op_read_at(self, fd: int, size: int, offset: int) -> Optional[bytes]:
+        buf = bytearray(size)
+        count = self.os.read_at(self.owned(fd), buf, offset)
+        return bytes(buf[0:count]) if count >= 0 else None
+
+    def op_write_at(self, fd: int, data: bytes, offset: int) -> int:
+        return self.os.write_at(self.owned(fd), data, offset)
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # a mounted OS shared by local processes, a thread per connection
+    daemon_threads = True
+
+    def __init__(self, shared: OS, path: str = SERVER_SOCKET) -> None:
+        self.os = shared
+        super().__init__(path, ServerHandler)
+        # the socket gives full access to the image, keep it to the owner
+        os.chmod(path, 0o600)
+
+class ClientOps:
+    # OS operations of a Client, each becomes one request
+    def create(self, path: str) -> None:
+        return self.call('create', path)
+
+    def mkdir(self, path: str) -> None:
+        return self.call('mkdir', path)
+
+    def rmdir(self, path: str) -> None:
+        return self.call('rmdir', path)
+
+    def link(self, path1: str, path2: str) -> None:
+        return self.call('link', path1, path2)
+
+    def unlink(self, path: str) -> None:
+        return self.call('unlink', path)
+
+    def truncate(self, path: str, size: int) -> None:
+        return self.call('truncate', path, size)
+
+    def preallocate(self, path: str, size: int) -> None:
+        return self.call('preallocate', path, size)
+
+    def stat(self, path: str) -> Optional[dict]:
+        return self.call('stat', path)
+
+    def listdir(self, path: str = "") -> Optional[list[str]]:
+        return self.call('listdir', path)
+
+    def open(self, path: str) -> int:
+        return self.call('open', path)
+
+    def close(self, fd: int) -> None:
+        return self.call('close', fd)
+
+    def seek(self, fd: int, offset: int) -> None:
+        return self.call('seek', fd, offset)
+
+    def read(self, fd: int, size: int) -> Optional[bytes]:
+        return self.call('read', fd, size)
+
+    def write(self, fd: int, data: bytes) -> int:
+        return self.call('write', fd, data)
+
+    def read_at(self, fd: int, size: int, offset: int) -> Optional[bytes]:
+        return self.call('read_at', fd, size, offset)
+
+    def write_at(self, fd: int, data: bytes, offset: int) -> int:
+        return self.call('write_at', fd, data, offset)
+
+    def flush(self) -> None:
+        return self.call('flush')
+
+    def sync(self) -> None:
+        return self.call('sync')
+
+    def stats(self) -> dict:
+        return self.call('stats')
+
+def request(name: str, args: tuple) -> bytearray:
+    payload = bytearray()
+    encode_value(args, payload)
+    return bytearray(REQUEST_STRUCT.pack(len(payload), SERVER_OPCODES[name])) + payload
+
+class Client(ClientOps):
+    # connection to a Server, calls wait for their reply unless pipelined
+    def __init__(self, path: str = SERVER_SOCKET) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rb')
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.disconnect()
+
+    def disconnect(self) -> None:
+        # the server closes descriptors left open
+        self.file.close()
+        self.sock.close()
+
+    def call(self, name: str, *args):
+        self.sock.sendall(request(name, args))
+        return self.reply()
+
+    def reply(self):
+        header = self.file.read(REPLY_STRUCT.size)
+        if len(header) < REPLY_STRUCT.size:
+            raise ConnectionError("Server closed the connection")
+        size, status = REPLY_STRUCT.unpack(header)
+        body = self.file.read(size)
+        if status != REPLY_OK:
+            log_fail(f"Server: {body.decode()}")
+            return None
+        return decode_value(body)[0]
+
+    def pipeline(self) -> "Pipeline":
+        return Pipeline(self)
+
+class Pipeline(ClientOps):
+    # queued calls of a Client sent in one write, run sends them and
+    # returns their results in order
+    def __init__(self, client: Client) -> None:
+        self.client = client
+        self.requests = bytearray()
+        self.count = 0
+
+    def call(self, name: str, *args) -> None:
+        self.requests += request(name, args)
+        self.count += 1
+
+    def run(self) -> list:
+        self.client.sock.sendall(self.requests)
+        results = [self.client.reply() for _ in range(self.count)]
+        self.requests = bytearray()
+        self.count = 0
+        return results
+
+def serve(image: str, path: str = SERVER_SOCKET, use_mmap: bool = False) -> int:
+    shared = OS()
+    shared.mount(image, use_mmap)
+    if not shared.fs_initialized():
+        return 1
+    if os.path.exists(path):
+        try:
+            Client(path).disconnect()
+            log_fail(f"Another server is listening on '{path}'")
+            shared.unmount()
+            return 1
+        except ConnectionRefusedError:
+            # left behind by a server that did not shut down
+            os.remove(path)
+    server = Server(shared, path)
+    # stop on SIGTERM like on Ctrl-C, so dirty data is flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    log_info(f"Serving '{image}' on '{path}'")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        shared.unmount()
+    log_info(f"Server on '{path}' stopped")
+    return 0
+
 
 class Shell(cmd.Cmd):
     intro = 'Welcome!  Type help or ? to list commands.\n'
@@ -884,13 +3574,78 @@ class Shell(cmd.Cmd):
     file = None
     os = OS()
 
+    def default(self, line):
+        return log_fail(f"Unknown command '{line}'")
+
     def do_mkfs(self, arg):
-        'Make FileSystem with arg as number of descriptors'
-        self.os.mkfs(arg)
+        'Make FileSystem with arg1 as number of descriptors, arg2 image ("fs"), arg3 its size (K, M, G suffixes) and arg4 block size'
+        args = parse(arg)
+        if len(args) == 0:
+            return log_fail('Number of descriptors expected!')
+        try:
+            sizes = [parse_size(a) for a in args[2:4]]
+        except ValueError as error:
+            return log_fail(error)
+        self.os.mkfs(args[0], args[1] if len(args) > 1 else "fs", *sizes)
 
     def do_mount(self, arg):
-        'Mount FileSystem with arg as name of the file, containing the filesystem'
-        self.os.mount(arg)
+        'Mount FileSystem with arg1 as name of the file, containing the filesystem, arg2 "mmap" maps it into memory'
+        args = parse(arg)
+        if len(args) == 0:
+            return log_fail('Image name expected!')
+        self.os.mount(args[0], len(args) > 1 and args[1] == 'mmap')
+
+    def do_cache(self, arg):
+        'Show block cache counters, arg sets cache memory budget in bytes'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        args = parse(arg)
+        self.os.cache(args[0] if len(args) > 0 else None)
+
+    def do_stats(self, arg):
+        'Show session counters and latencies, "json [FILE]" dumps them as JSON, "reset" clears them'
+        args = parse(arg)
+        if len(args) > 0 and args[0] == 'reset':
+            self.os.reset_stats()
+            return
+        if len(args) > 0 and args[0] == 'json':
+            self.os.dump_stats(args[1] if len(args) > 1 else None)
+            return
+        self.os.print_stats()
+
+    def do_log(self, arg):
+        'Set log level: fail, info or debug'
+        args = parse(arg)
+        if len(args) == 0 or args[0] not in LOG_LEVELS:
+            return log_fail(f"Log level expected, one of {', '.join(LOG_LEVELS)}")
+        set_log_level(LOG_LEVELS[args[0]])
+
+    def do_flush(self, arg):
+        'Write dirty blocks and metadata to the image'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        self.os.flush()
+
+    def do_sync(self, arg):
+        'Write dirty blocks and metadata to the image and sync it to disk'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        self.os.sync()
+
+    def do_unmount(self, arg):
+        'Flush and close mounted FileSystem'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        self.os.unmount()
+
+    def do_convert(self, arg):
+        'Convert v1, v2, v3 or v4 image arg1 to the current format, writing to arg2 or in place'
+        args = parse(arg)
+        if len(args) == 0:
+            return log_fail('Image name expected!')
+        if self.os.fs_initialized():
+            return log_fail('Unmount the filesystem first!')
+        convert(*args[0:2])
 
     def do_ls(self, arg):
         'List files in current directory'
@@ -905,6 +3660,24 @@ class Shell(cmd.Cmd):
         args = parse(arg)
         self.os.symlink(args[0], args[1])
 
+    def do_mkdir(self, arg):
+        'Create directory'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        self.os.mkdir(arg)
+
+    def do_rmdir(self, arg):
+        'Remove empty directory'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        self.os.rmdir(arg)
+
+    def do_cd(self, arg):
+        'Change working directory'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        self.os.cd(arg)
+
     def do_link(self, arg):
         'Create hard link: arg2 links to arg1'
         if not self.os.fs_initialized():
@@ -943,19 +3716,43 @@ class Shell(cmd.Cmd):
         args = parse(arg)
         self.os.truncate(args[0], args[1])
 
+    def do_preallocate(self, arg):
+        'Reserve zeroed blocks for file arg1 up to arg2 bytes in as few runs as possible'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        args = parse(arg)
+        self.os.preallocate(args[0], args[1])
+
+    def do_defrag(self, arg):
+        'Move blocks of file arg, or of all files, into contiguous runs'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        args = parse(arg)
+        self.os.defrag(args[0] if len(args) > 0 else "")
+
+    def do_fsck(self, arg):
+        'Check the filesystem for consistency, arg "repair" fixes what is found'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        args = parse(arg)
+        self.os.fsck(len(args) > 0 and args[0] == 'repair')
+
     def do_open(self, arg):
         'Open file'
         if not self.os.fs_initialized():
             return log_fail('No filesystem initialized!')
         args = parse(arg)
-        self.os.open(args[0])
+        fd = self.os.open(args[0])
+        if fd >= 0:
+            print(f"fd={fd}")
 
     def do_close(self, arg):
         'Close file'
         if not self.os.fs_initialized():
             return log_fail('No filesystem initialized!')
         args = parse(arg)
-        self.os.close(args[0])
+        if self.os.close(args[0]) == 0:
+            print("Closed!")
 
     def do_write(self, arg):
         'Write to file'
@@ -978,9 +3775,24 @@ class Shell(cmd.Cmd):
         args = parse(arg)
         self.os.seek(args[0], args[1])
 
+    def do_import(self, arg):
+        'Copy host file arg1 into the filesystem as arg2'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        args = parse(arg)
+        self.os.import_file(args[0], args[1])
+
+    def do_export(self, arg):
+        'Copy file arg1 out of the filesystem to host file arg2'
+        if not self.os.fs_initialized():
+            return log_fail('No filesystem initialized!')
+        args = parse(arg)
+        self.os.export_file(args[0], args[1])
+
     def do_bye(self, arg):
         'Stop recording, close the window, and exit:  BYE'
         print('Bye!')
+        self.os.unmount()
         self.close()
         return True
 
@@ -993,5 +3805,127 @@ def parse(arg):
     'Convert a series of zero or more numbers to an argument tuple'
     return tuple(map(str, arg.split()))
 
+def parse_size(arg: str) -> int:
+    # bytes with an optional binary K, M, G or T suffix
+    units = 'KMGT'
+    text = arg.strip().upper().removesuffix('B').removesuffix('I')
+    scale = 1
+    if text and text[-1] in units:
+        scale = 1 << 10*(units.index(text[-1]) + 1)
+        text = text[:-1]
+    try:
+        return int(float(text) * scale)
+    except ValueError:
+        raise ValueError(f"Wrong size '{arg}'") from None
+
+def run_script(file, image: str, flush_every: int = -1, use_mmap: bool = False) -> int:
+    # flush_every: -1 keeps the usual write-back limits, 0 flushes only at
+    # the end or when the journal fills, K flushes after every K commands
+    shell = Shell()
+    if flush_every < 0:
+        shell.os.mount(image, use_mmap)
+    else:
+        shell.os.mount(image, use_mmap, dirty_limit=math.inf, flush_interval=math.inf)
+    if not shell.os.fs_initialized():
+        return 1
+    lines = iter(file)
+    # write takes the next line of the script as is, blank or not, as its data
+    shell.os.input = lambda prompt: next(lines, "").removesuffix("\n")
+    ops = 0
+    failed = failures()
+    start = time.monotonic()
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        ops += 1
+        if shell.onecmd(line):
+            break
+        if flush_every > 0 and ops % flush_every == 0:
+            shell.os.flush()
+    if shell.os.fs_initialized():
+        shell.os.unmount()
+    elapsed = time.monotonic() - start
+    failed = failures() - failed
+    log_info(f"Executed {ops} commands in {elapsed:.3f}s ({ops/max(elapsed, 1e-9):.0f} ops/s), {failed} failed")
+    return 1 if failed else 0
+
+def mkfs(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='fs.py mkfs', description='Make a filesystem image')
+    parser.add_argument('image')
+    parser.add_argument('size', type=parse_size, help='image size in bytes, K, M, G or T suffixes allowed')
+    parser.add_argument('--block-size', type=parse_size, default=MKFS_BLOCK_SIZE)
+    parser.add_argument('--descriptors', type=int,
+        help=f'number of descriptors, one per {MKFS_BYTES_PER_DESC} bytes by default')
+    args = parser.parse_args(argv)
+    n = args.descriptors or max(MKFS_MIN_DESCRIPTORS, args.size // MKFS_BYTES_PER_DESC)
+    start = time.monotonic()
+    fs = FS()
+    fs.mkfs(n, args.image, size=args.size, block_size=args.block_size)
+    if not fs.initialized:
+        return 1
+    fs.unmount()
+    log_info(f"Made '{args.image}' in {time.monotonic() - start:.3f}s")
+    return 0
+
+def defrag(image: str, path: str = "") -> int:
+    # offline defrag, the image must not be mounted by anyone else
+    shell = Shell()
+    shell.os.mount(image)
+    if not shell.os.fs_initialized():
+        return 1
+    shell.os.defrag(path)
+    shell.os.unmount()
+    return 0
+
+def fsck(image: str, repair: bool = False) -> int:
+    # exit codes like e2fsck: 0 - clean, 1 - errors repaired, 4 - errors left
+    shell = Shell()
+    shell.os.mount(image)
+    if not shell.os.fs_initialized():
+        return 8
+    problems = shell.os.fsck(repair)
+    shell.os.unmount()
+    if problems == 0:
+        return 0
+    return 1 if repair else 4
+
+def main() -> int:
+    if len(sys.argv) > 2 and sys.argv[1] == 'convert':
+        return 0 if convert(*sys.argv[2:4]) else 1
+    if len(sys.argv) > 2 and sys.argv[1] == 'defrag':
+        return defrag(*sys.argv[2:4])
+    if len(sys.argv) > 1 and sys.argv[1] == 'mkfs':
+        return mkfs(sys.argv[2:])
+    if len(sys.argv) > 2 and sys.argv[1] == 'fsck':
+        return fsck(sys.argv[2], '--repair' in sys.argv[3:])
+    parser = argparse.ArgumentParser(description='Manipulate fs images')
+    parser.add_argument('--image', help='image to mount on start')
+    parser.add_argument('--script', help='run commands from file ("-" for stdin) instead of the shell')
+    parser.add_argument('--flush-every', type=int, default=-1, metavar='K',
+        help='script mode: flush after every K commands, 0 - only at the end or when the journal fills')
+    parser.add_argument('--serve', nargs='?', const=SERVER_SOCKET, metavar='SOCKET',
+        help=f'share the image with other processes over a Unix socket ("{SERVER_SOCKET}")')
+    parser.add_argument('--mmap', action='store_true', help='map the image into memory')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info')
+    args = parser.parse_args()
+    set_log_level(LOG_LEVELS[args.log_level])
+    if args.serve is not None:
+        if args.image is None:
+            parser.error('--serve requires --image')
+        return serve(args.image, args.serve, args.mmap)
+    if args.script is not None:
+        if args.image is None:
+            parser.error('--script requires --image')
+        if args.script == '-':
+            return run_script(sys.stdin, args.image, args.flush_every, args.mmap)
+        with open(args.script) as file:
+            return run_script(file, args.image, args.flush_every, args.mmap)
+    shell = Shell()
+    if args.image is not None:
+        shell.os.mount(args.image, args.mmap)
+    shell.cmdloop()
+    return 0
+
 if __name__ == '__main__':
-    Shell().cmdloop()
+    sys.exit(main())
@@ -0,0 +1,46 @@
+# Shared fixtures and helpers: scratch images in a temporary directory, quiet logging.
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fs
+
+
+def contents(shell: fs.OS, path: str) -> bytes:
+    # whole file read back through the OS interface
+    size = shell.stat(path)['size']
+    fd = shell.open(path)
+    buf = bytearray(size)
+    assert shell.read_at(fd, buf, 0) == size
+    shell.close(fd)
+    return bytes(buf)
+
+@pytest.fixture(autouse=True)
+def quiet():
+    level = fs.LOG_LEVEL
+    fs.set_log_level(fs.LOG_FAIL)
+    yield
+    fs.set_log_level(level)
+
+@pytest.fixture
+def image(tmp_path) -> str:
+    return str(tmp_path / 'test.img')
+
+@pytest.fixture
+def make_os(image):
+    # formats the image and mounts it again with the given mount options
+    made = list()
+
+    def make(size: int = 1 << 20, block_size: int = 512, descriptors: int = 64, **options) -> fs.OS:
+        shell = fs.OS()
+        shell.fs.mkfs(descriptors, image, size=size, block_size=block_size)
+        shell.unmount()
+        shell.mount(image, **options)
+        assert shell.fs_initialized()
+        made.append(shell)
+        return shell
+    yield make
+    for shell in made:
+        if shell.fs_initialized():
+            shell.unmount()
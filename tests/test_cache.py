@@ -0,0 +1,48 @@
+import threading
+
+import fs
+
+
+def finishes(func, seconds: float = 10.0) -> bool:
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    return not thread.is_alive()
+
+def test_partial_writes_with_tiny_cache(make_os):
+    shell = make_os(cache_size=64)
+    fd = shell.open('f')
+    data = bytearray()
+    for i in range(200):
+        chunk = bytes([i % 251]) * 1000
+        assert shell.write_at(fd, chunk, i * 1536 + 7) == len(chunk)
+        end = i * 1536 + 7 + len(chunk)
+        data[len(data):end] = bytes(end - len(data))
+        data[end - len(chunk):end] = chunk
+    buf = bytearray(len(data))
+    assert shell.read_at(fd, buf, 0) == len(data)
+    assert buf == data
+
+def test_metadata_writes_do_not_spin_when_cache_is_pinned(make_os):
+    # pinned indirect blocks fill the cache, the block merged into must not be dropped
+    shell = make_os(cache_size=64)
+    fd = shell.open('f')
+    for i in range(200):
+        shell.write_at(fd, b'x' * 1000, i * 1536 + 7)
+    shell.flush()
+    assert finishes(lambda: shell.truncate('f', 1000))
+    assert shell.stat('f')['size'] == 1024
+
+def test_deferred_flush_with_tiny_cache(make_os, image):
+    # script mode with --flush-every 0 pins metadata blocks until the journal fills
+    shell = make_os(size=4 << 20, cache_size=4096, block_size=4096, dirty_limit=float('inf'),
+        flush_interval=float('inf'))
+    fd = shell.open('f')
+    assert finishes(lambda: [shell.write_at(fd, b'y' * 100, i * 4096 * 5) for i in range(300)])
+    shell.close(fd)
+    shell.unmount()
+    shell.mount(image, cache_size=4096)
+    fd = shell.open('f')
+    buf = bytearray(100)
+    assert shell.read_at(fd, buf, 299 * 4096 * 5) == 100
+    assert buf == b'y' * 100
@@ -0,0 +1,137 @@
+import random, sys, threading
+
+import fs
+from conftest import contents
+
+
+THREADS = 8
+ROUNDS = 40
+
+def worker(shell: fs.OS, n: int, files: dict, errors: list) -> None:
+    # each thread works in its own directory and links into a shared one
+    rand = random.Random(n)
+    try:
+        shell.mkdir(f'/t{n}')
+        for k in range(ROUNDS):
+            path = f'/t{n}/f{k}'
+            data = rand.randbytes(rand.randrange(1, 3000))
+            fd = shell.open(path)
+            assert shell.write_at(fd, data, 0) == len(data)
+            shell.close(fd)
+            files[path] = data
+            if k % 3 == 0:
+                shell.mkdir(f'/t{n}/d{k}')
+                shell.link(path, f'/t{n}/d{k}/g')
+                files[f'/t{n}/d{k}/g'] = data
+            if k % 4 == 1:
+                shell.link(path, f'/shared/t{n}f{k}')
+                files[f'/shared/t{n}f{k}'] = data
+            if k % 5 == 2:
+                shell.unlink(path)
+                del files[path]
+    except Exception as error:
+        errors.append(error)
+
+def test_parallel_writes_links_and_unlinks(make_os, image):
+    shell = make_os(size=8 << 20, descriptors=1024)
+    shell.mkdir('/shared')
+    files: list[dict] = [dict() for _ in range(THREADS)]
+    errors: list = list()
+    threads = [threading.Thread(target=worker, args=(shell, n, files[n], errors))
+        for n in range(THREADS)]
+    # switch threads often so that operations interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+    finally:
+        sys.setswitchinterval(interval)
+    assert not any(thread.is_alive() for thread in threads)
+    assert errors == []
+    expected = {path: data for model in files for path, data in model.items()}
+    assert sorted(shell.listdir('/shared')[2:]) == \
+        sorted(path[8:] for path in expected if path.startswith('/shared/'))
+    for path, data in expected.items():
+        assert contents(shell, path) == data
+    assert shell.fsck() == 0
+    shell.unmount()
+    shell.mount(image)
+    for path, data in expected.items():
+        assert contents(shell, path) == data
+    assert shell.fsck() == 0
+
+def racing_lookup(shell: fs.OS, method: str, path: str, monkeypatch) -> None:
+    # a lookup from another thread runs while the entry is being removed
+    change = getattr(shell.fs, method)
+
+    def slow(*args):
+        thread = threading.Thread(target=shell.lookup, args=(path, False))
+        thread.start()
+        thread.join(10)
+        return change(*args)
+    monkeypatch.setattr(shell.fs, method, slow)
+
+def test_unlink_drops_entries_cached_during_it(make_os, monkeypatch):
+    shell = make_os()
+    shell.create('x')
+    racing_lookup(shell, 'unlink', 'x', monkeypatch)
+    shell.unlink('x')
+    assert shell.lookup('x', False)[1] is None
+    shell.create('y')
+    fd = shell.open('x')
+    assert shell.write_at(fd, b'x', 0) == 1
+    shell.close(fd)
+    assert shell.stat('y')['size'] == 0
+
+def test_rmdir_drops_entries_cached_during_it(make_os, monkeypatch):
+    shell = make_os()
+    shell.mkdir('d')
+    racing_lookup(shell, 'rmdir', 'd', monkeypatch)
+    shell.rmdir('d')
+    assert shell.lookup('d', False)[1] is None
+    assert shell.stat('d') is None
+
+def test_write_backs_out_when_another_file_takes_the_last_blocks(make_os, monkeypatch):
+    shell = make_os()
+    fd = shell.open('f')
+    free = shell.fs.bitmap.free
+    allocate = shell.fs.bitmap.allocate
+    calls = list()
+
+    def racing() -> int:
+        # the second indirect block is gone by the time it is allocated
+        calls.append(1)
+        return allocate() if len(calls) == 1 else -1
+    monkeypatch.setattr(shell.fs.bitmap, 'allocate', racing)
+    # the first block behind the double indirect one needs two indirect blocks
+    offset = (fs.DIRECT_BLOCKS + fs.pointers_per_block(512)) * 512
+    assert shell.write_at(fd, b'x', offset) == 0
+    assert len(calls) == 2
+    monkeypatch.setattr(shell.fs.bitmap, 'allocate', allocate)
+    assert shell.fs.bitmap.free == free
+    assert shell.stat('f')['nblock'] == 0
+    shell.close(fd)
+    assert shell.fsck() == 0
+
+def test_stats_count_every_thread():
+    stats = fs.Stats()
+
+    def count() -> None:
+        for _ in range(1000):
+            stats.count('ops')
+            stats.observe('op', 1e-5)
+    for _ in range(2):
+        threads = [threading.Thread(target=count) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    # the first threads are gone, their shards are folded in when the main thread starts counting
+    stats.count('ops')
+    report = stats.report()
+    assert report['counters']['ops'] == 2 * THREADS * 1000 + 1
+    assert report['latency']['op']['count'] == 2 * THREADS * 1000
+    assert len(stats.shards) == 1
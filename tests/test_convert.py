@@ -0,0 +1,63 @@
+import os, shutil
+
+import fs
+from conftest import contents
+
+
+# v1 sample image of the repository: 64-byte blocks, 'm' and 'n' link one file of six blocks
+V1_SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fs')
+
+def v2_image(path: str, data: bytes) -> None:
+    # 64-byte blocks, data in blocks 0-3 and 5-6, block 4 is the single indirect one
+    block_size, desc_num, blocks_num = 64, 4, 16
+    head = fs.V3_SUPERBLOCK_STRUCT.pack(fs.FS_MAGIC, fs.V2_VERSION, 0, desc_num,
+        blocks_num, block_size).ljust(fs.SUPERBLOCK_SIZE, b'\x00')
+    links = [(b'.', 0), (b'..', 0), (b'big', 1), (b'', fs.NO_DESC)]
+    empty = [fs.NO_BLOCK] * fs.V2_BLOCKS_MAP_SIZE
+    descs = [fs.V2_DESC_STRUCT.pack(b'd', 2, 0, 0, *empty),
+        fs.V2_DESC_STRUCT.pack(b'r', 1, len(data), 7, 0, 1, 2, 3, 4),
+        fs.V2_DESC_STRUCT.pack(b'-', 0, 0, 0, *empty),
+        fs.V2_DESC_STRUCT.pack(b'-', 0, 0, 0, *empty)]
+    blocks = bytearray(blocks_num * block_size)
+    for i, block in enumerate((0, 1, 2, 3, 5, 6)):
+        blocks[block*block_size:(block + 1)*block_size] = data[i*block_size:(i + 1)*block_size]
+    blocks[4*block_size:5*block_size] = fs.pack_pointers([5, 6], block_size // fs.PTR_SIZE)
+    with open(path, 'wb') as file:
+        file.write(head)
+        file.write(b''.join(fs.DIRENT_STRUCT.pack(*link) for link in links))
+        file.write(b''.join(descs))
+        file.write(bytes([0x7f, 0]))
+        file.write(blocks)
+
+def test_convert_v2(image):
+    data = bytes(range(256)) + bytes(range(128))
+    v2_image(image, data)
+    shell = fs.OS()
+    shell.mount(image)
+    assert not shell.fs_initialized()
+    assert fs.convert(image)
+    shell.mount(image)
+    assert shell.stat('big')['nblock'] == 7
+    fd = shell.open('big')
+    buf = bytearray(len(data))
+    assert shell.read_at(fd, buf, 0) == len(data)
+    assert buf == data
+    shell.close(fd)
+    assert shell.fsck() == 0
+    shell.unmount()
+
+def test_convert_v1(image):
+    shutil.copy(V1_SAMPLE, image)
+    assert fs.convert(image)
+    shell = fs.OS()
+    shell.mount(image)
+    assert sorted(shell.listdir('/')[2:]) == ['b', 'm', 'n']
+    blocks = [b'Football' + b'football' * 7, b'Keyboard' + b'keyboard' * 7, b'12345678' * 8,
+        b'qwertyui' * 8, b'Surprise' * 8, b'Umbrella' + b'umbrella' * 7]
+    data = b''.join(blocks)
+    assert contents(shell, 'm') == data
+    assert shell.stat('m')['nlink'] == 2
+    assert shell.stat('n')['id'] == shell.stat('m')['id']
+    assert contents(shell, 'b') == b'0' * 64
+    assert shell.fsck() == 0
+    shell.unmount()
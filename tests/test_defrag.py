@@ -0,0 +1,62 @@
+import random
+
+import fs
+from conftest import contents
+
+
+def fragmented(shell: fs.OS, names: list[str]) -> dict[str, bytearray]:
+    # appends to the files in turn interleave their blocks
+    rand = random.Random(5)
+    fds = {name: shell.open(name) for name in names}
+    data = {name: bytearray() for name in names}
+    for _ in range(600):
+        name = rand.choice(names)
+        chunk = rand.randbytes(rand.randrange(1, 1500))
+        assert shell.write_bytes(fds[name], chunk) == len(chunk)
+        data[name] += chunk
+    for fd in fds.values():
+        shell.close(fd)
+    return data
+
+def test_defrag_keeps_contents(make_os, image):
+    shell = make_os(size=8 << 20)
+    names = [f'f{i}' for i in range(4)]
+    data = fragmented(shell, names)
+    # a hole stays a hole, a hard link sees the moved blocks
+    fd = shell.open('f0')
+    assert shell.write_at(fd, b'xyz', len(data['f0']) + 100000) == 3
+    data['f0'] += bytes(100000) + b'xyz'
+    shell.link('f1', 'h')
+    free = shell.fs.bitmap.free
+    assert all(shell.fs.fragments(shell.lookup(name)[1]) > 1 for name in names)
+    shell.defrag()
+    assert shell.fs.bitmap.free == free
+    for name in names:
+        assert contents(shell, name) == data[name]
+    assert contents(shell, 'h') == data['f1']
+    # the descriptor still open reads the moved blocks
+    buf = bytearray(len(data['f0']))
+    assert shell.read_at(fd, buf, 0) == len(buf)
+    assert buf == data['f0']
+    shell.close(fd)
+    assert all(shell.fs.fragments(shell.lookup(name)[1]) == 1 for name in names[1:])
+    assert shell.fsck() == 0
+    shell.unmount()
+    shell.mount(image)
+    for name in names:
+        assert contents(shell, name) == data[name]
+    assert shell.fsck() == 0
+
+def test_offline_defrag_of_one_file(make_os, image):
+    shell = make_os(size=8 << 20)
+    names = ['a', 'b']
+    data = fragmented(shell, names)
+    before = shell.fs.fragments(shell.lookup('b')[1])
+    shell.unmount()
+    assert fs.defrag(image, 'a') == 0
+    shell.mount(image)
+    assert shell.fs.fragments(shell.lookup('a')[1]) == 1
+    assert shell.fs.fragments(shell.lookup('b')[1]) == before
+    for name in names:
+        assert contents(shell, name) == data[name]
+    assert shell.fsck() == 0
@@ -0,0 +1,57 @@
+import random
+
+import fs
+from conftest import contents
+
+
+def write(shell: fs.OS, path: str, data: bytes) -> None:
+    fd = shell.open(path)
+    assert shell.write_at(fd, data, 0) == len(data)
+    shell.close(fd)
+
+def test_repair(make_os, image):
+    shell = make_os(size=4 << 20, descriptors=128)
+    rand = random.Random(1)
+    files = {path: rand.randbytes(3000) for path in ('a', 'b', 'c/x', 'd/e/y')}
+    shell.mkdir('c')
+    shell.mkdir('d')
+    shell.mkdir('d/e')
+    for path, data in files.items():
+        write(shell, path, data)
+    shell.link('a', 'c/hl')
+    assert shell.fsck() == 0
+    a = shell.lookup('a')[1]
+    b = shell.lookup('b')[1]
+    x = shell.lookup('c/x')[1]
+    e = shell.lookup('d/e')[1]
+    # a leaked block, a used block marked free, a block shared by two files
+    shell.fs.bitmap[shell.fs.blocks_number - 3] = 1
+    shell.fs.bitmap[a.data[-1]] = 0
+    shell.fs.remap_block(b, 0, a.data[0])
+    shell.fs.write_descriptor(b)
+    # wrong counts
+    shell.fs.nlinks[a.index] += 3
+    shell.fs.write_descriptor(a)
+    shell.fs.nblocks[x.index] += 1
+    shell.fs.write_descriptor(x)
+    # an orphaned file and an orphaned directory with a subtree
+    shell.fs.remove_entry(shell.lookup('c')[1], 'x')
+    shell.fs.remove_entry(shell.lookup('d')[1], 'e')
+    assert shell.fsck() >= 7
+    assert shell.fsck(True) >= 7
+    assert shell.fsck() == 0
+    lost = sorted(name for name in shell.listdir(f'/{fs.LOST_FOUND}') if name not in ('.', '..'))
+    assert lost == sorted([f'#{x.index}', f'#{e.index}'])
+    assert shell.stat('a')['nlink'] == 2
+    assert contents(shell, 'a') == files['a']
+    assert contents(shell, 'c/hl') == files['a']
+    # the later owner of the shared block gets a copy of it
+    assert contents(shell, 'b') == files['a'][:512] + files['b'][512:]
+    assert contents(shell, f'/{fs.LOST_FOUND}/#{x.index}') == files['c/x']
+    assert contents(shell, f'/{fs.LOST_FOUND}/#{e.index}/y') == files['d/e/y']
+    assert shell.stat(f'/{fs.LOST_FOUND}/#{e.index}/..')['id'] == \
+        shell.stat(f'/{fs.LOST_FOUND}')['id']
+    shell.unmount()
+    shell.mount(image)
+    assert shell.fsck() == 0
+    assert contents(shell, 'a') == files['a']
@@ -0,0 +1,32 @@
+import fs
+
+
+def test_block_size_is_per_filesystem(tmp_path):
+    # formatting a second image must not change the geometry of the first
+    a, b = fs.OS(), fs.OS()
+    a.fs.mkfs(16, str(tmp_path / 'a.img'), size=64 << 10, block_size=64)
+    a.unmount()
+    a.mount(str(tmp_path / 'a.img'))
+    b.fs.mkfs(16, str(tmp_path / 'b.img'), size=1 << 20, block_size=4096)
+    assert (a.fs.block_size, b.fs.block_size) == (64, 4096)
+    data = bytes(range(220))
+    fd = a.open('f')
+    assert a.write_at(fd, data, 0) == len(data)
+    a.close(fd)
+    a.unmount()
+    a.mount(str(tmp_path / 'a.img'))
+    assert a.fs.block_size == 64
+    fd = a.open('f')
+    buf = bytearray(len(data))
+    assert a.read_at(fd, buf, 0) == len(data)
+    assert buf == data
+    a.unmount()
+    b.unmount()
+
+def test_mkfs_defaults_to_the_mounted_block_size(tmp_path):
+    shell = fs.OS()
+    shell.fs.mkfs(16, str(tmp_path / 'a.img'), size=1 << 20, block_size=1024)
+    shell.fs.mkfs(16, str(tmp_path / 'b.img'), size=1 << 20)
+    assert shell.fs.block_size == 1024
+    assert fs.OS().fs.block_size == fs.BLOCK_SIZE
+    shell.unmount()
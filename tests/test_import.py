@@ -0,0 +1,29 @@
+import random
+
+import fs
+from conftest import contents
+
+
+def test_import_export_round_trip(make_os, image, tmp_path):
+    shell = make_os(size=8 << 20)
+    rand = random.Random(4)
+    # more than one transfer chunk, ending inside a block
+    data = rand.randbytes(fs.IO_CHUNK_SIZE * 2 + 1000)
+    host = tmp_path / 'host.bin'
+    host.write_bytes(data)
+    shell.mkdir('d')
+    shell.import_file(str(host), 'd/f')
+    assert contents(shell, 'd/f') == data
+    shell.export_file('d/f', str(tmp_path / 'out.bin'))
+    assert (tmp_path / 'out.bin').read_bytes() == data
+    # importing over a file replaces all of it
+    short = rand.randbytes(3000)
+    host.write_bytes(short)
+    shell.import_file(str(host), 'd/f')
+    assert contents(shell, 'd/f') == short
+    assert shell.fsck() == 0
+    shell.unmount()
+    shell.mount(image)
+    shell.export_file('d/f', str(tmp_path / 'out.bin'))
+    assert (tmp_path / 'out.bin').read_bytes() == short
+    assert shell.fsck() == 0
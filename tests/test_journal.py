@@ -0,0 +1,158 @@
+import fs
+
+
+def metadata(shell: fs.OS) -> int:
+    # everything after the journal is written in place once a transaction commits
+    return shell.fs.get_descriptor_offset(0)
+
+def crash(shell: fs.OS) -> None:
+    # drop the image without the sync that unmount does
+    shell.fs.image.close()
+    shell.fs.image = None
+    shell.fs.initialized = 0
+
+def restore(path: str, offset: int, data: bytes) -> None:
+    with open(path, 'r+b') as file:
+        file.seek(offset)
+        file.write(data)
+
+def test_committed_transactions_are_replayed(make_os, image):
+    shell = make_os()
+    shell.mkdir('d')
+    shell.flush()
+    offset = metadata(shell)
+    with open(image, 'rb') as file:
+        before = file.read()[offset:]
+    shell.create('d/f')
+    shell.link('d/f', 'g')
+    shell.mkdir('e')
+    shell.flush()
+    # the transaction reached the journal, the in-place writes did not
+    crash(shell)
+    restore(image, offset, before)
+    shell = fs.OS()
+    shell.mount(image)
+    assert sorted(shell.listdir('/')[2:]) == ['d', 'e', 'g']
+    assert shell.stat('d/f')['nlink'] == 2
+    assert shell.fsck() == 0
+    shell.unmount()
+
+def test_torn_transaction_is_dropped(make_os, image):
+    shell = make_os()
+    shell.create('f')
+    shell.flush()
+    offset = metadata(shell)
+    with open(image, 'rb') as file:
+        before = file.read()[offset:]
+    shell.create('torn')
+    shell.flush()
+    pos = shell.fs.journal_pos
+    crash(shell)
+    restore(image, offset, before)
+    # the last byte of the transaction never reached the disk
+    journal_end = shell.fs.get_journal_offset() + pos
+    with open(image, 'rb') as file:
+        file.seek(journal_end - 1)
+        last = file.read(1)[0]
+    restore(image, journal_end - 1, bytes([last ^ 1]))
+    shell = fs.OS()
+    shell.mount(image)
+    assert shell.stat('f') is not None
+    assert shell.stat('torn') is None
+    assert shell.fsck() == 0
+    shell.create('after')
+    shell.unmount()
+    shell.mount(image)
+    assert sorted(shell.listdir('/')[2:]) == ['after', 'f']
+    shell.unmount()
+
+def sparse_writes(shell: fs.OS, count: int) -> None:
+    # writes an indirect block's reach apart, each needs an indirect block of its own
+    fd = shell.open('f')
+    for k in range(count):
+        assert shell.write_at(fd, b'x', k * fs.pointers_per_block(512) * 512) == 1
+        if shell.fs.journal_bytes() > shell.fs.journal_capacity():
+            break
+    shell.close(fd)
+
+def test_deferred_write_back_flushes_before_the_journal_fills(make_os):
+    shell = make_os(size=8 << 20, descriptors=16, dirty_limit=float('inf'),
+        flush_interval=float('inf'))
+    sparse_writes(shell, 400)
+    assert shell.fs.stats.counters.get('flushes', 0) > 0
+    shell.flush()
+    assert 'journal_split_flushes' not in shell.fs.stats.counters
+    assert shell.fsck() == 0
+
+def transaction_records(data: bytes) -> list[tuple[int, bytes]]:
+    _, _, length, _ = fs.TRANSACTION_STRUCT.unpack_from(data)
+    payload = data[fs.TRANSACTION_STRUCT.size:fs.TRANSACTION_STRUCT.size + length]
+    records = list()
+    i = 0
+    while i < length:
+        offset, size = fs.RECORD_STRUCT.unpack_from(payload, i)
+        i += fs.RECORD_STRUCT.size
+        records.append((offset, payload[i:i + size]))
+        i += size
+    return records
+
+def journalled_flush(shell: fs.OS, monkeypatch) -> int:
+    # flushes, checks that every metadata write in place follows the
+    # transaction holding it, returns the number of transactions
+    writes = list()
+    write = shell.fs.image.write
+    monkeypatch.setattr(shell.fs.image, 'write',
+        lambda offset, data: (writes.append((offset, bytes(data))), write(offset, data))[1])
+    shell.flush()
+    monkeypatch.setattr(shell.fs.image, 'write', write)
+    start = shell.fs.get_journal_offset()
+    end = start + shell.fs.journal_size
+    journalled = set()
+    transactions = 0
+    for offset, data in writes:
+        if start + fs.JOURNAL_HEADER_SIZE <= offset < end:
+            journalled.update(transaction_records(data))
+            transactions += 1
+        elif offset >= end and journalled:
+            assert (offset, data) in journalled
+    return transactions
+
+def test_flush_with_big_blocks_is_journalled(make_os, monkeypatch):
+    shell = make_os(size=1 << 20, block_size=4096, descriptors=16)
+    monkeypatch.setattr(shell.fs, 'maybe_flush', lambda: None)
+    shell.create('f')
+    assert journalled_flush(shell, monkeypatch) >= 1
+    assert shell.fsck() == 0
+
+def test_flush_bigger_than_the_journal_is_split(make_os, image, monkeypatch):
+    shell = make_os(size=8 << 20, descriptors=16)
+    monkeypatch.setattr(shell.fs, 'maybe_flush', lambda: None)
+    sparse_writes(shell, 400)
+    assert shell.fs.journal_bytes() > shell.fs.journal_capacity()
+    size = shell.stat('f')['size']
+    assert journalled_flush(shell, monkeypatch) > 1
+    assert shell.fs.stats.counters['journal_split_flushes'] == 1
+    shell.unmount()
+    shell.mount(image)
+    assert shell.stat('f')['size'] == size
+    assert shell.fsck() == 0
+
+def test_journal_takes_whole_big_blocks(make_os, image, monkeypatch):
+    shell = make_os(size=2 << 20, block_size=65536, descriptors=16)
+    assert shell.fs.journal_capacity() >= fs.JOURNAL_MIN_BLOCKS * 65536
+    shell.flush()
+    offset = metadata(shell)
+    with open(image, 'rb') as file:
+        before = file.read()[offset:]
+    monkeypatch.setattr(shell.fs, 'maybe_flush', lambda: None)
+    shell.create('f')
+    shell.mkdir('d')
+    assert journalled_flush(shell, monkeypatch) == 1
+    crash(shell)
+    restore(image, offset, before)
+    shell = fs.OS()
+    shell.mount(image)
+    assert shell.stat('f') is not None
+    assert shell.stat('d')['type'] == 'd'
+    assert shell.fsck() == 0
+    shell.unmount()
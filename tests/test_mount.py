@@ -0,0 +1,37 @@
+import fs
+
+
+GROUP = 1 << fs.DESC_GROUP_SHIFT
+
+def test_mount_reads_descriptor_groups_on_first_use(make_os, image):
+    shell = make_os(size=8 << 20, descriptors=3 * GROUP)
+    for i in range(GROUP + 100):
+        shell.create(f'f{i}')
+    shell.unlink('f5')
+    shell.unmount()
+    shell.mount(image)
+    # the root directory is in the first group
+    assert list(shell.fs.desc_groups) == [1, 0, 0]
+    assert shell.stat(f'f{GROUP + 50}')['id'] == GROUP + 51
+    assert list(shell.fs.desc_groups) == [1, 1, 0]
+    # the lowest free slot is handed out first, released ones before it
+    shell.create('a')
+    assert shell.stat('a')['id'] == 6
+    shell.create('b')
+    assert shell.stat('b')['id'] == GROUP + 101
+    shell.unlink('b')
+    shell.create('c')
+    assert shell.stat('c')['id'] == GROUP + 101
+    assert shell.fsck() == 0
+    assert list(shell.fs.desc_groups) == [1, 1, 1]
+
+def test_missing_image_is_reported(tmp_path):
+    missing = str(tmp_path / 'missing.img')
+    shell = fs.OS()
+    shell.mount(missing)
+    assert not shell.fs_initialized()
+    shell.fs.mkfs(16, str(tmp_path / 'no' / 'dir.img'), size=1 << 20)
+    assert not shell.fs_initialized()
+    assert fs.fsck(missing) == 8
+    assert fs.defrag(missing) == 1
+    assert not fs.convert(missing)
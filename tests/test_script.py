@@ -0,0 +1,51 @@
+import io
+
+import fs
+
+
+def script(*lines: str) -> io.StringIO:
+    return io.StringIO(''.join(line + '\n' for line in lines))
+
+def test_write_takes_the_raw_next_line(make_os, image):
+    make_os().unmount()
+    data = '  # not a comment  '
+    assert fs.run_script(script('# comment', '', 'create f', 'open f', 'write 0 100', data,
+        'close 0'), image) == 0
+    shell = fs.OS()
+    shell.mount(image)
+    fd = shell.open('f')
+    buf = bytearray(len(data))
+    assert shell.read_at(fd, buf, 0) == len(data)
+    assert buf.decode() == data
+    shell.unmount()
+
+def test_failed_write_keeps_the_script_in_step(make_os, image):
+    make_os().unmount()
+    assert fs.run_script(script('write 5 10', 'create g', 'create f'), image) == 1
+    shell = fs.OS()
+    shell.mount(image)
+    assert shell.stat('f') is not None
+    assert shell.stat('g') is None
+    shell.unmount()
+
+def test_failures_set_the_exit_code(make_os, image):
+    make_os().unmount()
+    assert fs.run_script(script('create f', 'stat f'), image) == 0
+    assert fs.run_script(script('create f'), image) == 1
+    assert fs.run_script(script('unlink missing', 'create h'), image) == 1
+    assert fs.run_script(script('no_such_command'), image) == 1
+
+def test_open_creating_a_file_is_no_failure(make_os, image):
+    make_os().unmount()
+    assert fs.run_script(script('open new', 'close 0', 'stat new'), image) == 0
+    assert fs.run_script(script('open missing/new'), image) == 1
+
+def test_only_the_shell_prints_open_and_close(make_os, image, capsys):
+    shell = make_os()
+    capsys.readouterr()
+    shell.close(shell.open('f'))
+    assert capsys.readouterr().out == ''
+    shell.unmount()
+    assert fs.run_script(script('open f', 'close 0'), image) == 0
+    out = capsys.readouterr().out
+    assert 'fd=0' in out and 'Closed!' in out
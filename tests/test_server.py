@@ -0,0 +1,90 @@
+import os, signal, subprocess, sys, time
+
+import pytest
+
+import fs
+from conftest import contents
+
+
+FS_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fs.py')
+
+@pytest.fixture
+def server(make_os, image, tmp_path):
+    # a server process sharing a fresh image, stopped with SIGTERM like a service
+    make_os(size=4 << 20).unmount()
+    path = str(tmp_path / 'fs.sock')
+    proc = subprocess.Popen([sys.executable, FS_PY, '--image', image, '--serve', path,
+        '--log-level', 'fail'])
+    deadline = time.monotonic() + 30
+    while not os.path.exists(path):
+        assert proc.poll() is None and time.monotonic() < deadline
+        time.sleep(0.01)
+    yield proc, path
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+def stop(proc: subprocess.Popen, path: str) -> None:
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait(30) == 0
+    assert not os.path.exists(path)
+
+def test_clients_share_the_image(server, image):
+    proc, path = server
+    data = bytes(range(256)) * 20
+    with fs.Client(path) as client:
+        client.mkdir('d')
+        fd = client.open('d/f')
+        assert fd >= 0
+        assert client.write(fd, data) == len(data)
+        assert client.read_at(fd, 10, 250) == data[250:260]
+        client.seek(fd, 0)
+        assert client.read(fd, len(data) + 100) == data
+        client.close(fd)
+        # the descriptor is gone, the failed call gets an error reply
+        assert client.read(fd, 10) is None
+        with fs.Client(path) as other:
+            assert other.stat('d/f')['size'] == len(data)
+    stop(proc, path)
+    shell = fs.OS()
+    shell.mount(image)
+    assert contents(shell, 'd/f') == data
+    assert shell.fsck() == 0
+    shell.unmount()
+
+def test_pipelined_calls_reply_in_order(server, image):
+    proc, path = server
+    with fs.Client(path) as client:
+        fd = client.open('f')
+        pipeline = client.pipeline()
+        pipeline.write_at(fd, b'abc', 0)
+        pipeline.close(fd + 1)
+        pipeline.read_at(fd, 3, 0)
+        pipeline.stat('f')
+        pipeline.listdir('/')
+        pipeline.close(fd)
+        written, failed, read, stat, names, closed = pipeline.run()
+        assert (written, failed, read) == (3, None, b'abc')
+        assert stat['size'] == 3
+        assert names == ['.', '..', 'f']
+        assert closed is None
+        # the connection stays usable after a pipeline
+        assert client.stat('f')['size'] == 3
+    stop(proc, path)
+
+def test_served_image_is_not_mounted_twice(server, image, tmp_path):
+    proc, path = server
+    shell = fs.OS()
+    shell.mount(image)
+    assert not shell.fs_initialized()
+    other_path = str(tmp_path / 'other.sock')
+    assert fs.serve(image, other_path) == 1
+    assert not os.path.exists(other_path)
+    # another image cannot take the socket of a running server
+    other = str(tmp_path / 'other.img')
+    shell.fs.mkfs(16, other, size=1 << 20, block_size=512)
+    shell.unmount()
+    assert fs.serve(other, path) == 1
+    with fs.Client(path) as client:
+        assert client.listdir('/') == ['.', '..']
+    stop(proc, path)
@@ -0,0 +1,66 @@
+import random
+
+import fs
+
+
+def read(shell: fs.OS, fd: int, offset: int, size: int) -> bytes:
+    buf = bytearray(size)
+    count = shell.read_at(fd, buf, offset)
+    return bytes(buf[:count])
+
+def test_truncate_extends_with_a_hole(make_os, image):
+    shell = make_os(size=4 << 20)
+    free = shell.fs.bitmap.free
+    shell.create('f')
+    shell.truncate('f', 1 << 30)
+    assert shell.stat('f')['size'] == 1 << 30
+    # only the indirect blocks the map needs, no data blocks
+    assert free - shell.fs.bitmap.free < 16
+    fd = shell.open('f')
+    assert read(shell, fd, 512 << 20, 4096) == bytes(4096)
+    assert read(shell, fd, (1 << 30) - 10, 100) == bytes(10)
+    assert shell.write_at(fd, b'abc', 700 << 20) == 3
+    shell.close(fd)
+    shell.unmount()
+    shell.mount(image)
+    fd = shell.open('f')
+    assert read(shell, fd, (700 << 20) - 2, 7) == b'\0\0abc\0\0'
+    shell.close(fd)
+    shell.unlink('f')
+    assert shell.fs.bitmap.free == free
+    assert shell.fsck() == 0
+
+def test_sparse_writes_and_truncates(make_os, image):
+    shell = make_os(size=8 << 20)
+    rand = random.Random(3)
+    free = shell.fs.bitmap.free
+    data = bytearray()
+    fd = shell.open('f')
+    for k in range(200):
+        offset = rand.choice([rand.randrange(1 << 16), rand.randrange(1 << 22),
+            rand.randrange(1 << 26)])
+        chunk = rand.randbytes(rand.randrange(1, 3000))
+        assert shell.write_at(fd, chunk, offset) == len(chunk)
+        data[len(data):offset] = bytes(max(0, offset - len(data)))
+        data[offset:offset + len(chunk)] = chunk
+        if k % 50 == 49:
+            # truncate rounds up to whole blocks
+            size = (rand.randrange(len(data)) // 512 + 1) * 512
+            shell.truncate('f', size)
+            data[size:] = b''
+            data[len(data):size] = bytes(size - len(data))
+    assert shell.stat('f')['size'] == len(data)
+    assert read(shell, fd, 0, len(data) + 10) == data
+    # past the end of file after a seek, the gap reads as zeros
+    shell.seek(fd, len(data) + 100000)
+    assert shell.write_bytes(fd, b'xyz') == 3
+    data += bytes(100000) + b'xyz'
+    shell.close(fd)
+    assert shell.fsck() == 0
+    shell.unmount()
+    shell.mount(image)
+    fd = shell.open('f')
+    assert read(shell, fd, 0, len(data)) == data
+    shell.close(fd)
+    shell.unlink('f')
+    assert shell.fs.bitmap.free == free